@@ -1 +1,8 @@
+import django
+
+
 __version__ = '4.15.0'
+
+if django.VERSION < (3, 2):
+    # Later versions find the AppConfig in cropduster.apps by themselves
+    default_app_config = 'cropduster.apps.CropDusterConfig'
@@ -0,0 +1,14 @@
+from django.apps import AppConfig, apps
+
+
+class CropDusterConfig(AppConfig):
+
+    name = "cropduster"
+    verbose_name = "Cropduster"
+
+    def ready(self):
+        from cropduster.fields import register_image_fields
+
+        # Find the CropDusterImageFields that Image.save() updates now,
+        # rather than walking each model's fields on every save
+        register_image_fields(apps.get_models())
@@ -18,7 +18,8 @@ from generic_plus.forms import (
 import cropduster.settings
 from .forms import CropDusterInlineFormSet, CropDusterWidget, CropDusterThumbFormField
 from .utils import json
-from .resizing import Box, Crop
+from .render import RenderBatch
+from .resizing import Box, Crop, Size
 
 try:
     from django.db.models.fields.related import (
@@ -56,8 +57,15 @@ class CropDusterImageFieldFile(ImageFieldFile):
         Image = compat_rel_to(self.field.db_field)
         Thumb = compat_rel_to(Image._meta.get_field("thumbs"))
 
-        box = Box(0, 0, self.width, self.height)
-        crop_box = Crop(box, self.name)
+        # Only the geometry is needed, so give the crop the dimensions stored
+        # on the Image row rather than having it open the original
+        image = self.related_object
+        if image is not None and image.width and image.height:
+            orig_size = (image.width, image.height)
+        else:
+            orig_size = (self.width, self.height)
+        box = Box(0, 0, *orig_size)
+        crop_box = Crop(box, self.name, size=orig_size)
 
         best_fit = size.fit_to_crop(crop_box, original_image=self.name)
         fit_box = best_fit.box
@@ -72,7 +80,18 @@ class CropDusterImageFieldFile(ImageFieldFile):
         })
         return crop_thumb
 
-    def generate_thumbs(self, permissive=False, skip_existing=False):
+    def generate_thumbs(self, permissive=False, skip_existing=False, background=None,
+                        sizes=None):
+        """
+        Create (or re-create) the thumbs for every size of the field.
+
+        If ``sizes`` is passed, only the sizes with those names (or whose auto
+        sizes have those names) are generated.
+
+        If ``background`` is True (it defaults to the CROPDUSTER_BACKGROUND_THUMBS
+        setting), only the crop geometry of the thumbs is saved before returning;
+        the image files are created by the backend in CROPDUSTER_THUMB_BACKEND.
+        """
         # "Imports"
         Image = compat_rel_to(self.field.db_field)
         Thumb = compat_rel_to(Image._meta.get_field("thumbs"))
@@ -93,20 +112,54 @@ class CropDusterImageFieldFile(ImageFieldFile):
             image.save()
             self.related_object = image
 
-        for size in self.sizes:
-            if getattr(size, 'is_alias', False):
-                continue
-            try:
-                crop_thumb = self.related_object.thumbs.get(name=size.name)
-            except Thumb.DoesNotExist:
-                crop_thumb = self._get_new_crop_thumb(size)
+        if background is None:
+            background = cropduster.settings.CROPDUSTER_BACKGROUND_THUMBS
+
+        if background:
+            # Only the crop geometry is computed now, from the dimensions
+            # stored on the Image row; the backend reads the original when it
+            # renders the thumbnails
+            pil_image = None
+        else:
+            # Open the original once and share it across every size, rather
+            # than having save_size() re-read and re-decode it for each one,
+            # and render all of the sizes together once their crop boxes are known
+            pil_image = self.related_object.open_image()
+        batch = RenderBatch(pil_image)
+
+        field_sizes = [s for s in self.sizes if not getattr(s, 'is_alias', False)]
+        if sizes is not None:
+            size_names = set(sizes)
+            field_sizes = [s for s in field_sizes
+                           if any(sz.name in size_names for sz in Size.flatten([s]))]
+
+        # Look up the thumbs of every size in one query, and save them all
+        # together once their crop boxes are known
+        existing_thumbs = self.related_object.get_thumbs_by_name(field_sizes)
+        all_thumbs = []
+        for size in field_sizes:
+            crop_thumb = existing_thumbs.get(size.name) or self._get_new_crop_thumb(size)
 
             thumbs = self.related_object.save_size(
-                size, thumb=crop_thumb, permissive=permissive, skip_existing=skip_existing)
+                size, thumb=crop_thumb, image=pil_image, permissive=permissive,
+                skip_existing=skip_existing, commit=False, render=not background,
+                batch=batch, existing_thumbs=existing_thumbs)
 
             for slug, thumb in thumbs.items():
                 thumb.image = self.related_object
-                thumb.save()
+                all_thumbs.append(thumb)
+
+        # Render before saving, so that the thumbs are saved with the
+        # quality they were encoded at
+        batch.run()
+        Thumb.objects.bulk_save(all_thumbs)
+
+        if background:
+            from cropduster.jobs import get_backend
+
+            get_backend().enqueue(
+                self.related_object, field_sizes, permissive=permissive,
+                skip_existing=skip_existing)
 
 
 class CropDusterImageField(models.ImageField):
@@ -118,6 +171,40 @@ class CropDusterImageField(models.ImageField):
         return super(CropDusterImageField, self).formfield(*args, **kwargs)
 
 
+# The CropDusterImageFields of each model, by field_identifier, as a list of
+# (model, attname) pairs. Built for every installed model when the app is
+# ready, and for any other model the first time it is looked up.
+_image_field_registry = {}
+
+
+def _get_model_image_fields(model_class):
+    image_fields = {}
+    for field in model_class._meta.get_fields():
+        if isinstance(field, CropDusterImageField):
+            field_identifier = field.generic_field.field_identifier
+            # field.model is the parent model whose table holds the column,
+            # for fields inherited through multi-table inheritance
+            image_fields.setdefault(field_identifier, []).append((field.model, field.attname))
+    return image_fields
+
+
+def register_image_fields(model_classes):
+    for model_class in model_classes:
+        _image_field_registry[model_class] = _get_model_image_fields(model_class)
+
+
+def get_image_fields(model_class, field_identifier):
+    """
+    Returns the (model, attname) pairs of the CropDusterImageFields of
+    ``model_class`` whose CropDusterField has ``field_identifier``.
+    """
+    try:
+        image_fields = _image_field_registry[model_class]
+    except KeyError:
+        image_fields = _image_field_registry[model_class] = _get_model_image_fields(model_class)
+    return image_fields.get(field_identifier, [])
+
+
 class CropDusterImageFileDescriptor(ImageFileDescriptor):
     """
     The same as ImageFileDescriptor, except only updates image dimensions if
@@ -237,6 +324,9 @@ def create_reverse_foreign_related_manager(
                 super(RelatedManager, self).set(objs, **kwargs)
                 for obj in objs:
                     obj.save()
+                if cropduster.settings.CROPDUSTER_CROP_MANIFEST and hasattr(self.instance, 'refresh_manifest'):
+                    # Once for all of the thumbs, rather than as each is saved
+                    self.instance.refresh_manifest()
 
         set.alters_data = True
 
@@ -2,7 +2,6 @@ from __future__ import division
 
 import os
 import re
-import hashlib
 
 from django.core.files.images import get_image_dimensions
 from django.core.files.uploadedfile import SimpleUploadedFile
@@ -15,6 +14,8 @@ from urllib.request import urlopen
 
 from generic_plus.utils import get_relative_media_url, get_media_path
 
+from .utils import file_exists
+
 
 class VirtualFieldFile(FieldFile):
 
@@ -42,6 +43,12 @@ class VirtualFieldFile(FieldFile):
 
     @cached_property
     def dimensions(self):
+        from cropduster.utils import probe_image
+
+        probed = probe_image(self.name, storage=self.storage) if self.name else None
+        if probed:
+            return probed[1:]
+        # Fall back to PIL for formats probe_image() doesn't know
         try:
             close = self.closed
             self.open()
@@ -87,7 +94,7 @@ class ImageFile(VirtualFieldFile):
             # url on other server? download it.
             self._path = self.download_image_url(path)
         else:
-            if default_storage.exists(path):
+            if file_exists(path):
                 self._path = path
 
         if not self._path:
@@ -101,13 +108,13 @@ class ImageFile(VirtualFieldFile):
 
     def download_image_url(self, url):
         from cropduster.models import StandaloneImage
+        from cropduster.utils import md5_digest
         from cropduster.views.forms import clean_upload_data
 
         image_contents = urlopen(url).read()
-        md5_hash = hashlib.md5()
-        md5_hash.update(image_contents)
+        md5 = md5_digest(image_contents)
         try:
-            standalone_image = StandaloneImage.objects.get(md5=md5_hash.hexdigest())
+            standalone_image = StandaloneImage.objects.get(md5=md5)
         except StandaloneImage.DoesNotExist:
             pass
         else:
@@ -119,7 +126,7 @@ class ImageFile(VirtualFieldFile):
         file_data = clean_upload_data({
             'image': fake_upload,
             'upload_to': self.upload_to,
-        })
+        }, md5=md5)
         return get_relative_media_url(file_data['image'].name)
 
     def __nonzero__(self):
@@ -133,6 +140,6 @@ class ImageFile(VirtualFieldFile):
 
         image = Image.get_file_for_size(self, size_slug)
         if size_slug == 'preview':
-            if not default_storage.exists(image.name):
+            if not file_exists(image.name):
                 Image.save_preview_file(self, preview_w=self.preview_width, preview_h=self.preview_height)
         return image
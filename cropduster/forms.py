@@ -220,6 +220,13 @@ class CropDusterInlineFormSet(BaseGenericFileInlineFormSet):
                 form.add_error(
                     "alt_text", "Alt text describing the image is required for this field.")
 
+    def save_existing(self, form, instance, commit=True):
+        if commit:
+            # A re-cropped thumb is a new row, the next generation of the thumb
+            # it replaces, which would otherwise be left behind with no image
+            instance.delete_replaced_thumbs(form.cleaned_data.get('thumbs') or [])
+        return super(CropDusterInlineFormSet, self).save_existing(form, instance, commit=commit)
+
     def _construct_form(self, i, **kwargs):
         """
         Limit the queryset of the thumbs for performance reasons (so that it doesn't
@@ -0,0 +1,148 @@
+"""
+Backends for creating thumbnail files outside of the code that saves them.
+
+When ``CropDusterImageFieldFile.generate_thumbs()`` is called with
+``background=True`` (or the CROPDUSTER_BACKGROUND_THUMBS setting is enabled),
+the crop geometry of every size is saved immediately and the image is handed
+to the backend named by the CROPDUSTER_THUMB_BACKEND setting, which renders
+the files later.
+
+ImmediateBackend
+    Renders the thumbnails in the calling thread once the current transaction
+    commits. Mostly useful in tests.
+
+ThreadPoolBackend (the default)
+    Renders the thumbnails in a pool of CROPDUSTER_THUMB_WORKERS threads in the
+    current process. Pillow releases the GIL while resizing and encoding, so
+    the pool renders several images at once.
+
+DatabaseBackend
+    Queues a RenderJob row, to be processed by the ``cropduster_render_jobs``
+    management command. Jobs survive process restarts and need no external
+    broker.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, connection, transaction
+from django.utils.module_loading import import_string
+
+from cropduster import settings as cropduster_settings
+from cropduster.render import RenderBatch
+from cropduster.utils import json
+
+
+__all__ = (
+    'render_thumbs', 'get_backend', 'ImmediateBackend', 'ThreadPoolBackend',
+    'DatabaseBackend')
+
+
+logger = logging.getLogger(__name__)
+
+
+def render_thumbs(image_id, sizes, permissive=False, skip_existing=False):
+    """
+    Create the thumbnail files of an Image's sizes from the crop geometry
+    already saved on its thumbs.
+
+    :param image_id: the primary key of a cropduster.models.Image
+    :param sizes: a list of Size objects, or its JSON serialization
+    """
+    from cropduster.models import Image, Thumb
+
+    if isinstance(sizes, str):
+        sizes = json.loads(sizes)
+
+    image = Image.objects.get(pk=image_id)
+    pil_image = image.open_image()
+    batch = RenderBatch(pil_image)
+
+    sizes = [size for size in sizes if not getattr(size, 'is_alias', False)]
+    existing_thumbs = image.get_thumbs_by_name(sizes)
+    all_thumbs = []
+    for size in sizes:
+        crop_thumb = existing_thumbs.get(size.name)
+        if crop_thumb is None:
+            logger.warning("Image %s has no crop for size '%s'", image_id, size.name)
+            continue
+
+        thumbs = image.save_size(
+            size, thumb=crop_thumb, image=pil_image, permissive=permissive,
+            skip_existing=skip_existing, commit=False, batch=batch,
+            existing_thumbs=existing_thumbs)
+
+        for slug, thumb in thumbs.items():
+            thumb.image = image
+            all_thumbs.append(thumb)
+
+    batch.run()
+    Thumb.objects.bulk_save(all_thumbs)
+
+
+class BaseBackend(object):
+
+    def enqueue(self, image, sizes, permissive=False, skip_existing=False):
+        """Schedule the creation of the thumbnail files of ``image``'s ``sizes``."""
+        raise NotImplementedError
+
+
+class ImmediateBackend(BaseBackend):
+
+    def enqueue(self, image, sizes, permissive=False, skip_existing=False):
+        sizes = json.dumps(sizes)
+        transaction.on_commit(lambda: render_thumbs(
+            image.pk, sizes, permissive=permissive, skip_existing=skip_existing))
+
+
+class ThreadPoolBackend(BaseBackend):
+
+    _executor = None
+    _lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if ThreadPoolBackend._executor is None:
+                ThreadPoolBackend._executor = ThreadPoolExecutor(
+                    max_workers=cropduster_settings.CROPDUSTER_THUMB_WORKERS,
+                    thread_name_prefix='cropduster')
+        return ThreadPoolBackend._executor
+
+    def enqueue(self, image, sizes, permissive=False, skip_existing=False):
+        # Serialize the sizes so that the worker doesn't share Size objects
+        # with the caller, and wait for the crop geometry to be committed
+        # before handing the image to another thread (and db connection).
+        sizes = json.dumps(sizes)
+        transaction.on_commit(lambda: self.executor.submit(
+            self.run, image.pk, sizes, permissive=permissive, skip_existing=skip_existing))
+
+    def run(self, image_id, sizes, **kwargs):
+        close_old_connections()
+        try:
+            render_thumbs(image_id, sizes, **kwargs)
+        except Exception:
+            logger.exception("Failed to render thumbnails for image %s", image_id)
+        finally:
+            connection.close()
+
+
+class DatabaseBackend(BaseBackend):
+
+    def enqueue(self, image, sizes, permissive=False, skip_existing=False):
+        from cropduster.models import RenderJob
+
+        RenderJob.objects.create(
+            image=image, sizes=json.dumps(sizes), permissive=permissive,
+            skip_existing=skip_existing)
+
+
+_backends = {}
+
+
+def get_backend():
+    """Return an instance of the backend named by CROPDUSTER_THUMB_BACKEND."""
+    path = cropduster_settings.CROPDUSTER_THUMB_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
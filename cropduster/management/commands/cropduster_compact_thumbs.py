@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from cropduster.models import Thumb
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Delete the thumbs that belong to no image, and their files: crops "
+        "that were never committed, and generations replaced by a later crop.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float, default=24,
+            help="Only delete thumbs last modified this many hours ago or "
+                 "earlier, so that crops still being edited are kept (default: 24)")
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of thumbs to delete at a time (default: 1000)")
+
+    def handle(self, min_age=24, batch_size=1000, **options):
+        deleted = Thumb.objects.delete_orphans(
+            max_age=timedelta(hours=min_age), batch_size=batch_size)
+        self.stdout.write("Deleted %d orphaned thumb(s)" % deleted)
@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+
+from cropduster.fields import CropDusterField
+from cropduster.models import Image
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Regenerate the thumbnails of existing images, for instance after "
+        "adding a new size. Images are processed in primary key order, so an "
+        "interrupted run can be resumed with --checkpoint.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', dest='models', default=[],
+            metavar='APP_LABEL.MODEL',
+            help="Only regenerate images attached to this model (can be repeated)")
+        parser.add_argument('--field-identifier', action='append',
+            dest='field_identifiers', default=[],
+            help="Only regenerate images with this field_identifier (can be repeated)")
+        parser.add_argument('--size', action='append', dest='sizes', default=[],
+            help="Only regenerate the size with this name (can be repeated)")
+        parser.add_argument('--batch-size', type=int, default=500,
+            help="Number of images to fetch at a time (default: 500)")
+        parser.add_argument('--workers', type=int, default=1,
+            help="Number of threads regenerating images concurrently (default: 1)")
+        parser.add_argument('--checkpoint', metavar='FILE',
+            help=(
+                "Record the last processed image in FILE after every batch, "
+                "and resume from it if it exists"))
+        parser.add_argument('--skip-existing', action='store_true',
+            help="Don't re-create thumbnail files that already exist")
+        parser.add_argument('--permissive', action='store_true',
+            help="Skip sizes that the image is too small for, instead of failing")
+
+    def handle(self, models=None, field_identifiers=None, sizes=None,
+               batch_size=500, workers=1, checkpoint=None, skip_existing=False,
+               permissive=False, **options):
+        self.sizes = sizes or None
+        self.skip_existing = skip_existing
+        self.permissive = permissive
+
+        queryset = Image.objects.filter(object_id__isnull=False)
+        if models:
+            queryset = queryset.filter(content_type__in=[
+                self.get_content_type(label) for label in models])
+        if field_identifiers:
+            queryset = queryset.filter(field_identifier__in=field_identifiers)
+        queryset = queryset.select_related('content_type').order_by('pk')
+
+        last_pk = self.read_checkpoint(checkpoint)
+        if last_pk:
+            self.stdout.write("Resuming after image %d" % last_pk)
+
+        executor = None
+        if workers > 1:
+            executor = ThreadPoolExecutor(max_workers=workers)
+
+        done = failed = 0
+        start = time.time()
+        try:
+            while True:
+                # Keyset pagination: unlike OFFSET, every batch is an index
+                # range scan no matter how far into the table it is.
+                images = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+                if not images:
+                    break
+                if executor:
+                    results = executor.map(self.regenerate_in_thread, images)
+                else:
+                    results = [self.regenerate(image) for image in images]
+                for result in results:
+                    if result:
+                        done += 1
+                    else:
+                        failed += 1
+                last_pk = images[-1].pk
+                self.write_checkpoint(checkpoint, last_pk)
+
+                elapsed = time.time() - start
+                self.stdout.write(
+                    "Regenerated %d image(s), %d failed, up to image %d "
+                    "(%.1f images/s)" % (
+                        done, failed, last_pk, (done + failed) / (elapsed or 1)))
+        finally:
+            if executor:
+                executor.shutdown()
+
+        self.stdout.write("Done: regenerated %d image(s), %d failed" % (done, failed))
+
+    def get_content_type(self, label):
+        try:
+            app_label, model = label.lower().split('.')
+            return ContentType.objects.get_by_natural_key(app_label, model)
+        except (ValueError, ContentType.DoesNotExist):
+            raise CommandError("Unknown model '%s'" % label)
+
+    def read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return json.load(f)['last_pk']
+
+    def write_checkpoint(self, path, last_pk):
+        if not path:
+            return
+        # Write to a temporary file and rename it, so that a crash can't leave
+        # a truncated checkpoint behind
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_pk': last_pk}, f)
+        os.replace(tmp_path, path)
+
+    def get_field_file(self, image):
+        obj = image.content_object
+        if obj is None:
+            return None
+        for field in obj._meta.private_fields:
+            if isinstance(field, CropDusterField) and field.field_identifier == image.field_identifier:
+                field_file = getattr(obj, field.name)
+                if field_file.name == image.image.name:
+                    return field_file
+        return None
+
+    def regenerate(self, image):
+        try:
+            field_file = self.get_field_file(image)
+            if field_file is None:
+                self.stderr.write("Image %d: no matching field, skipping" % image.pk)
+                return False
+            field_file.generate_thumbs(
+                permissive=self.permissive, skip_existing=self.skip_existing,
+                background=False, sizes=self.sizes)
+        except Exception as e:
+            self.stderr.write("Image %d: %s" % (image.pk, e))
+            return False
+        return True
+
+    def regenerate_in_thread(self, image):
+        close_old_connections()
+        try:
+            return self.regenerate(image)
+        finally:
+            connection.close()
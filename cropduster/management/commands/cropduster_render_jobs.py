@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from cropduster.models import RenderJob
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Create the thumbnail files queued by cropduster.jobs.DatabaseBackend, "
+        "until no pending jobs remain.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+            help="Number of jobs to claim at a time (default: 100)")
+        parser.add_argument('--workers', type=int, default=1,
+            help="Number of threads rendering jobs concurrently (default: 1)")
+        parser.add_argument('--retry-failed', action='store_true',
+            help="Re-queue failed jobs before processing")
+        parser.add_argument('--stale-after', type=float, default=60,
+            help="Re-queue jobs that were claimed this many minutes ago or "
+                 "earlier and are still running, e.g. because their worker "
+                 "died (default: 60)")
+
+    def handle(self, batch_size=100, workers=1, retry_failed=False, stale_after=60,
+               **options):
+        if retry_failed:
+            RenderJob.objects.filter(status=RenderJob.FAILED).update(
+                status=RenderJob.PENDING, error='')
+        RenderJob.objects.requeue_stale(timedelta(minutes=stale_after))
+
+        executor = None
+        if workers > 1:
+            executor = ThreadPoolExecutor(max_workers=workers)
+
+        done = failed = 0
+        try:
+            while True:
+                jobs = RenderJob.objects.claim(limit=batch_size)
+                if not jobs:
+                    break
+                if executor:
+                    results = executor.map(self.run_job_in_thread, jobs)
+                else:
+                    results = [job.run() for job in jobs]
+                for result in results:
+                    if result:
+                        done += 1
+                    else:
+                        failed += 1
+        finally:
+            if executor:
+                executor.shutdown()
+
+        self.stdout.write("Rendered %d job(s), %d failed" % (done, failed))
+
+    def run_job_in_thread(self, job):
+        close_old_connections()
+        try:
+            return job.run()
+        finally:
+            connection.close()
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+import cropduster.settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0002_alt_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sizes', models.TextField()),
+                ('permissive', models.BooleanField(default=False)),
+                ('skip_existing', models.BooleanField(default=False)),
+                ('status', models.CharField(max_length=16, db_index=True, default='pending', choices=[('pending', 'Pending'), ('running', 'Running'), ('failed', 'Failed')])),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('date_claimed', models.DateTimeField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('image', models.ForeignKey(related_name='+', to='cropduster.Image', on_delete=models.CASCADE)),
+            ],
+            options={
+                'db_table': '%s_renderjob' % cropduster.settings.CROPDUSTER_DB_PREFIX,
+            },
+        ),
+    ]
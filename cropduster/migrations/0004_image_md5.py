@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0003_renderjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='md5',
+            field=models.CharField(blank=True, default='', editable=False, max_length=32),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0004_image_md5'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='manifest',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+    ]
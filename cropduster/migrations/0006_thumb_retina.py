@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0005_image_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumb',
+            name='retina_width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='thumb',
+            name='retina_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0006_thumb_retina'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumb',
+            name='formats',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
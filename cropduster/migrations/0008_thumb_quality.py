@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0007_thumb_formats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumb',
+            name='quality',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
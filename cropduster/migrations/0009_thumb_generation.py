@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0008_thumb_quality'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumb',
+            name='generation',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='thumb',
+            name='pending_image',
+            field=models.ForeignKey(related_name='+', to='cropduster.Image', blank=True, null=True, on_delete=models.CASCADE),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def unique_md5s(apps, schema_editor):
+    StandaloneImage = apps.get_model('cropduster', 'StandaloneImage')
+    db = schema_editor.connection.alias
+    StandaloneImage.objects.using(db).filter(md5='').update(md5=None)
+    # Lookups by md5 couldn't tell duplicates apart, so only the first image
+    # with each digest keeps it
+    duplicates = (
+        StandaloneImage.objects.using(db).exclude(md5=None).values('md5')
+        .annotate(count=Count('pk'), first_pk=Min('pk')).filter(count__gt=1))
+    for duplicate in duplicates:
+        (StandaloneImage.objects.using(db).filter(md5=duplicate['md5'])
+            .exclude(pk=duplicate['first_pk']).update(md5=None))
+
+
+def empty_md5s(apps, schema_editor):
+    StandaloneImage = apps.get_model('cropduster', 'StandaloneImage')
+    db = schema_editor.connection.alias
+    StandaloneImage.objects.using(db).filter(md5=None).update(md5='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropduster', '0009_thumb_generation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='standaloneimage',
+            name='md5',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.RunPython(unique_md5s, empty_md5s),
+        migrations.AlterField(
+            model_name='standaloneimage',
+            name='md5',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='thumb',
+            index=models.Index(fields=['image', 'name'], name='cropduster_thumb_image_name'),
+        ),
+    ]
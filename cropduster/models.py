@@ -1,18 +1,20 @@
 from __future__ import division
 
-import hashlib
 import random
+import traceback
 from io import BytesIO
 import os
 import time
 from datetime import datetime
 
 from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.files.images import get_image_dimensions
 from django.core.files.storage import FileSystemStorage
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.core.files.storage import default_storage, FileSystemStorage
+from django.utils import timezone
 
 import PIL.Image
 
@@ -21,14 +23,132 @@ from generic_plus.utils import get_relative_media_url
 from .exceptions import CropDusterResizeException
 from .fields import (
     CropDusterField, ReverseForeignRelation, CropDusterImageField,
-    CropDusterSimpleImageField)
+    CropDusterSimpleImageField, get_image_fields)
 from .files import VirtualFieldFile
-from .resizing import Size, Box, Crop, SizeAlias
-from .utils import process_image
+from .render import RenderBatch
+from .resizing import Size, Box, Crop, SizeAlias, get_xmp_metadata
+from .utils import (
+    json, process_image, draft_image, get_preview_size, smart_resize, md5_digest,
+    get_cache_buster, probe_image, get_format_extension, get_alternate_formats,
+    move_file, file_exists, delete_file, record_write)
+from .utils.xmp import XMP_PACKET_FORMATS, can_write_xmp_packet
 from . import settings as cropduster_settings
 
 
-__all__ = ('Image', 'Thumb', 'StandaloneImage', 'CropDusterField', 'Size', 'Box', 'Crop')
+__all__ = ('Image', 'Thumb', 'RenderJob', 'StandaloneImage', 'CropDusterField', 'Size', 'Box', 'Crop')
+
+
+class ThumbManager(models.Manager):
+
+    def bulk_save(self, thumbs):
+        """
+        Save ``thumbs`` in one transaction, creating the new ones with
+        bulk_create() (before the auto thumbs that reference them) and
+        updating the others with bulk_update(), then move the tmp files of the
+        updated thumbs into place, as Thumb.save() does, and refresh the
+        manifests of the images they belong to.
+
+        On databases that cannot return the primary keys of bulk inserted
+        rows, the new thumbs are saved one at a time.
+        """
+        thumbs = list(thumbs)
+        db = router.db_for_write(self.model)
+        features = connections[db].features
+        can_return_pks = getattr(features, 'can_return_rows_from_bulk_insert',
+            getattr(features, 'can_return_ids_from_bulk_insert', False))
+        reference_field = self.model._meta.get_field('reference_thumb')
+
+        def sync_reference(thumb):
+            # Returns False if the thumb references a thumb not yet created
+            ref_thumb = reference_field.get_cached_value(thumb, default=None)
+            if ref_thumb is None:
+                return True
+            thumb.reference_thumb_id = ref_thumb.pk
+            return ref_thumb.pk is not None
+
+        existing = [t for t in thumbs if t.pk]
+        with transaction.atomic(using=db):
+            pending = [t for t in thumbs if not t.pk]
+            while pending:
+                ready = [t for t in pending if sync_reference(t)] or pending
+                if can_return_pks:
+                    self.using(db).bulk_create(ready)
+                else:
+                    for thumb in ready:
+                        super(Thumb, thumb).save(using=db)
+                ready_ids = set(map(id, ready))
+                pending = [t for t in pending if id(t) not in ready_ids]
+            if existing:
+                now = timezone.now()
+                for thumb in existing:
+                    sync_reference(thumb)
+                    thumb.date_modified = now
+                fields = [f.name for f in self.model._meta.concrete_fields if not f.primary_key]
+                self.using(db).bulk_update(existing, fields)
+
+        for thumb in existing:
+            if thumb.image_id:
+                thumb.promote_tmp_files()
+
+        if cropduster_settings.CROPDUSTER_CROP_MANIFEST:
+            image_thumbs = {t.image_id: t for t in thumbs if t.image_id}
+            for thumb in image_thumbs.values():
+                thumb.image.refresh_manifest()
+
+    def delete_orphans(self, max_age=None, batch_size=1000):
+        """
+        Delete the thumbs that belong to no image and were last modified more
+        than ``max_age`` (a timedelta) ago, and their files, ``batch_size`` at
+        a time: crops that were never committed, and generations that were
+        replaced before committing deleted them. Returns the number of thumbs
+        deleted.
+        """
+        orphans = self.filter(image__isnull=True)
+        if max_age is not None:
+            orphans = orphans.filter(date_modified__lt=timezone.now() - max_age)
+        # A thumb whose auto thumbs belong to an image is still in use
+        orphans = orphans.exclude(auto_set__image__isnull=False).order_by('pk')
+        deleted = 0
+        while True:
+            thumbs = list(orphans.select_related('pending_image')[:batch_size])
+            if not thumbs:
+                return deleted
+            pks = [t.pk for t in thumbs]
+            # Their auto thumbs are deleted with them
+            thumbs += self.filter(reference_thumb__in=pks).exclude(pk__in=pks).select_related('pending_image')
+            # Delete the files first, so that a failure leaves the rows to retry
+            for path in self._get_orphan_paths(thumbs):
+                delete_file(path)
+            with transaction.atomic(using=router.db_for_write(self.model)):
+                deleted += self.filter(pk__in=pks).delete()[1].get(self.model._meta.label, 0)
+
+    def _get_orphan_paths(self, thumbs):
+        """
+        Returns the paths of the files of the orphaned ``thumbs`` which no
+        other thumb uses. Every uncommitted crop of a size renders to the same
+        tmp files, which are kept while a newer crop of it is pending, and the
+        files without the tmp suffix are those of the size's committed thumb,
+        if the image has one.
+        """
+        thumbs = [t for t in thumbs if t.pending_image_id]
+        if not thumbs:
+            return []
+        image_ids = set(t.pending_image_id for t in thumbs)
+        names = set(t.name for t in thumbs)
+        pending = set(
+            self.filter(image__isnull=True, pending_image__in=image_ids, name__in=names)
+            .exclude(pk__in=[t.pk for t in thumbs])
+            .values_list('pending_image', 'name'))
+        committed = set(
+            self.filter(image__in=image_ids, name__in=names).values_list('image', 'name'))
+        paths = []
+        for thumb in thumbs:
+            key = (thumb.pending_image_id, thumb.name)
+            if key not in pending:
+                paths += thumb.get_image_paths(tmp=True, image=thumb.pending_image)
+            if key not in committed:
+                paths += thumb.get_image_paths(image=thumb.pending_image)
+        return sorted(set(paths))
 
 
 class Thumb(models.Model):
@@ -47,14 +167,42 @@ class Thumb(models.Model):
     crop_w = models.PositiveIntegerField(blank=True, null=True)
     crop_h = models.PositiveIntegerField(blank=True, null=True)
 
+    # The dimensions of the thumb's 2x file, for sizes with retina=True whose
+    # crop box is large enough to have one
+    retina_width = models.PositiveIntegerField(blank=True, null=True)
+    retina_height = models.PositiveIntegerField(blank=True, null=True)
+
+    # A comma-separated list of the PIL formats the thumb's files were also
+    # encoded in, besides the format of the original
+    formats = models.CharField(max_length=255, blank=True, default='')
+
+    # The quality the thumb was encoded at, for JPEGs
+    quality = models.PositiveSmallIntegerField(blank=True, null=True)
+
+    # Re-cropping a thumb creates a row for its next generation, which
+    # belongs to no image until it is committed; committing it deletes the
+    # generation it replaces (see Image.delete_replaced_thumbs)
+    generation = models.PositiveIntegerField(default=1)
+
     date_modified = models.DateTimeField(auto_now=True)
 
     image = models.ForeignKey('Image', related_name='+', null=True, blank=True,
         on_delete=models.CASCADE)
 
+    # The image an uncommitted crop was rendered from, whose folder its tmp
+    # files are in, so that they can be deleted with it
+    pending_image = models.ForeignKey('Image', related_name='+', null=True, blank=True,
+        on_delete=models.CASCADE)
+
+    objects = ThumbManager()
+
     class Meta:
         app_label = cropduster_settings.CROPDUSTER_APP_LABEL
         db_table = '%s_thumb' % cropduster_settings.CROPDUSTER_DB_PREFIX
+        indexes = [
+            # For looking up the thumb of a size, e.g. image.thumbs.get(name=...)
+            models.Index(fields=['image', 'name'], name='cropduster_thumb_image_name'),
+        ]
 
     def __str__(self):
         return self.name
@@ -79,24 +227,56 @@ class Thumb(models.Model):
     def path(self):
         return self.image_file.path if self.image_file else ''
 
+    @property
+    def retina_name(self):
+        """The size name of the thumb's 2x file, or None if it has none"""
+        if not self.retina_width or not self.retina_height:
+            return None
+        return '%s@2x' % self.name
+
+    @property
+    def alternate_formats(self):
+        return [f for f in self.formats.split(',') if f]
+
+    def get_image_paths(self, tmp=False, image=None):
+        """
+        Returns the paths of all of the thumb's files: the 1x file and any 2x
+        file, in the original's format and in each of its alternate formats.
+
+        ``image`` defaults to the thumb's image, and must be passed for thumbs
+        which don't belong to one yet.
+        """
+        image = image or self.image
+        return [
+            image.get_image_path(name, tmp=tmp, format=format)
+            for name in filter(None, [self.name, self.retina_name])
+            for format in [None] + self.alternate_formats]
+
+    @property
+    def retina_url(self):
+        if not self.retina_name:
+            return ''
+        image_file = Image.get_file_for_size(
+            image=self.image, size_name=self.retina_name,
+            tmp=not(getattr(self.image, 'pk', None)))
+        return image_file.url if image_file else ''
+
     @property
     def image_name(self):
         return self.image_file.name if self.image_file else ''
 
-    def save(self, *args, **kwargs):
-        if self.pk and self.image_id:
+    def promote_tmp_files(self):
+        for tmp_image_path, image_path in zip(self.get_image_paths(tmp=True), self.get_image_paths()):
             try:
-                # save new file without tmp suffix
-                tmp_image_path = self.image.get_image_path(self.name, tmp=True)
-                image_path = self.image.get_image_path(self.name)
-                with default_storage.open(tmp_image_path) as tmp_file:
-                    with default_storage.open(image_path, 'wb') as f:
-                        f.write(tmp_file.read())
-                # delete tmp file
-                default_storage.delete(tmp_image_path)
+                # move the new file to the name without the tmp suffix
+                move_file(tmp_image_path, image_path)
             except (IOError, OSError):
                 pass
-        return super(Thumb, self).save(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        if self.pk and self.image_id:
+            self.promote_tmp_files()
+        super(Thumb, self).save(*args, **kwargs)
 
     def to_dict(self):
         """Returns a dict of the thumb's values which are JSON serializable."""
@@ -175,6 +355,13 @@ class Thumb(models.Model):
         self.width = width
         self.height = height
 
+        # Retina sizes also get a 2x file, unless it would be upscaled
+        if size.retina and new_w >= 2 * width and new_h >= 2 * height:
+            self.retina_width = 2 * width
+            self.retina_height = 2 * height
+        else:
+            self.retina_width = self.retina_height = None
+
         return crop
 
 
@@ -185,6 +372,11 @@ def generate_filename(instance, filename):
     return filename
 
 
+# The attributes of an Image that determine the value of its owner's
+# CropDusterImageField
+SYNCED_FIELDS = ('content_type_id', 'object_id', 'field_identifier', 'image')
+
+
 class Image(models.Model):
 
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
@@ -212,6 +404,14 @@ class Image(models.Model):
     caption = models.TextField(blank=True, null=True)
     alt_text = models.TextField("Alt Text", blank=True, default="")
 
+    # A JSON object mapping size names to the url, width, height and
+    # cache_buster of their crops, kept when CROPDUSTER_CROP_MANIFEST is True
+    manifest = models.TextField(blank=True, default='', editable=False)
+
+    # The md5 digest of the original image. Set at upload, or computed from
+    # storage the first time it is needed (see get_md5())
+    md5 = models.CharField(max_length=32, blank=True, default='', editable=False)
+
     class Meta:
         app_label = cropduster_settings.CROPDUSTER_APP_LABEL
         db_table = '%s_image' % cropduster_settings.CROPDUSTER_DB_PREFIX
@@ -241,13 +441,19 @@ class Image(models.Model):
         return os.path.splitext(self.image.name)[1]
 
     @staticmethod
-    def get_file_for_size(image, size_name='original', tmp=False):
+    def get_file_for_size(image, size_name='original', tmp=False, format=None):
+        """
+        Returns the file of the size ``size_name`` of ``image``, or of its
+        alternate encoding in the PIL format ``format``.
+        """
         if isinstance(image, str):
             image = VirtualFieldFile(image)
         if not image:
             return None
         path, basename = os.path.split(image.name)
         filename, extension = os.path.splitext(basename)
+        if format:
+            extension = get_format_extension(format)
         if size_name == 'preview':
             size_name = '_preview'
         if tmp:
@@ -263,22 +469,16 @@ class Image(models.Model):
             f.open()
             pil_img = PIL.Image.open(BytesIO(f.read()))
             pil_img.filename = f.name
-        orig_w, orig_h = pil_img.size
 
         preview_w = preview_w or cropduster_settings.CROPDUSTER_PREVIEW_WIDTH
         preview_h = preview_h or cropduster_settings.CROPDUSTER_PREVIEW_HEIGHT
+        (w, h) = get_preview_size(pil_img.size, preview_w, preview_h)
 
-        resize_ratio = min(preview_w / orig_w, preview_h / orig_h)
+        # Only decode JPEGs at the smallest scale needed for the preview
+        draft_image(pil_img, w, h)
 
         def fit_preview(im):
-            if resize_ratio < 1:
-                w = int(round(orig_w * resize_ratio))
-                h = int(round(orig_h * resize_ratio))
-                preview_img = im.resize((w, h), PIL.Image.LANCZOS)
-            else:
-                w, h = orig_w, orig_h
-                preview_img = im
-            return preview_img
+            return smart_resize(im, w, h, resample=PIL.Image.LANCZOS)
 
         preview_file = cls.get_file_for_size(image_file, '_preview')
         process_image(pil_img, preview_file.name, fit_preview)
@@ -307,18 +507,34 @@ class Image(models.Model):
             return ''
         return os.path.basename(self.get_image_path(size_name))
 
-    def get_image_path(self, size_name='original', tmp=False):
+    def get_image_path(self, size_name='original', tmp=False, format=None):
         size_name = size_name or 'original'
-        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp)
+        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp, format=format)
         if not converted:
             return ''
         else:
             return converted.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Image, cls).from_db(db, field_names, values)
+        if 'image' in instance.__dict__ and 'md5' in instance.__dict__:
+            instance._loaded_original = (instance.image.name, instance.md5)
+        if all(f in instance.__dict__ for f in SYNCED_FIELDS):
+            instance._synced_field = instance._get_synced_field()
+        return instance
+
+    def _get_synced_field(self):
+        return (self.content_type_id, self.object_id, self.field_identifier, self.name or '')
+
     def save(self, **kwargs):
         self.date_modified = datetime.now()
         if self.field_identifier is None:
             self.field_identifier = ""
+        loaded_name, loaded_md5 = getattr(self, '_loaded_original', (None, None))
+        if loaded_name and self.image.name != loaded_name and self.md5 == loaded_md5:
+            # The original was replaced without a new digest being set
+            self.md5 = ''
         if not self.pk and self.content_type and self.object_id:
             try:
                 original = Image.objects.get(content_type=self.content_type,
@@ -335,24 +551,21 @@ class Image(models.Model):
         super(Image, self).save(**kwargs)
 
         # If the Image has changed, we need to make sure the related field on the
-        # model class has also been updated
-        model_class = self.content_type.model_class()
-
-        fields_with_models = [
-            (f, f.model if f.model != model_class else None)
-            for f in model_class._meta.get_fields()
-            if not f.is_relation
-            or f.one_to_one
-            or (f.many_to_one and f.related_model)]
-
-        for field, field_model_class in fields_with_models:
-            field_model_class = field_model_class or model_class
-            if (isinstance(field, CropDusterImageField) and
-                    field.generic_field.field_identifier == self.field_identifier):
-                field_model_class.objects.filter(pk=self.object_id).update(**{field.attname: self.name or ''})
-
-    def get_image_url(self, size_name='original', tmp=False):
-        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp)
+        # model class has also been updated. When its path and owner are the
+        # same as when it was loaded, the field already has its path.
+        synced_field = self._get_synced_field()
+        if synced_field == getattr(self, '_synced_field', None):
+            return
+        model_class = None
+        if self.content_type_id:
+            model_class = ContentType.objects.get_for_id(self.content_type_id).model_class()
+        if model_class is not None:
+            for field_model_class, attname in get_image_fields(model_class, self.field_identifier):
+                field_model_class.objects.filter(pk=self.object_id).update(**{attname: self.name or ''})
+        self._synced_field = synced_field
+
+    def get_image_url(self, size_name='original', tmp=False, format=None):
+        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp, format=format)
         return getattr(converted, 'url', None) or ''
 
     def get_image_size(self, size_name=None):
@@ -370,19 +583,26 @@ class Image(models.Model):
                 return (thumb.width, thumb.height)
 
         # Get the original size
-        if not self.image or not default_storage.exists(self.image.name):
+        if not self.image or not file_exists(self.image.name):
             return (0, 0)
         elif self.width and self.height:
             return (self.width, self.height)
         else:
-            try:
+            probed = probe_image(self.image.name, storage=self._meta.get_field("image").storage)
+            if probed:
+                width, height = probed[1:]
+            else:
+                # Fall back to PIL for formats probe_image() doesn't know, and
+                # headers it couldn't read
                 with self.image_file_open() as f:
-                    img = PIL.Image.open(BytesIO(f.read()))
-                    img.filename = f.name
-            except (IOError, ValueError, TypeError):
+                    width, height = get_image_dimensions(f)
+            if not width or not height:
                 return (0, 0)
-            else:
-                return img.size
+            self.width, self.height = width, height
+            if self.pk:
+                # Store the dimensions so the file needn't be probed again
+                Image.objects.filter(pk=self.pk).update(width=self.width, height=self.height)
+            return (self.width, self.height)
 
     def delete(self, *args, **kwargs):
         obj = self.content_object
@@ -408,37 +628,99 @@ class Image(models.Model):
             setattr(obj, cropduster_field.name, None)
             obj.save()
 
+    def get_thumbs_by_name(self, sizes):
+        """
+        Returns a dict of the image's existing thumbs for ``sizes`` and their
+        auto-sizes, by name, looked up in a single query.
+        """
+        if not self.pk:
+            return {}
+        names = [sz.name for sz in Size.flatten(sizes)]
+        return dict((t.name, t) for t in self.thumbs.filter(name__in=names))
+
+    def delete_replaced_thumbs(self, thumbs):
+        """
+        Deletes the image's thumbs which are earlier generations of ``thumbs``,
+        i.e. the thumbs of the same name that re-crops being committed replace.
+        Returns the number of thumbs deleted.
+        """
+        if not self.pk:
+            return 0
+        replaced = models.Q()
+        for thumb in thumbs:
+            if thumb.generation > 1:
+                replaced |= models.Q(name=thumb.name, generation__lt=thumb.generation)
+        if not replaced:
+            return 0
+        replaced_thumbs = Thumb.objects.filter(replaced, image=self).exclude(
+            pk__in=[thumb.pk for thumb in thumbs if thumb.pk])
+        return replaced_thumbs.delete()[1].get(Thumb._meta.label, 0)
+
     def save_size(self, size, thumb=None, image=None, tmp=False, standalone=False,
-                  permissive=False, skip_existing=False, commit=True):
+                  permissive=False, skip_existing=False, commit=True, render=True,
+                  batch=None, existing_thumbs=None):
+        """
+        Crop and resize ``size`` and its auto-sizes from the original image.
+
+        The crop box of every size is computed first, then the thumbnails are
+        rendered together (see cropduster.render.RenderBatch). If a ``batch`` is
+        passed, the thumbnails are added to it instead, and are not created
+        until the caller runs it.
+
+        With ``render=False``, the original is not opened unless ``image`` is
+        passed or the image's dimensions are unknown.
+
+        ``existing_thumbs`` is a dict of the image's thumbs by name, as
+        returned by get_thumbs_by_name(); if it isn't passed, the thumbs are
+        looked up when they are needed. With ``commit=False``, callers should
+        save the returned thumbs (see ThumbManager.bulk_save()) after the
+        batch has run, so that they are saved with the quality they were
+        encoded at.
+        """
         thumbs = {}
         if not image and not self.image:
             raise Exception("Cannot save sizes without an image")
 
-        if not image:
-            with self.image_file_open() as f:
-                image = PIL.Image.open(BytesIO(f.read()))
-                image.filename = f.name
+        if not image and (render or standalone or not (self.width and self.height)):
+            image = self.open_image()
 
         if standalone:
             if not StandaloneImage:
                 raise ImproperlyConfigured("standalone mode used, but not installed.")
             return self._save_standalone_thumb(size, image, thumb, commit=commit)
 
-        for sz in Size.flatten([size]):
-            if self.pk and skip_existing and default_storage.exists(self.get_image_path(sz.name)):
-                try:
-                    existing_thumb = self.thumbs.get(name=sz.name)
-                except Thumb.DoesNotExist:
-                    pass
-                else:
-                    thumbs[sz.name] = existing_thumb
+        run_batch = batch is None
+        if run_batch:
+            batch = RenderBatch(image)
+        create_thumbs = render and cropduster_settings.CROPDUSTER_CREATE_THUMBS
+        xmp_metadata = None
+        if create_thumbs and StandaloneImage:
+            # The digest is embedded in the metadata of every thumb; look it up,
+            # and whether XMP is supported, now rather than in each of the
+            # batch's threads
+            self.get_md5()
+            xmp_metadata = get_xmp_metadata()
+        new_thumbs = []
+
+        flattened_sizes = list(Size.flatten([size]))
+        if existing_thumbs is None:
+            if thumb and not skip_existing and len(flattened_sizes) == 1:
+                existing_thumbs = {}
+            else:
+                existing_thumbs = self.get_thumbs_by_name([size])
+
+        for sz in flattened_sizes:
+            if self.pk and skip_existing and file_exists(self.get_image_path(sz.name)):
+                if sz.name in existing_thumbs:
+                    thumbs[sz.name] = existing_thumbs[sz.name]
                     continue
+            sz_thumb = existing_thumbs.get(sz.name) or Thumb(name=sz.name)
             try:
                 if thumb and sz.is_auto:
-                    new_thumb = self._save_thumb(
-                        sz, image, ref_thumb=thumb, tmp=tmp, commit=commit)
+                    new_thumb, thumb_crop = self._get_thumb_crop(sz, image, sz_thumb, ref_thumb=thumb)
                 else:
-                    thumb = new_thumb = self._save_thumb(sz, image, thumb, tmp=tmp, commit=commit)
+                    new_thumb, thumb_crop = self._get_thumb_crop(sz, image, thumb or sz_thumb)
+                    thumb = new_thumb
             except CropDusterResizeException:
                 if permissive or not sz.required:
                     if not sz.is_auto:
@@ -447,8 +729,22 @@ class Image(models.Model):
                 else:
                     raise
 
-            if new_thumb:
-                thumbs[sz.name] = new_thumb
+            if tmp and self.pk and not new_thumb.image_id:
+                new_thumb.pending_image = self
+            if create_thumbs:
+                batch.add(self._render_thumb, new_thumb, thumb_crop, sz, image, tmp=tmp,
+                          xmp_metadata=xmp_metadata)
+                if commit and not run_batch:
+                    # The thumb is saved before the caller renders it
+                    batch.add_callback(self._store_thumb_quality, new_thumb)
+            new_thumbs.append(new_thumb)
+            thumbs[sz.name] = new_thumb
+
+        if run_batch:
+            batch.run()
+
+        if commit:
+            Thumb.objects.bulk_save(new_thumbs)
         return thumbs
 
     def _save_standalone_thumb(self, size, image=None, thumb=None, commit=True):
@@ -469,17 +765,30 @@ class Image(models.Model):
             w = int(round(h * aspect_ratio))
 
         thumb_crop = thumb.crop(image, size, w=w, h=h)
-        thumb_image = thumb_crop.create_image(thumb_path, width=thumb.width, height=thumb.height)
-        thumb_image.crop.add_xmp_to_crop(thumb_path, size, original_image=image)
-        md5 = hashlib.md5()
-        with default_storage.open(thumb_path, mode='rb') as f:
-            image_contents = f.read()
-        md5.update(image_contents)
-        thumb.name = md5.hexdigest()[0:9]
+        xmp = None
+        if image.format in XMP_PACKET_FORMATS:
+            xmp = thumb_crop.get_xmp_packet(size, original_image=image, md5=self.get_md5())
+        if image.format in XMP_PACKET_FORMATS and (
+                xmp is None or can_write_xmp_packet(image.format, xmp)):
+            # Embed the metadata in memory, so that the crop is only written
+            # to storage once it has its final, md5-derived name
+            thumb_image = thumb_crop.create_image(
+                thumb_path, width=thumb.width, height=thumb.height, xmp=xmp, commit=False)
+            image_contents = thumb_image.content
+        else:
+            # exempi can only add metadata to other formats, and packets too
+            # large to embed, in a file
+            thumb_crop.create_image(thumb_path, width=thumb.width, height=thumb.height)
+            thumb_crop.add_xmp_to_crop(
+                thumb_path, size, original_image=image, md5=self.get_md5())
+            with default_storage.open(thumb_path, mode='rb') as f:
+                image_contents = f.read()
+            delete_file(thumb_path)
+        thumb.name = md5_digest(image_contents)[0:9]
         new_path = self.get_image_path(thumb.name)
         with default_storage.open(new_path, 'wb') as f:
             f.write(image_contents)
-        default_storage.delete(thumb_path)
+        record_write(new_path, size=len(image_contents))
 
         if not thumb.pk:
             try:
@@ -491,6 +800,8 @@ class Image(models.Model):
 
         if commit:
             thumb.save()
+            if cropduster_settings.CROPDUSTER_CROP_MANIFEST:
+                self.refresh_manifest()
 
         return thumb
 
@@ -498,11 +809,107 @@ class Image(models.Model):
         storage = self._meta.get_field("image").storage
         return storage.open(self.image.name, "rb")
 
-    def _save_thumb(self, size, image=None, thumb=None, ref_thumb=None, tmp=False, commit=True):
-        if not image:
+    def build_manifest(self, thumbs=None):
+        """
+        Returns a dict mapping 'original' and the name of each of ``thumbs``
+        (by default, all of the image's thumbs) to the url, width, height and
+        cache_buster of its file.
+        """
+        if thumbs is None:
+            thumbs = self.thumbs.all() if self.pk else []
+        manifest = {}
+        for name, obj in [('original', self)] + [(t.name, t) for t in thumbs]:
+            image_file = Image.get_file_for_size(self.image, name)
+            manifest[name] = {
+                'url': getattr(image_file, 'url', None),
+                'width': obj.width,
+                'height': obj.height,
+                'cache_buster': get_cache_buster(obj.date_modified or datetime.now()),
+            }
+            retina_name = getattr(obj, 'retina_name', None)
+            if retina_name:
+                retina_file = Image.get_file_for_size(self.image, retina_name)
+                manifest[name]['retina'] = {
+                    'url': getattr(retina_file, 'url', None),
+                    'width': obj.retina_width,
+                    'height': obj.retina_height,
+                }
+            formats = getattr(obj, 'alternate_formats', None)
+            if formats:
+                manifest[name]['sources'] = self.get_sources(name, formats, retina_name)
+        return manifest
+
+    def get_sources(self, size_name, formats, retina_name=None):
+        """
+        Returns a list of dicts with the format, mime type, url and retina_url
+        (None if there is no 2x file) of the alternate encodings of a size,
+        in the order of ``formats``.
+        """
+        sources = []
+        for format in formats:
+            retina_url = None
+            if retina_name:
+                retina_url = self.get_image_url(retina_name, format=format) or None
+            sources.append({
+                'format': format,
+                'type': PIL.Image.MIME.get(format, 'image/%s' % format.lower()),
+                'url': self.get_image_url(size_name, format=format),
+                'retina_url': retina_url,
+            })
+        return sources
+
+    def get_manifest(self):
+        """
+        Returns the manifest of the image's crops (see build_manifest()), or
+        None if it has not been stored.
+        """
+        if not self.manifest:
+            return None
+        return json.loads(self.manifest)
+
+    def refresh_manifest(self):
+        self.manifest = json.dumps(self.build_manifest())
+        if self.pk:
+            Image.objects.filter(pk=self.pk).update(manifest=self.manifest)
+
+    def get_md5(self):
+        """
+        Return the md5 digest of the original image, hashing it from storage
+        (and storing the result) only if it wasn't recorded at upload.
+        """
+        if not self.md5 and self.image:
             with self.image_file_open() as f:
-                image = PIL.Image.open(BytesIO(f.read()))
-                image.filename = f.name
+                self._store_md5(md5_digest(f))
+        return self.md5
+
+    def _store_md5(self, md5):
+        self.md5 = md5
+        if self.pk:
+            Image.objects.filter(pk=self.pk).update(md5=md5)
+        self._loaded_original = (self.image.name, md5)
+
+    def open_image(self):
+        """
+        Open the original image as a PIL image. Pillow decodes the pixel data
+        the first time it is accessed and keeps it in memory, so passing the
+        returned image to save_size() lets every size (and auto-size) be
+        cropped and resized from a single decode of the original.
+        """
+        with self.image_file_open() as f:
+            contents = f.read()
+            image = PIL.Image.open(BytesIO(contents))
+            image.filename = f.name
+        if not self.md5:
+            # The original is in memory anyway, so record its digest now
+            # rather than reading it again in get_md5()
+            self._store_md5(md5_digest(contents))
+        return image
+
+    def _get_thumb_crop(self, size, image, thumb=None, ref_thumb=None):
+        """
+        Returns a tuple of the thumb for ``size`` and its Crop, having updated
+        the thumb's width and height to fit the crop box.
+        """
         if not thumb and self.pk:
             try:
                 thumb = self.thumbs.get(name=size.name)
@@ -515,19 +922,164 @@ class Image(models.Model):
 
         if size.is_auto:
             thumb.reference_thumb = ref_thumb or thumb.reference_thumb
+            if ref_thumb and not thumb.pk:
+                thumb.generation = ref_thumb.generation
 
+        if image is None:
+            # Only the geometry is needed, which the dimensions stored on the
+            # image are enough for. The formats are set when it is rendered.
+            return thumb, thumb.crop(self, size)
         thumb_crop = thumb.crop(image, size)
+        thumb.formats = ','.join(get_alternate_formats(size.formats, image))
+        return thumb, thumb_crop
+
+    def _render_thumb(self, thumb, thumb_crop, size, image, tmp=False, xmp_metadata=None):
+        """
+        ``xmp_metadata`` is the result of get_xmp_metadata(), resolved by the
+        caller since this may run in a RenderBatch thread.
+        """
         thumb_path = self.get_image_path(size.name, tmp=tmp)
+        retina_path = None
+        if thumb.retina_name:
+            retina_path = self.get_image_path(thumb.retina_name, tmp=tmp)
+        embed_xmp = xmp_metadata and image.format in XMP_PACKET_FORMATS
+        xmp = None
+        if embed_xmp:
+            xmp = thumb_crop.get_xmp_packet(
+                size, original_image=image, md5=self.get_md5(), metadata=xmp_metadata)
+            if xmp and not can_write_xmp_packet(image.format, xmp):
+                # Too large to embed, so exempi writes it to the file instead
+                embed_xmp, xmp = False, None
+        thumb_image = thumb_crop.create_image(
+            thumb_path, width=thumb.width, height=thumb.height, xmp=xmp,
+            retina_filename=retina_path, alternate_formats=thumb.alternate_formats)
+
+        if xmp_metadata and not embed_xmp:
+            for path in filter(None, [thumb_path, retina_path]):
+                thumb_image.crop.add_xmp_to_crop(
+                    path, size, original_image=image, md5=self.get_md5(),
+                    metadata=xmp_metadata)
+
+        quality = getattr(thumb_image, 'quality', None)
+        if quality != thumb.quality:
+            thumb.quality = quality
+            thumb._quality_changed = True
+        return thumb_image
+
+    def _store_thumb_quality(self, thumb):
+        # Thumbs rendered by a RenderBatch may already have been saved, and
+        # are rendered in other threads, so the quality is stored afterwards
+        if thumb.pk and getattr(thumb, '_quality_changed', False):
+            Thumb.objects.filter(pk=thumb.pk).update(quality=thumb.quality)
+        thumb._quality_changed = False
+
+    def _save_thumb(self, size, image=None, thumb=None, ref_thumb=None, tmp=False, commit=True,
+                    render=True):
+        if not image:
+            image = self.open_image()
 
-        if cropduster_settings.CROPDUSTER_CREATE_THUMBS:
-            thumb_image = thumb_crop.create_image(thumb_path, width=thumb.width, height=thumb.height)
+        thumb, thumb_crop = self._get_thumb_crop(size, image, thumb, ref_thumb=ref_thumb)
 
-        if StandaloneImage and cropduster_settings.CROPDUSTER_CREATE_THUMBS:
-            thumb_image.crop.add_xmp_to_crop(thumb_path, size, original_image=image)
+        if render and cropduster_settings.CROPDUSTER_CREATE_THUMBS:
+            xmp_metadata = get_xmp_metadata() if StandaloneImage else None
+            self._render_thumb(thumb, thumb_crop, size, image, tmp=tmp,
+                               xmp_metadata=xmp_metadata)
 
         if commit:
             thumb.save()
+            if thumb.image_id and cropduster_settings.CROPDUSTER_CROP_MANIFEST:
+                thumb.image.refresh_manifest()
         return thumb
 
 
+class RenderJobManager(models.Manager):
+
+    def claim(self, limit=100):
+        """
+        Mark up to ``limit`` pending jobs as running and return them. Where the
+        database supports it, rows locked by another worker are skipped so
+        that several workers can drain the queue at once.
+        """
+        with transaction.atomic(using=self.db):
+            qset = self.filter(status=RenderJob.PENDING).order_by('pk')
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                qset = qset.select_for_update(skip_locked=True)
+            pks = list(qset[:limit].values_list('pk', flat=True))
+            self.filter(pk__in=pks).update(
+                status=RenderJob.RUNNING, attempts=models.F('attempts') + 1,
+                date_claimed=timezone.now())
+            # Reload the jobs, so that saving them doesn't undo the update
+            return list(self.filter(pk__in=pks).order_by('pk'))
+
+    def requeue_stale(self, timeout):
+        """
+        Mark the jobs that have been running for longer than ``timeout`` (a
+        timedelta) as pending again, e.g. because the worker that claimed them
+        died mid-render. Returns the number of jobs re-queued.
+        """
+        cutoff = timezone.now() - timeout
+        return self.filter(status=RenderJob.RUNNING, date_claimed__lt=cutoff).update(
+            status=RenderJob.PENDING, date_claimed=None)
+
+
+class RenderJob(models.Model):
+    """
+    A request to create the thumbnail files for an Image's sizes, queued by
+    cropduster.jobs.DatabaseBackend and processed by the
+    ``cropduster_render_jobs`` management command.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+    )
+
+    objects = RenderJobManager()
+
+    image = models.ForeignKey('Image', related_name='+', on_delete=models.CASCADE)
+    sizes = models.TextField()
+    permissive = models.BooleanField(default=False)
+    skip_existing = models.BooleanField(default=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING,
+        db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    # When the job was last claimed by a worker, so that jobs left running by
+    # a worker that died can be re-queued
+    date_claimed = models.DateTimeField(blank=True, null=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = cropduster_settings.CROPDUSTER_APP_LABEL
+        db_table = '%s_renderjob' % cropduster_settings.CROPDUSTER_DB_PREFIX
+
+    def __str__(self):
+        return 'Render job %s for image %s (%s)' % (self.pk, self.image_id, self.status)
+
+    def run(self):
+        """
+        Create the job's thumbnails. Completed jobs are deleted; failed jobs
+        are kept, with their traceback, so that they can be inspected and retried.
+        """
+        from cropduster.jobs import render_thumbs
+
+        try:
+            render_thumbs(self.image_id, self.sizes,
+                permissive=self.permissive, skip_existing=self.skip_existing)
+        except Exception:
+            self.status = RenderJob.FAILED
+            self.error = traceback.format_exc()
+            self.save(update_fields=['status', 'error', 'date_modified'])
+            return False
+        else:
+            self.delete()
+            return True
+
+
 from cropduster.standalone.models import StandaloneImage
@@ -0,0 +1,77 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cropduster import settings as cropduster_settings
+
+
+__all__ = ('RenderBatch',)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=cropduster_settings.CROPDUSTER_RENDER_WORKERS,
+                thread_name_prefix='cropduster-render')
+    return _executor
+
+
+class RenderBatch(object):
+    """
+    Collects the thumbnails to be cropped and resized from one original image,
+    so that they can be created together once all of their crop boxes are known.
+
+    When the CROPDUSTER_RENDER_WORKERS setting is greater than 1, the thumbnails
+    are rendered concurrently by a shared thread pool. Pillow releases the GIL
+    while resizing and encoding, so sibling sizes render in roughly the time
+    of the slowest one.
+    """
+
+    def __init__(self, image, workers=None):
+        self.image = image
+        if workers is None:
+            workers = cropduster_settings.CROPDUSTER_RENDER_WORKERS
+        self.workers = workers
+        self.jobs = []
+        self.callbacks = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, func, *args, **kwargs):
+        """Add a callable which renders a thumbnail from ``self.image``."""
+        self.jobs.append((func, args, kwargs))
+
+    def add_callback(self, func, *args, **kwargs):
+        """
+        Add a callable to be called in the calling thread once all of the
+        thumbnails are rendered, e.g. to save something learned while
+        rendering them to the database.
+        """
+        self.callbacks.append((func, args, kwargs))
+
+    def run(self):
+        """Render all of the queued thumbnails and return their results, in order."""
+        jobs, self.jobs = self.jobs, []
+        callbacks, self.callbacks = self.callbacks, []
+        if self.workers > 1 and len(jobs) > 1:
+            # Decode the original before it is shared between threads; a
+            # PIL image's lazy load() is not safe to call concurrently
+            self.image.load()
+            # Each job runs in a copy of the calling thread's context, so that
+            # it shares e.g. the request's storage cache
+            futures = [
+                get_executor().submit(contextvars.copy_context().run, f, *args, **kwargs)
+                for f, args, kwargs in jobs]
+            results = [future.result() for future in futures]
+        else:
+            results = [f(*args, **kwargs) for f, args, kwargs in jobs]
+        for f, args, kwargs in callbacks:
+            f(*args, **kwargs)
+        return results
@@ -1,25 +1,53 @@
 from __future__ import division
 
-import os
 import re
 import math
-import hashlib
-import tempfile
+import threading
 
 import PIL.Image
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import default_storage
 
 from .settings import CROPDUSTER_RETAIN_METADATA
 
 
-__all__ = ('Size', 'Box', 'Crop')
+__all__ = ('Size', 'Box', 'Crop', 'best_fit_batch')
 
 
 INFINITY = float('inf')
 
 
+_xmp_metadata = None
+_xmp_metadata_resolved = False
+_xmp_metadata_lock = threading.Lock()
+
+
+def get_xmp_metadata():
+    """
+    Returns the cropduster.standalone.metadata module, or None if
+    python-xmp-toolkit or the exempi library is not installed.
+
+    The module is imported once, under a lock, so that threads rendering
+    thumbnails never import it concurrently and see it half-initialized.
+    """
+    global _xmp_metadata, _xmp_metadata_resolved
+    with _xmp_metadata_lock:
+        if not _xmp_metadata_resolved:
+            try:
+                from cropduster.standalone import metadata
+            except ImproperlyConfigured:
+                metadata = None
+            _xmp_metadata = metadata if (metadata and metadata.libxmp) else None
+            _xmp_metadata_resolved = True
+    return _xmp_metadata
+
+
 class SizeAlias(object):
     is_alias = True
 
@@ -48,7 +76,7 @@ class Size(object):
     parent = None
 
     def __init__(self, name, label=None, w=None, h=None, retina=False, auto=None, min_w=None, min_h=None,
-            max_w=None, max_h=None, required=True):
+            max_w=None, max_h=None, required=True, formats=None):
 
         self.min_w = max(w or 1, min_w or 1) or 1
         self.min_h = max(h or 1, min_h or 1) or 1
@@ -69,6 +97,9 @@ class Size(object):
         self.name = name
         self.auto = auto
         self.retina = retina
+        # PIL format names (e.g. 'WEBP', 'AVIF') that the size's thumbnails
+        # are also encoded in, next to the file in the original's format
+        self.formats = list(formats or [])
         self.width = w
         self.height = h
         self.label = label or ' '.join(filter(None, re.split(r'[_\-]', name))).title()
@@ -144,6 +175,16 @@ class Size(object):
             crop_box = crop.get_crop_box()
             crop = Crop(crop_box, original_image)
 
+        return crop.best_fit(**self.get_best_fit_kwargs())
+
+    def fit_to_boxes(self, boxes, bounds):
+        """
+        The batch equivalent of fit_to_crop(). See best_fit_batch() for the
+        arguments and return value.
+        """
+        return best_fit_batch(boxes, bounds, **self.get_best_fit_kwargs())
+
+    def get_best_fit_kwargs(self):
         best_fit_kwargs = {
             'min_w': self.min_w or self.width,
             'min_h': self.min_h or self.height,
@@ -154,7 +195,7 @@ class Size(object):
         }
         if self.width and self.height:
             best_fit_kwargs.update({'w': self.width, 'h': self.height})
-        return crop.best_fit(**best_fit_kwargs)
+        return best_fit_kwargs
 
     def __serialize__(self):
         data = {
@@ -168,6 +209,7 @@ class Size(object):
             'retina': 1 if self.retina else 0,
             'label': self.label,
             'required': self.required,
+            'formats': self.formats,
             '__type__': 'Size',
         }
         if self.auto:
@@ -220,15 +262,46 @@ class Box(object):
 
 
 class Crop(object):
+    """
+    A crop ``box`` of an original ``image``, which is either a PIL image or
+    the name of a file in default_storage. The geometry methods only need the
+    dimensions of the original, so a file is not opened until its pixels are
+    needed by create_image(). ``size`` is the (width, height) of the
+    original; it is required when ``image`` is omitted, and avoids probing
+    the header of a file.
+    """
+
+    def __init__(self, box, image=None, size=None):
+        self.box = box
+        self._image = image
+        if size is None:
+            if isinstance(image, str):
+                from cropduster.utils import probe_image
+
+                probed = probe_image(image)
+                size = probed[1:] if probed else self.image.size
+            elif hasattr(image, 'size'):
+                size = image.size
+            elif image is not None:
+                size = (image.width, image.height)
+            else:
+                raise TypeError("Crop() requires the image or its size")
+        self.bounds = Box(0, 0, *size)
 
-    def __init__(self, box, image):
-        if isinstance(image, str):
-            self._fh = default_storage.open(image, mode='rb')
+    @property
+    def image(self):
+        if isinstance(self._image, str):
+            self._fh = default_storage.open(self._image, mode='rb')
             image = PIL.Image.open(self._fh)
+            image.filename = self._image
+            self._image = image
+        return self._image
 
-        self.box = box
-        self.image = image
-        self.bounds = Box(0, 0, *image.size)
+    @property
+    def image_filename(self):
+        if isinstance(self._image, str):
+            return self._image
+        return getattr(self._image, 'filename', None)
 
     def close(self):
         if hasattr(self, '_fh') and not self._fh.closed:
@@ -237,28 +310,56 @@ class Crop(object):
     def __del__(self):
         self.close()
 
-    def create_image(self, output_filename, width, height):
-        from cropduster.utils import process_image, get_image_extension
-
-        temp_file = tempfile.NamedTemporaryFile(suffix=get_image_extension(self.image), delete=False)
-        temp_filename = temp_file.name
-        with default_storage.open(self.image.filename, mode='rb') as f:
-            temp_file.write(f.read())
-        temp_file.seek(0)
-        image = PIL.Image.open(temp_filename)
-        image.filename = self.image.filename
+    def create_image(self, output_filename, width, height, xmp=None, commit=True,
+                     retina_filename=None, alternate_formats=None):
+        """
+        Crops and resizes the image, and saves it as ``output_filename``
+        (unless ``commit`` is False), with ``xmp`` as its XMP packet if given.
+        The resized image is also encoded in each of ``alternate_formats``
+        (see process_image()).
+
+        If ``retina_filename`` is given, a crop of twice the width and height
+        is saved as that file too, and is available as the ``retina``
+        attribute of the returned image. The 1x crop is then downscaled from
+        the 2x one rather than resampled again from the original.
+        """
+        from cropduster.utils import process_image, smart_resize, is_animated_gif
 
         crop_args = self.box.as_tuple()
 
-        def crop_and_resize_callback(im):
-            from cropduster.utils import smart_resize
+        def crop_and_resize_callback(im, final_w=width, final_h=height):
             im = im.crop(crop_args)
-            return smart_resize(im, final_w=width, final_h=height)
-
-        new_image = process_image(image, output_filename, crop_and_resize_callback)
+            return smart_resize(im, final_w=final_w, final_h=final_h)
+
+        callback = crop_and_resize_callback
+        retina_image = None
+        if retina_filename and is_animated_gif(self.image):
+            # gifsicle resizes every frame itself; there are no decoded pixels
+            # to share between the two files
+            retina_image = self.create_image(retina_filename, 2 * width, 2 * height,
+                xmp=xmp, commit=commit, alternate_formats=alternate_formats)
+        elif retina_filename:
+            retina_pixels = []
+
+            def retina_callback(im):
+                im = crop_and_resize_callback(im, 2 * width, 2 * height)
+                retina_pixels.append(im)
+                return im
+
+            def downscale_retina_callback(im):
+                return smart_resize(retina_pixels[0], final_w=width, final_h=height)
+
+            retina_image = process_image(self.image, retina_filename, retina_callback,
+                xmp=xmp, commit=commit, alternate_formats=alternate_formats)
+            retina_image.crop = self
+            callback = downscale_retina_callback
+
+        # Crop from the already-opened original rather than re-reading it from
+        # storage, so that all sizes rendered from one image share its pixels
+        new_image = process_image(self.image, output_filename, callback,
+            xmp=xmp, commit=commit, alternate_formats=alternate_formats)
         new_image.crop = self
-        temp_file.close()
-        os.unlink(temp_filename)
+        new_image.retina = retina_image
         return new_image
 
     def best_fit(self, w=None, h=None, min_w=None, min_h=None, max_w=None, max_h=None, min_aspect=None, max_aspect=None):
@@ -356,39 +457,68 @@ class Crop(object):
             elif y1 > self.bounds.y1:
                 y1 -= 1
 
-        return Crop(Box(x1, y1, x2, y2), self.image)
+        return Crop(Box(x1, y1, x2, y2), self._image, size=self.bounds.size)
+
+    def get_xmp_packet(self, size, original_image=None, md5=None, metadata=False):
+        """
+        Returns the XMP packet to embed in a crop of ``size``, or None if
+        python-xmp-toolkit is not installed. The metadata of
+        ``original_image`` is taken from what Pillow parsed out of its header
+        when it was opened, so the original is not read again.
+
+        ``metadata`` is the result of get_xmp_metadata(), which threads
+        rendering thumbnails are passed rather than importing it themselves.
+        """
+        if metadata is False:
+            metadata = get_xmp_metadata()
+        if not metadata:
+            return None
 
-    def add_xmp_to_crop(self, cropped_image_path, size, original_image=None):
-        try:
-            from cropduster.standalone.metadata import (libxmp,
-                get_xmp_from_storage, put_xmp_to_storage)
-        except ImproperlyConfigured:
-            libxmp = None
+        from cropduster.utils.xmp import XMP_PACKET_FORMATS, get_image_xmp_packet
 
-        if not libxmp or not cropped_image_path:
+        original_metadata = None
+        if original_image and CROPDUSTER_RETAIN_METADATA:
+            if original_image.format in XMP_PACKET_FORMATS:
+                packet = get_image_xmp_packet(original_image)
+                if packet:
+                    original_metadata = metadata.xmp_from_packet(packet)
+            else:
+                original_metadata = metadata.get_xmp_from_storage(original_image.filename)
+
+        xmp_meta = self.generate_xmp(size, original_metadata=original_metadata, md5=md5)
+        return metadata.xmp_to_packet(xmp_meta)
+
+    def add_xmp_to_crop(self, cropped_image_path, size, original_image=None, md5=None,
+                        metadata=False):
+        if metadata is False:
+            metadata = get_xmp_metadata()
+        if not metadata or not cropped_image_path:
             return
 
         if original_image and CROPDUSTER_RETAIN_METADATA:
-            original_metadata = get_xmp_from_storage(original_image.filename)
+            original_metadata = metadata.get_xmp_from_storage(original_image.filename)
         else:
             original_metadata = None
 
-        xmp_meta = self.generate_xmp(size, original_metadata=original_metadata)
+        xmp_meta = self.generate_xmp(size, original_metadata=original_metadata, md5=md5)
 
-        put_xmp_to_storage(xmp_meta, cropped_image_path)
+        metadata.put_xmp_to_storage(xmp_meta, cropped_image_path)
 
-    def generate_xmp(self, size, original_metadata=None):
+    def generate_xmp(self, size, original_metadata=None, md5=None):
+        """
+        ``md5`` is the digest of the original image, if it is known; otherwise
+        the original is read from storage and hashed.
+        """
         from cropduster.standalone.metadata import libxmp
-        from cropduster.utils import json
+        from cropduster.utils import json, md5_digest
 
         NS_MWG_RS = "http://www.metadataworkinggroup.com/schemas/regions/"
         NS_XMPMM = "http://ns.adobe.com/xap/1.0/mm/"
         NS_CROP = "http://ns.thealtantic.com/cropduster/1.0/"
 
-        md5 = hashlib.md5()
-        with default_storage.open(self.image.filename, mode='rb') as f:
-            md5.update(f.read())
-        digest = md5.hexdigest()
+        if not md5:
+            with default_storage.open(self.image_filename, mode='rb') as f:
+                md5 = md5_digest(f)
 
         md = original_metadata or libxmp.XMPMeta()
         md.register_namespace(NS_XMPMM, 'xmpMM')
@@ -399,10 +529,10 @@ class Crop(object):
         md.set_property(NS_CROP, 'crop:size/stDim:w', '%s' % (size.width or ''))
         md.set_property(NS_CROP, 'crop:size/stDim:h', '%s' % (size.height or ''))
         md.set_property(NS_CROP, 'crop:size/crop:json', json.dumps(size))
-        md.set_property(NS_CROP, 'crop:md5', digest.upper())
+        md.set_property(NS_CROP, 'crop:md5', md5.upper())
         md.set_property(NS_MWG_RS, 'mwg-rs:Regions/mwg-rs:AppliedToDimensions', '', prop_value_is_struct=True)
-        md.set_property(NS_MWG_RS, 'mwg-rs:Regions/mwg-rs:AppliedToDimensions/stDim:w', str(self.image.size[0]))
-        md.set_property(NS_MWG_RS, 'mwg-rs:Regions/mwg-rs:AppliedToDimensions/stDim:h', str(self.image.size[1]))
+        md.set_property(NS_MWG_RS, 'mwg-rs:Regions/mwg-rs:AppliedToDimensions/stDim:w', str(self.bounds.w))
+        md.set_property(NS_MWG_RS, 'mwg-rs:Regions/mwg-rs:AppliedToDimensions/stDim:h', str(self.bounds.h))
         # Clear out any existing <mwg-rs:RegionList> tags so they don't conflict
         # (for instance, iPhone face regions are stored in this tag)
         if md.does_property_exist(NS_MWG_RS, 'mwg-rs:Regions/mwg-rs:RegionList'):
@@ -416,3 +546,123 @@ class Crop(object):
         md.set_property(NS_MWG_RS, 'mwg-rs:Regions/mwg-rs:RegionList[1]/mwg-rs:Area/stArea:x', "%.5f" % (self.box.x1 / self.bounds.w))
         md.set_property(NS_MWG_RS, 'mwg-rs:Regions/mwg-rs:RegionList[1]/mwg-rs:Area/stArea:y', "%.5f" % (self.box.y1 / self.bounds.h))
         return md
+
+
+def best_fit_batch(boxes, bounds, w=None, h=None, min_w=None, min_h=None,
+                   max_w=None, max_h=None, min_aspect=None, max_aspect=None):
+    """
+    Computes Crop.best_fit() for many crops at once, with numpy.
+
+    ``boxes`` is an (N, 4) array of (x1, y1, x2, y2) crop boxes and ``bounds``
+    an (N, 2) array of the (width, height) of their originals, or a single
+    (width, height) shared by all of them. Each constraint is either a scalar
+    or an array of N values, where None, NaN and 0 mean unset. Returns an
+    (N, 4) integer array of the fitted boxes, which are identical to what
+    best_fit() returns for each row.
+
+    As in best_fit(), ``max_w`` and ``max_h`` are accepted but not used.
+    The only difference is that best_fit() raises a TypeError when it needs
+    to compare against a ``min_w`` or ``min_h`` of None, which is treated as
+    0 here.
+    """
+    if np is None:
+        raise ImproperlyConfigured("best_fit_batch() requires numpy")
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    n = len(boxes)
+    bounds_w, bounds_h = np.broadcast_to(
+        np.asarray(bounds, dtype=np.float64), (n, 2)).T
+
+    def constraint(value):
+        if value is None:
+            return np.zeros(n)
+        value = np.broadcast_to(np.asarray(value, dtype=np.float64), (n,))
+        return np.where(np.isnan(value), 0.0, value)
+
+    w, h, min_w, min_h = map(constraint, (w, h, min_w, min_h))
+    min_aspect, max_aspect = map(constraint, (min_aspect, max_aspect))
+
+    # Each step below mirrors the corresponding one of best_fit(), using the
+    # same float operations in the same order so that the results round
+    # identically.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        box_x1, box_y1, box_x2, box_y2 = boxes.T
+        box_w = box_x2 - box_x1
+        box_h = box_y2 - box_y1
+        box_aspect_ratio = np.where(box_h != 0, box_w / box_h, 1.0)
+
+        aspect_ratio = np.where((w != 0) & (h != 0), w / h, box_aspect_ratio)
+        aspect_ratio = np.where(
+            (min_aspect != 0) & (aspect_ratio < min_aspect), min_aspect,
+            np.where((max_aspect != 0) & (aspect_ratio > max_aspect),
+                max_aspect, aspect_ratio))
+
+        scale = np.sqrt(aspect_ratio / box_aspect_ratio)
+        w_fit = box_w * scale
+        h_fit = w_fit / aspect_ratio
+
+        scale_min_w = (min_w != 0) & (min_w > w_fit)
+        scale_min_h = (min_h != 0) & (min_h > h_fit)
+        min_scale = np.maximum(
+            np.where(scale_min_w, min_w / w_fit, -np.inf),
+            np.where(scale_min_h, min_h / h_fit, -np.inf))
+        scale_min = scale_min_w | scale_min_h
+        w_fit = np.where(scale_min, w_fit * min_scale, w_fit)
+        h_fit = np.where(scale_min, h_fit * min_scale, h_fit)
+
+        x1 = (box_x1 + box_x2) / 2 - (w_fit / 2)
+        y1 = (box_y1 + box_y2) / 2 - (h_fit / 2)
+        x2 = x1 + w_fit
+        y2 = y1 + h_fit
+        initial_w = x2 - x1
+        initial_h = y2 - y1
+
+        def fit_to_bounds(v1, v2, initial, bound):
+            before = v1 < 0
+            v2 = np.where(before, v2 + (-1 * v1), v2)
+            v1 = np.where(before, 0.0, v1)
+            after = v2 > bound
+            v1 = np.where(after, np.maximum(bound - initial, 0), v1)
+            v2 = np.where(after, bound, v2)
+            scale = np.where(after, (v2 - v1) / initial, 1.0)
+            return v1, v2, scale
+
+        x1, x2, scale_x = fit_to_bounds(x1, x2, initial_w, bounds_w)
+        y1, y2, scale_y = fit_to_bounds(y1, y2, initial_h, bounds_h)
+
+        def shrink(v1, v2, initial, min_size, scale):
+            size = (v2 - v1) * scale
+            size = np.where(size < min_size, min_size, size)
+            v1 = v1 + ((initial - size) / 2)
+            return v1, v1 + size, size
+
+        shrink_w = scale_y < scale_x
+        shrink_h = ~shrink_w & (scale_x <= scale_y)
+        new_x1, new_x2, new_w = shrink(x1, x2, initial_w, min_w, scale_y / scale_x)
+        new_y1, new_y2, new_h = shrink(y1, y2, initial_h, min_h, scale_x / scale_y)
+        x1 = np.where(shrink_w, new_x1, x1)
+        x2 = np.where(shrink_w, new_x2, x2)
+        w_fit = np.where(shrink_w, new_w, w_fit)
+        y1 = np.where(shrink_h, new_y1, y1)
+        y2 = np.where(shrink_h, new_y2, y2)
+        h_fit = np.where(shrink_h, new_h, h_fit)
+
+    # np.rint rounds half to even, as round() does
+    w_fit = np.rint(w_fit)
+    h_fit = np.rint(h_fit)
+    x1 = np.maximum(np.rint(x1), 0)
+    y1 = np.maximum(np.rint(y1), 0)
+    x2 = np.minimum(np.minimum(np.rint(x2), bounds_w), x1 + w_fit)
+    y2 = np.minimum(np.minimum(np.rint(y2), bounds_h), y1 + h_fit)
+
+    # Fix off-by-one rounding errors
+    def fix_off_by_one(v1, v2, size, bound):
+        off_by_one = (v2 - v1 == size - 1)
+        grow = off_by_one & (v2 < bound)
+        move = off_by_one & ~grow & (v1 > 0)
+        return np.where(move, v1 - 1, v1), np.where(grow, v2 + 1, v2)
+
+    x1, x2 = fix_off_by_one(x1, x2, w_fit, bounds_w)
+    y1, y2 = fix_off_by_one(y1, y2, h_fit, bounds_h)
+
+    return np.stack([x1, y1, x2, y2], axis=1).astype(np.int64)
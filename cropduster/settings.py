@@ -43,13 +43,48 @@ def get_jpeg_quality(width, height):
             "CROPDUSTER_JPEG_QUALITY setting must be either a callable "
             "or a numeric value, got type %s" % (type(CROPDUSTER_JPEG_QUALITY).__name__))
 
+# When set, the quality of each JPEG thumbnail is searched for by encoding it
+# in memory, instead of using CROPDUSTER_JPEG_QUALITY. A dict of keyword
+# arguments for cropduster.utils.quality.search_quality() (max_bytes, which may
+# also be a callable of the width and height, min_psnr, min_quality,
+# max_quality and max_time).
+CROPDUSTER_JPEG_QUALITY_SEARCH = getattr(settings, 'CROPDUSTER_JPEG_QUALITY_SEARCH', None)
+
 JPEG_SAVE_ICC_SUPPORTED = getattr(settings, 'JPEG_SAVE_ICC_SUPPORTED', True)
 
+# Passed as the ``reducing_gap`` argument to PIL's Image.resize(), which first
+# shrinks images by an integer factor with Image.reduce() when downscaling by
+# more than this ratio. None disables the optimization.
+CROPDUSTER_REDUCING_GAP = getattr(settings, 'CROPDUSTER_REDUCING_GAP', 3.0)
+
 CROPDUSTER_GIFSICLE_PATH = getattr(settings, 'CROPDUSTER_GIFSICLE_PATH', None)
 
 if CROPDUSTER_GIFSICLE_PATH is None:
     # Try to find executable in the PATH
     CROPDUSTER_GIFSICLE_PATH = shutil.which("gifsicle")
 
+# The number of threads used to render the sizes of an image concurrently.
+# 1 (the default) renders them one after the other in the calling thread.
+CROPDUSTER_RENDER_WORKERS = getattr(settings, 'CROPDUSTER_RENDER_WORKERS', 1)
+
 CROPDUSTER_RETAIN_METADATA = getattr(settings, 'CROPDUSTER_RETAIN_METADATA', False)
 CROPDUSTER_CREATE_THUMBS = getattr(settings, 'CROPDUSTER_CREATE_THUMBS', True)
+
+# When True, CropDusterImageFieldFile.generate_thumbs() saves crop geometry
+# immediately and leaves creating the thumbnail files to the backend below.
+CROPDUSTER_BACKGROUND_THUMBS = getattr(settings, 'CROPDUSTER_BACKGROUND_THUMBS', False)
+CROPDUSTER_THUMB_BACKEND = getattr(
+    settings, 'CROPDUSTER_THUMB_BACKEND', 'cropduster.jobs.ThreadPoolBackend')
+CROPDUSTER_THUMB_WORKERS = getattr(settings, 'CROPDUSTER_THUMB_WORKERS', 4)
+
+# The alias of a cache in CACHES that records whether files exist in storage
+# (and their size), shared between processes. Whether or not it is set, these
+# are also remembered for the duration of each request. cropduster updates
+# both when it writes or deletes files.
+CROPDUSTER_STORAGE_CACHE = getattr(settings, 'CROPDUSTER_STORAGE_CACHE', None)
+CROPDUSTER_STORAGE_CACHE_TIMEOUT = getattr(settings, 'CROPDUSTER_STORAGE_CACHE_TIMEOUT', 300)
+
+# When True, each Image keeps a JSON manifest of the url, dimensions and
+# cache-buster of its crops, which the get_crop template tag reads instead of
+# looking up thumbs.
+CROPDUSTER_CROP_MANIFEST = getattr(settings, 'CROPDUSTER_CROP_MANIFEST', False)
@@ -7,10 +7,11 @@ from io import open
 
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import default_storage
-from django.utils.encoding import force_bytes
+from django.utils.encoding import force_bytes, force_str
 
 from cropduster.files import ImageFile
-from cropduster.utils import json
+from cropduster.utils import json, record_write
+from cropduster.utils.xmp import read_xmp_packet, write_xmp_packet
 
 try:
     import libxmp
@@ -320,7 +321,23 @@ def get_xmp_from_file(file_path):
     return libxmp.XMPFiles(file_path=file_path).get_xmp()
 
 
+def xmp_from_packet(packet):
+    return libxmp.XMPMeta(xmp_str=force_str(packet))
+
+
+def xmp_to_packet(xmp_meta):
+    return force_bytes(xmp_meta.serialize_to_str())
+
+
 def get_xmp_from_bytes(img_bytes):
+    try:
+        packet = read_xmp_packet(img_bytes)
+    except ValueError:
+        pass
+    else:
+        return xmp_from_packet(packet) if packet else None
+
+    # Not a JPEG or PNG, so fall back to having exempi read it from a file
     tmp = tempfile.NamedTemporaryFile(delete=False)
     tmp.write(img_bytes)
     tmp.close()
@@ -348,16 +365,27 @@ def put_xmp_to_file(xmp_meta, file_path):
     xmp_file.close_file()
 
 
-def put_xmp_to_storage(xmp_meta, file_path, storage=default_storage):
+def put_xmp_to_bytes(xmp_meta, img_bytes):
+    try:
+        return write_xmp_packet(img_bytes, xmp_to_packet(xmp_meta))
+    except ValueError:
+        pass
+
+    # Not a JPEG or PNG, so fall back to having exempi update a file
     tmp = tempfile.NamedTemporaryFile(delete=False)
     try:
-        with default_storage.open(file_path, mode='rb') as f:
-            tmp.write(f.read())
+        tmp.write(img_bytes)
         tmp.close()
         put_xmp_to_file(xmp_meta, tmp.name)
         with open(tmp.name, mode='rb') as f:
-            data = f.read()
-        with storage.open(file_path, mode='wb') as f:
-            f.write(data)
+            return f.read()
     finally:
         os.unlink(tmp.name)
+
+
+def put_xmp_to_storage(xmp_meta, file_path, storage=default_storage):
+    with storage.open(file_path, mode='rb') as f:
+        data = put_xmp_to_bytes(xmp_meta, f.read())
+    with storage.open(file_path, mode='wb') as f:
+        f.write(data)
+    record_write(file_path, size=len(data), storage=storage)
@@ -1,5 +1,4 @@
 import os
-import hashlib
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.files.uploadedfile import SimpleUploadedFile
@@ -11,6 +10,7 @@ from cropduster import settings as cropduster_settings
 from cropduster.fields import CropDusterField
 from cropduster.files import VirtualFieldFile
 from cropduster.resizing import Size
+from cropduster.utils import md5_digest
 
 
 class StandaloneImageManager(models.Manager):
@@ -20,20 +20,19 @@ class StandaloneImageManager(models.Manager):
         from cropduster.views.forms import clean_upload_data
 
         image_file = VirtualFieldFile(file_path)
-        md5 = hashlib.md5()
         image_contents = image_file.read()
-        md5.update(image_contents)
+        md5 = md5_digest(image_contents)
         basepath, basename = os.path.split(file_path)
         basefile, extension = os.path.splitext(basename)
         if basefile == 'original':
             basepath, basename = os.path.split(basepath)
             basename += extension
-        standalone, created = self.get_or_create(md5=md5.hexdigest().lower())
+        standalone, created = self.get_or_create(md5=md5)
         if created or not standalone.image:
             file_data = clean_upload_data({
                 'image': SimpleUploadedFile(basename, image_contents),
                 'upload_to': upload_to,
-            })
+            }, md5=md5)
             file_path = get_relative_media_url(file_data['image'].name)
             standalone.image = file_path
             standalone.save()
@@ -44,6 +43,8 @@ class StandaloneImageManager(models.Manager):
             content_type=ContentType.objects.get_for_model(StandaloneImage),
             object_id=standalone.pk)
         standalone.image.related_object = cropduster_image
+        if cropduster_image.image.name != file_path:
+            cropduster_image.md5 = md5
         cropduster_image.image = file_path
         cropduster_image.save()
         cropduster_image.save_preview(preview_w, preview_h)
@@ -54,7 +55,9 @@ class StandaloneImage(models.Model):
 
     objects = StandaloneImageManager()
 
-    md5 = models.CharField(max_length=32, blank=True, default='')
+    # Unique, so that looking up the image of a file by its digest is an
+    # index lookup; images whose digest is unknown have none
+    md5 = models.CharField(max_length=32, blank=True, null=True, unique=True)
     image = CropDusterField(sizes=[Size("crop")], upload_to='')
 
     class Meta:
@@ -63,8 +66,6 @@ class StandaloneImage(models.Model):
 
     def save(self, **kwargs):
         if not self.md5 and self.image:
-            md5_hash = hashlib.md5()
-            with self.image.related_object.image_file_open() as f:
-                md5_hash.update(f.read())
-            self.md5 = md5_hash.hexdigest()
+            self.md5 = self.image.related_object.get_md5()
+        self.md5 = self.md5 or None
         super(StandaloneImage, self).save(**kwargs)
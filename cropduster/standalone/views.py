@@ -27,6 +27,8 @@ class CropDusterStandaloneIndex(CropDusterIndex):
             return None
         md5 = self.image_file.metadata.get('md5') or self.image_file.metadata.get('DerivedFrom')
         try:
+            if not md5:
+                raise StandaloneImage.DoesNotExist
             standalone = StandaloneImage.objects.get(md5=md5)
         except StandaloneImage.DoesNotExist:
             (preview_w, preview_h) = self.preview_size
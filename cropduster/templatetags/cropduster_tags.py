@@ -1,10 +1,11 @@
-import time
 import warnings
 
 import django
 from django import template
+from cropduster import settings as cropduster_settings
 from cropduster.models import Image
 from cropduster.resizing import Size
+from cropduster.utils import get_cache_buster
 
 
 register = template.Library()
@@ -16,7 +17,29 @@ else:
     tag_decorator = register.assignment_tag
 
 
-@tag_decorator
+def _get_thumbs(context, related_object):
+    """
+    Returns a dict of the thumbs of a cropduster Image, keyed on name. In
+    templates the dict is built once per request (or once per render, if there
+    is no request in the context), so calling get_crop for several crop names
+    of the same image costs at most one query. When the thumbs were
+    prefetched, e.g. with cropduster.utils.prefetch_crops(), it costs none.
+    """
+    if context is None:
+        return {thumb.name: thumb for thumb in related_object.thumbs.all()}
+    request = context.get('request')
+    if request is not None:
+        cache = request.__dict__.setdefault('_cropduster_thumbs', {})
+    else:
+        cache = context.render_context.setdefault('_cropduster_thumbs', {})
+    try:
+        return cache[related_object.pk]
+    except KeyError:
+        thumbs = {thumb.name: thumb for thumb in related_object.thumbs.all()}
+        cache[related_object.pk] = thumbs
+        return thumbs
+
+
 def get_crop(image, crop_name, **kwargs):
     """
     Get the crop of an image. Usage:
@@ -32,43 +55,111 @@ def get_crop(image, crop_name, **kwargs):
         "attribution": 'Stock Photoz',
         "attribution_link": 'http://stockphotoz.com',
         "caption": 'Woman laughing alone with salad.',
-        "alt_text": 'Woman laughing alone with salad.'
+        "alt_text": 'Woman laughing alone with salad.',
+        "retina_url": '/media/path/to/my@2x.jpg',
+        "srcset": '/media/path/to/my.jpg 1x, /media/path/to/my@2x.jpg 2x',
+        "sources": [{
+            "format": 'WEBP',
+            "type": 'image/webp',
+            "url": '/media/path/to/my.webp',
+            "srcset": '/media/path/to/my.webp 1x, /media/path/to/my@2x.webp 2x',
+        }]
     }
 
     For use in an image tag or style block like:
 
-        <img src="{{ img.url }}">
+        <img src="{{ img.url }}"{% if img.srcset %} srcset="{{ img.srcset }}"{% endif %}>
+
+    `retina_url` and `srcset` are None unless the crop's size has
+    retina=True and a 2x file was created for it. `sources` lists the
+    alternate encodings of the crop (see the `formats` argument of Size),
+    for the <source> elements of a <picture>.
 
     The `exact_size` kwarg is deprecated.
 
     Omitting the `attribution` kwarg will omit the attribution, attribution_link,
     and caption.
     """
+    return _get_crop(None, image, crop_name, **kwargs)
+
+
+@tag_decorator(takes_context=True, name='get_crop')
+def _get_crop_tag(context, image, crop_name, **kwargs):
+    # The template tag shares the thumbs it looks up across the request
+    return _get_crop(context, image, crop_name, **kwargs)
 
+
+def _get_crop(context, image, crop_name, **kwargs):
     if "exact_size" in kwargs:
         warnings.warn("get_crop's `exact_size` kwarg is deprecated.", DeprecationWarning)
 
     if not image or not image.related_object:
         return None
 
-    url = getattr(Image.get_file_for_size(image, crop_name), 'url', None)
+    related_object = image.related_object
+    manifest = None
+    if cropduster_settings.CROPDUSTER_CROP_MANIFEST:
+        manifest = related_object.get_manifest()
 
-    thumbs = {thumb.name: thumb for thumb in image.related_object.thumbs.all()}
-    try:
-        thumb = thumbs[crop_name]
-    except KeyError:
-        if crop_name == "original":
-            thumb = image.related_object
-        else:
+    if manifest is not None:
+        # Everything needed is in the row that has already been fetched
+        try:
+            crop = manifest[crop_name]
+        except KeyError:
             return None
+        url, width, height = crop['url'], crop['width'], crop['height']
+        cache_buster = crop['cache_buster']
+        retina_url = (crop.get('retina') or {}).get('url')
+        sources = crop.get('sources') or []
+    else:
+        url = getattr(Image.get_file_for_size(image, crop_name), 'url', None)
+
+        thumbs = _get_thumbs(context, related_object)
+        try:
+            thumb = thumbs[crop_name]
+        except KeyError:
+            if crop_name == "original":
+                thumb = related_object
+            else:
+                return None
+        width, height = thumb.width, thumb.height
+        cache_buster = get_cache_buster(thumb.date_modified)
+        retina_name = getattr(thumb, 'retina_name', None)
+        retina_url = None
+        if retina_name:
+            retina_url = getattr(Image.get_file_for_size(image, retina_name), 'url', None)
+        sources = []
+        if getattr(thumb, 'alternate_formats', None):
+            sources = related_object.get_sources(crop_name, thumb.alternate_formats, retina_name)
+
+    url = "%s?%s" % (url, cache_buster)
+    srcset = None
+    if retina_url:
+        retina_url = "%s?%s" % (retina_url, cache_buster)
+        srcset = "%s 1x, %s 2x" % (url, retina_url)
+
+    crop_sources = []
+    for source in sources:
+        source_url = "%s?%s" % (source['url'], cache_buster)
+        source_srcset = source_url
+        if source['retina_url']:
+            source_srcset = "%s 1x, %s?%s 2x" % (source_url, source['retina_url'], cache_buster)
+        crop_sources.append({
+            "format": source['format'],
+            "type": source['type'],
+            "url": source_url,
+            "srcset": source_srcset,
+        })
 
-    cache_buster = str(time.mktime(thumb.date_modified.timetuple()))[:-2]
     return {
-        "url": "%s?%s" % (url, cache_buster),
-        "width": thumb.width,
-        "height": thumb.height,
-        "attribution": image.related_object.attribution,
-        "attribution_link": image.related_object.attribution_link,
-        "caption": image.related_object.caption,
-        "alt_text": image.related_object.alt_text,
+        "url": url,
+        "width": width,
+        "height": height,
+        "attribution": related_object.attribution,
+        "attribution_link": related_object.attribution_link,
+        "caption": related_object.caption,
+        "alt_text": related_object.alt_text,
+        "retina_url": retina_url,
+        "srcset": srcset,
+        "sources": crop_sources,
     }
@@ -1,8 +1,16 @@
 from .image import (
     get_image_extension, is_transparent, exif_orientation,
     correct_colorspace, is_animated_gif, has_animated_gif_support, process_image,
-    smart_resize)
-from .paths import get_upload_foldername
+    ProcessedImage, smart_resize, draft_image, get_preview_size,
+    get_format_extension, get_alternate_formats)
+from .hashing import md5_digest
+from .paths import get_upload_foldername, release_upload_foldername
+from .probe import probe_image
+from .quality import search_quality
+from .storage import (
+    copy_file, move_file, file_exists, file_size, delete_file, record_write,
+    record_delete, storage_cache, clear_storage_cache)
 from .sizes import get_min_size
-from .thumbs import set_as_auto_crop, unset_as_auto_crop
+from .thumbs import (
+    set_as_auto_crop, unset_as_auto_crop, prefetch_crops, get_cache_buster)
 from . import jsonutils as json
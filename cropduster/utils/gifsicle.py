@@ -37,8 +37,8 @@ class GifsicleImage(object):
         self.crop_args = ['--crop', "%d,%d-%d,%d" % (x1, y1, x2, y2)]
         return self
 
-    def resize(self, size, method):
-        # Ignore method, PIL's algorithms don't match up
+    def resize(self, size, method, reducing_gap=None):
+        # Ignore method and reducing_gap, PIL's algorithms don't match up
         self.resize_args = [
             "--resize-fit", "%dx%d" % size,
             "--resize-method", "mix",
@@ -0,0 +1,26 @@
+import hashlib
+
+
+__all__ = ('md5_digest',)
+
+
+CHUNK_SIZE = 64 * 2 ** 10
+
+
+def md5_digest(f):
+    """
+    Returns the hex md5 digest of ``f``, which can be bytes or a file-like
+    object. Files are read in chunks, so that large images are never held in
+    memory in their entirety just to be hashed.
+    """
+    md5 = hashlib.md5()
+    if isinstance(f, bytes):
+        md5.update(f)
+    elif hasattr(f, 'chunks'):
+        # django.core.files.File, which rewinds the file itself
+        for chunk in f.chunks(chunk_size=CHUNK_SIZE):
+            md5.update(chunk)
+    else:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -11,15 +11,20 @@ from PIL import ImageFile, JpegImagePlugin
 from django.core.files.storage import default_storage
 
 from cropduster.settings import (
-    get_jpeg_quality, JPEG_SAVE_ICC_SUPPORTED, CROPDUSTER_GIFSICLE_PATH)
+    get_jpeg_quality, JPEG_SAVE_ICC_SUPPORTED, CROPDUSTER_GIFSICLE_PATH,
+    CROPDUSTER_REDUCING_GAP, CROPDUSTER_JPEG_QUALITY_SEARCH)
 
 from .gifsicle import GifsicleImage
+from .quality import search_quality
+from .storage import record_write
+from .xmp import write_xmp_packet
 
 
 __all__ = (
     'get_image_extension', 'is_transparent', 'exif_orientation',
     'correct_colorspace', 'is_animated_gif', 'has_animated_gif_support',
-    'process_image', 'smart_resize')
+    'process_image', 'ProcessedImage', 'smart_resize', 'draft_image',
+    'get_preview_size', 'get_format_extension', 'get_alternate_formats')
 
 
 # workaround for https://github.com/python-pillow/Pillow/issues/1138
@@ -38,19 +43,37 @@ IMAGE_EXTENSIONS = {
     "PNG":  ".png",   "PPM":  ".ppm",   "PSD":  ".psd",   "SGI":  ".rgb",   "SUN":  ".ras",
     "TGA":  ".tga",   "TIFF": ".tiff",  "WMF":  ".wmf",   "XBM":  ".xbm",   "XPM":  ".xpm",
     "MPO":  ".jpg",  # Pillow mislabels some jpeg images as MPO files
+    "WEBP": ".webp",  "AVIF": ".avif",
 }
 
 
 def get_image_extension(img):
-    if img.format in IMAGE_EXTENSIONS:
-        return IMAGE_EXTENSIONS[img.format]
+    return get_format_extension(img.format)
+
+
+def get_format_extension(format):
+    if format in IMAGE_EXTENSIONS:
+        return IMAGE_EXTENSIONS[format]
     else:
-        for ext, format in PIL.Image.EXTENSION.items():
-            if format == img.format:
+        for ext, ext_format in PIL.Image.EXTENSION.items():
+            if ext_format == format:
                 return ext
         # Our fallback is the PIL format name in lowercase,
         # which is probably the file extension
-        return ".%s" % img.format.lower()
+        return ".%s" % format.lower()
+
+
+def get_alternate_formats(formats, im):
+    """
+    Returns those of ``formats`` (PIL format names) that thumbnails of the PIL
+    image ``im`` can be encoded in besides its own format, given the encoders
+    this Pillow build has. Animated gifs are resized by gifsicle, which only
+    writes gifs, so they have none.
+    """
+    if not formats or is_animated_gif(im):
+        return []
+    PIL.Image.init()
+    return [f for f in formats if f != im.format and f in PIL.Image.SAVE]
 
 
 def is_transparent(image):
@@ -122,7 +145,8 @@ def has_animated_gif_support():
     return bool(CROPDUSTER_GIFSICLE_PATH)
 
 
-def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_params=None):
+def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_params=None,
+                  xmp=None, commit=True, alternate_formats=None):
     is_animated = is_animated_gif(im)
     images = [im]
 
@@ -141,31 +165,120 @@ def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_param
 
     if save_filename:
         save_params = save_params or {}
-        if im.format == 'JPEG':
-            save_params.setdefault('quality', get_jpeg_quality(new_images[0].size[0], new_images[0].size[1]))
+        img = new_images[0]
         if im.format in ('JPEG', 'PNG') and JPEG_SAVE_ICC_SUPPORTED:
             save_params.setdefault('icc_profile', im.info.get('icc_profile'))
-        img = new_images[0]
-        buf = BytesIO()
-        img.save(buf, format=im.format, **save_params)
-        with default_storage.open(save_filename, 'wb') as f:
-            f.write(buf.getvalue())
-        with default_storage.open(save_filename, mode='rb') as f:
-            content = f.read()
-            pil_image = PIL.Image.open(BytesIO(content))
-        pil_image.filename = save_filename
-        return pil_image
+        search = None
+        if (im.format == 'JPEG' and CROPDUSTER_JPEG_QUALITY_SEARCH and
+                'quality' not in save_params and not isinstance(img, GifsicleImage)):
+            # Search for the quality using the resized image that is about
+            # to be saved, and keep the encoding of the chosen one
+            search_kwargs = dict(CROPDUSTER_JPEG_QUALITY_SEARCH)
+            if callable(search_kwargs.get('max_bytes')):
+                search_kwargs['max_bytes'] = search_kwargs['max_bytes'](*img.size)
+            search = search_quality(img, save_params=save_params, **search_kwargs)
+            save_params['quality'] = search.quality
+            content = search.content
+        else:
+            if im.format == 'JPEG':
+                save_params.setdefault('quality', get_jpeg_quality(img.size[0], img.size[1]))
+            buf = BytesIO()
+            img.save(buf, format=im.format, **save_params)
+            content = buf.getvalue()
+        if xmp:
+            # Embed the metadata before the first (and only) write to storage
+            content = write_xmp_packet(content, xmp)
+        if commit:
+            with default_storage.open(save_filename, 'wb') as f:
+                f.write(content)
+            record_write(save_filename, size=len(content))
+        # gifsicle's --resize-fit may not produce exactly the requested size,
+        # so the size of animated gifs is read from the encoded bytes
+        size = None if isinstance(img, GifsicleImage) else img.size
+        processed = ProcessedImage(content, save_filename, size, im.format)
+        processed.quality = save_params.get('quality')
+        processed.quality_search = search
+        if alternate_formats and not isinstance(img, GifsicleImage):
+            # Encode the same resized pixels in each of the extra formats,
+            # saved next to the primary file with their own extension
+            base_filename = os.path.splitext(save_filename)[0]
+            for format in alternate_formats:
+                alt_filename = base_filename + get_format_extension(format)
+                alt_params = {}
+                if im.info.get('icc_profile') and JPEG_SAVE_ICC_SUPPORTED:
+                    alt_params['icc_profile'] = im.info['icc_profile']
+                buf = BytesIO()
+                img.save(buf, format=format, **alt_params)
+                alt_content = buf.getvalue()
+                if commit:
+                    with default_storage.open(alt_filename, 'wb') as f:
+                        f.write(alt_content)
+                    record_write(alt_filename, size=len(alt_content))
+                processed.alternates[format] = ProcessedImage(
+                    alt_content, alt_filename, img.size, format)
+        return processed
 
     return new_images[0]
 
 
-def smart_resize(im, final_w, final_h):
+class ProcessedImage(object):
+    """
+    The result of process_image() when the image is saved: the encoded bytes
+    that were written to ``filename``, along with their size and format. The
+    bytes are only decoded into a PIL image if an attribute that needs the
+    pixel data is accessed, which is then looked up on the decoded image.
+    This saves reading back from storage a file that was just written.
+    """
+
+    def __init__(self, content, filename, size=None, format=None):
+        self.content = content
+        self.filename = filename
+        self.format = format
+        self._size = size
+        self._image = None
+        # The same image encoded in other formats, keyed on format name
+        self.alternates = {}
+        # The JPEG quality it was encoded at, and the QualitySearch that
+        # picked it, if any
+        self.quality = None
+        self.quality_search = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = PIL.Image.open(BytesIO(self.content))
+            self._image.filename = self.filename
+        return self._image
+
+    @property
+    def size(self):
+        if self._size is None:
+            # Only parses the header; the pixel data is still not decoded
+            self._size = self.image.size
+        return self._size
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('content', '_image', '_size'):
+            raise AttributeError(name)
+        return getattr(self.image, name)
+
+
+def smart_resize(im, final_w, final_h, resample=PIL.Image.BICUBIC):
     """
     Resizes a given image in multiple steps to ensure maximum quality and performance
 
     :param im: PIL.Image instance the image to be resized
     :param final_w: int the intended final width of the image
     :param final_h: int the intended final height of the image
+    :param resample: the PIL resampling filter used for the final resize
     """
 
     (orig_w, orig_h) = im.size
@@ -173,4 +286,39 @@ def smart_resize(im, final_w, final_h):
         # If the image is already the right size, don't change it
         return im
 
-    return im.resize((final_w, final_h), PIL.Image.BICUBIC)
+    # With a reducing_gap, large downscales are first done by an integer
+    # factor with Image.reduce(), and only the remainder is resampled
+    return im.resize((final_w, final_h), resample, reducing_gap=CROPDUSTER_REDUCING_GAP)
+
+
+def draft_image(im, final_w, final_h):
+    """
+    Configures a JPEG that has not been loaded yet to be decoded in the DCT
+    domain at 1/2, 1/4 or 1/8 scale, picking the smallest scale that is still
+    at least ``final_w`` x ``final_h``. This makes producing a small image
+    from a large JPEG much faster and far less memory-intensive. It has no
+    effect on other formats or on images whose pixel data is already loaded.
+
+    Note that this changes ``im.size``, so it must not be used on an image
+    which will subsequently be cropped using full-resolution coordinates.
+
+    :param im: PIL.Image instance, as returned by PIL.Image.open()
+    :param final_w: int the intended final width of the image
+    :param final_h: int the intended final height of the image
+    """
+    if im.format == 'JPEG' and final_w and final_h:
+        im.draft(None, (final_w, final_h))
+    return im
+
+
+def get_preview_size(size, preview_w, preview_h):
+    """
+    Returns the (width, height) of an image with dimensions ``size`` scaled
+    down, preserving its aspect ratio, to fit within preview_w x preview_h.
+    """
+    (w, h) = size
+    resize_ratio = min(preview_w / w, preview_h / h)
+    if resize_ratio < 1:
+        w = int(round(w * resize_ratio))
+        h = int(round(h * resize_ratio))
+    return (w, h)
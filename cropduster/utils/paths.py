@@ -1,16 +1,55 @@
 import os
 import re
+import secrets
+from contextlib import contextmanager
 
-from django.core.files.storage import default_storage
-from django.conf import settings
+from django.core.files.storage import default_storage, FileSystemStorage
 from django.db.models.fields.files import FileField
 
 
 
-__all__ = ('get_upload_foldername')
+__all__ = ('get_upload_foldername', 'release_upload_foldername')
 
 
-def get_upload_foldername(file_name, upload_to='%Y/%m'):
+# The number of random hex digits appended to the folder name when the name
+# is taken, or when the storage cannot create a folder atomically
+SUFFIX_LENGTH = 8
+
+
+def _random_dir_name(basename):
+    return "%s-%s" % (basename, secrets.token_hex(SUFFIX_LENGTH // 2))
+
+
+@contextmanager
+def _directory_permissions(storage):
+    """
+    Creates folders with the storage's directory_permissions_mode (the
+    FILE_UPLOAD_DIRECTORY_PERMISSIONS setting), as FileSystemStorage does.
+    """
+    mode = storage.directory_permissions_mode
+    if mode is None:
+        yield 0o777
+        return
+    old_umask = os.umask(0o777 & ~mode)
+    try:
+        yield mode
+    finally:
+        os.umask(old_umask)
+
+
+def get_upload_foldername(file_name, upload_to='%Y/%m', storage=default_storage):
+    """
+    Returns a new folder, named after ``file_name``, for an upload's files.
+
+    On a FileSystemStorage the folder is created with mkdir, which fails if
+    another upload has already taken the name, in which case a random suffix
+    is added. Other storages have no folders to reserve, so the name always
+    gets a random suffix. Either way the parent folder is never listed.
+
+    Since the folder is created right away, it should only be requested once
+    the upload is ready to be saved, and passed to release_upload_foldername()
+    if saving it fails.
+    """
     # Generate date based path to put uploaded file.
     file_field = FileField(upload_to=upload_to)
     if not file_name:
@@ -20,18 +59,31 @@ def get_upload_foldername(file_name, upload_to='%Y/%m'):
 
     root_dir = os.path.splitext(filename)[0]
     parent_dir, _, basename = root_dir.rpartition('/')
-    image_dir = ''
-    i = 1
-    dir_name = basename
-    while not image_dir:
-        try:
-            sub_dirs, _ = default_storage.listdir(parent_dir)
-            while dir_name in sub_dirs:
-                dir_name = "%s-%d" % (basename, i)
-                i += 1
-        except OSError:
-            os.makedirs(os.path.join(settings.MEDIA_ROOT, parent_dir))
-        else:
+
+    if not isinstance(storage, FileSystemStorage):
+        return os.path.join(parent_dir, _random_dir_name(basename))
+
+    with _directory_permissions(storage) as mode:
+        os.makedirs(storage.path(parent_dir), mode, exist_ok=True)
+        dir_name = basename
+        while True:
             image_dir = os.path.join(parent_dir, dir_name)
+            try:
+                os.mkdir(storage.path(image_dir), mode)
+            except FileExistsError:
+                dir_name = _random_dir_name(basename)
+            else:
+                return image_dir
+
 
-    return image_dir
+def release_upload_foldername(folder_path, storage=default_storage):
+    """
+    Removes a folder returned by get_upload_foldername() if nothing was saved
+    in it, e.g. because saving the upload failed.
+    """
+    if not isinstance(storage, FileSystemStorage):
+        return
+    try:
+        os.rmdir(storage.path(folder_path))
+    except OSError:
+        pass
@@ -0,0 +1,145 @@
+"""
+Reads the format and dimensions of an image from the first few kilobytes of
+its file, without decoding it or reading it in full.
+"""
+import struct
+
+from django.core.files.storage import default_storage
+
+from .storage import _s3_key
+
+
+__all__ = ('probe_image', 'probe_image_bytes')
+
+
+# The number of bytes read at first. Most headers fit in this; a JPEG with
+# large Exif, ICC profile or XMP segments before its SOF marker needs more.
+PROBE_SIZE = 16 * 2 ** 10
+MAX_PROBE_SIZE = 4 * 2 ** 20
+
+
+class NeedMoreData(Exception):
+    pass
+
+
+def _unpack(fmt, data, offset=0):
+    size = struct.calcsize(fmt)
+    if len(data) < offset + size:
+        raise NeedMoreData
+    return struct.unpack_from(fmt, data, offset)
+
+
+def _probe_jpeg(data):
+    pos = 2
+    while True:
+        marker, = _unpack('>H', data, pos)
+        if marker == 0xFFFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker >> 8 != 0xFF:
+            return None
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xFFC0 <= marker <= 0xFFCF and marker not in (0xFFC4, 0xFFC8, 0xFFCC):
+            h, w = _unpack('>HH', data, pos + 5)
+            return ('JPEG', w, h)
+        if marker in (0xFFD9, 0xFFDA):
+            return None
+        seg_len, = _unpack('>H', data, pos + 2)
+        pos += 2 + seg_len
+
+
+def _probe_png(data):
+    w, h = _unpack('>II', data, 16)
+    return ('PNG', w, h)
+
+
+def _probe_gif(data):
+    w, h = _unpack('<HH', data, 6)
+    return ('GIF', w, h)
+
+
+def _probe_webp(data):
+    chunk, = _unpack('4s', data, 12)
+    if chunk == b'VP8 ':
+        w, h = _unpack('<HH', data, 26)
+        return ('WEBP', w & 0x3FFF, h & 0x3FFF)
+    elif chunk == b'VP8L':
+        b0, b1, b2, b3 = _unpack('4B', data, 21)
+        w = 1 + (((b1 & 0x3F) << 8) | b0)
+        h = 1 + (((b3 & 0xF) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6))
+        return ('WEBP', w, h)
+    elif chunk == b'VP8X':
+        w0, w1, w2, h0, h1, h2 = _unpack('6B', data, 24)
+        return ('WEBP', 1 + (w0 | w1 << 8 | w2 << 16), 1 + (h0 | h1 << 8 | h2 << 16))
+    return None
+
+
+def _probe_tiff(data):
+    endian = '<' if data[:2] == b'II' else '>'
+    ifd_offset, = _unpack(endian + 'I', data, 4)
+    num_entries, = _unpack(endian + 'H', data, ifd_offset)
+    dims = {}
+    for i in range(num_entries):
+        entry = ifd_offset + 2 + i * 12
+        tag, field_type = _unpack(endian + 'HH', data, entry)
+        if tag in (256, 257):
+            # ImageWidth / ImageLength, which are either SHORT or LONG
+            fmt = 'H' if field_type == 3 else 'I'
+            dims[tag], = _unpack(endian + fmt, data, entry + 8)
+            if len(dims) == 2:
+                return ('TIFF', dims[256], dims[257])
+    return None
+
+
+def probe_image_bytes(data):
+    """
+    Returns a (format, width, height) tuple for the image whose file starts
+    with ``data``, using PIL's format names. Returns None if the format is not
+    recognized, and raises NeedMoreData if more of the file is needed.
+    """
+    if data[:2] == b'\xff\xd8':
+        return _probe_jpeg(data)
+    elif data[:8] == b'\x89PNG\r\n\x1a\n':
+        return _probe_png(data)
+    elif data[:6] in (b'GIF87a', b'GIF89a'):
+        return _probe_gif(data)
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _probe_webp(data)
+    elif data[:4] in (b'II*\x00', b'MM\x00*'):
+        return _probe_tiff(data)
+    elif len(data) < 12:
+        raise NeedMoreData
+    return None
+
+
+def _read_head(name, storage, size):
+    key = _s3_key(storage, name)
+    if key is not None:
+        # django-storages' S3 backends download the whole object the first
+        # time its file is read, so ask for a byte range instead
+        response = storage.bucket.Object(key).get(Range='bytes=0-%d' % (size - 1))
+        return response['Body'].read()
+    with storage.open(name, 'rb') as f:
+        return f.read(size)
+
+
+def probe_image(name, storage=default_storage):
+    """
+    Returns a (format, width, height) tuple for the image ``name`` in
+    ``storage``, reading as little of the file as its header allows, or None
+    if the format is not recognized or the file cannot be read.
+    """
+    size = PROBE_SIZE
+    try:
+        while True:
+            data = _read_head(name, storage, size)
+            try:
+                return probe_image_bytes(data)
+            except NeedMoreData:
+                if len(data) < size or size >= MAX_PROBE_SIZE:
+                    return None
+                size *= 4
+    except (IOError, OSError):
+        # Missing files, and errors reading them
+        return None
@@ -0,0 +1,121 @@
+"""
+Searches for the JPEG quality of a thumbnail, by encoding it in memory at the
+qualities picked by bisection, instead of using a fixed quality for its size.
+"""
+from __future__ import division
+
+from io import BytesIO
+import logging
+import math
+import time
+
+import PIL.Image
+from PIL import ImageChops, ImageStat
+
+
+__all__ = ('QualitySearch', 'search_quality', 'get_psnr')
+
+
+logger = logging.getLogger(__name__)
+
+
+class QualitySearch(object):
+    """
+    The result of search_quality(): the chosen ``quality`` and the bytes it
+    encodes to, along with the number of encodes the search took and the
+    time it spent, in seconds.
+    """
+
+    def __init__(self, quality, content, encodes, elapsed):
+        self.quality = quality
+        self.content = content
+        self.encodes = encodes
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return '<QualitySearch quality=%d size=%d encodes=%d elapsed=%.3fs>' % (
+            self.quality, len(self.content), self.encodes, self.elapsed)
+
+
+def get_psnr(im, other):
+    """
+    Returns the peak signal-to-noise ratio, in dB, of the PIL image ``other``
+    compared to ``im``. Higher is more similar; identical images return inf.
+    """
+    if other.mode != im.mode:
+        other = other.convert(im.mode)
+    diff = ImageChops.difference(im, other)
+    mse = sum(rms ** 2 for rms in ImageStat.Stat(diff).rms) / len(diff.getbands())
+    if not mse:
+        return float('inf')
+    return 20 * math.log10(255 / math.sqrt(mse))
+
+
+def search_quality(im, format='JPEG', max_bytes=None, min_psnr=None, min_quality=40,
+                   max_quality=95, max_time=None, save_params=None):
+    """
+    Bisects the quality that ``im``, an already resized PIL image, is encoded
+    at in ``format``:
+
+    - with ``max_bytes``, the highest quality whose encoding is at most that
+      many bytes (or ``min_quality`` if none is);
+    - with ``min_psnr``, the lowest quality whose decoded encoding has at
+      least that PSNR against ``im`` (see get_psnr()), below any quality
+      imposed by ``max_bytes``.
+
+    If ``max_time`` (in seconds) runs out, the search stops and returns the
+    best quality found so far that meets the constraints.
+    """
+    save_params = dict(save_params or {})
+    save_params.pop('quality', None)
+    start = time.time()
+    encodes = {}
+
+    def encode(quality):
+        if quality not in encodes:
+            buf = BytesIO()
+            im.save(buf, format=format, quality=quality, **save_params)
+            encodes[quality] = buf.getvalue()
+        return encodes[quality]
+
+    def out_of_time():
+        return max_time is not None and time.time() - start > max_time
+
+    def bisect(lo, hi, ok, want_highest):
+        # Returns the highest (or lowest) quality in [lo, hi] for which ok()
+        # is True, assuming ok() is monotonic in quality, or None if there
+        # is none
+        found = None
+        while lo <= hi and not out_of_time():
+            mid = (lo + hi) // 2
+            if ok(mid):
+                found = mid
+                if want_highest:
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+            elif want_highest:
+                hi = mid - 1
+            else:
+                lo = mid + 1
+        return found
+
+    quality = max_quality
+    if max_bytes:
+        quality = bisect(min_quality, max_quality,
+            lambda q: len(encode(q)) <= max_bytes, want_highest=True)
+        if quality is None:
+            quality = min_quality
+    if min_psnr:
+        def similar_enough(q):
+            return get_psnr(im, PIL.Image.open(BytesIO(encode(q)))) >= min_psnr
+
+        lowest = bisect(min_quality, quality, similar_enough, want_highest=False)
+        if lowest is not None:
+            quality = lowest
+
+    content = encode(quality)
+    result = QualitySearch(quality, content, len(encodes), time.time() - start)
+    logger.debug("Chose %s quality %d for a %dx%d image (%d bytes) after %d encodes in %.3fs",
+        format, quality, im.size[0], im.size[1], len(content), result.encodes, result.elapsed)
+    return result
@@ -0,0 +1,241 @@
+"""
+Copies and moves files within a storage using the cheapest operation it
+supports, rather than reading each file into the process and writing it back,
+and caches whether files exist (and their size) so that repeated checks don't
+each cost a request to a remote storage.
+"""
+import contextvars
+import hashlib
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.signals import request_finished, request_started
+
+from cropduster import settings as cropduster_settings
+
+
+__all__ = (
+    'copy_file', 'move_file', 'file_exists', 'file_size', 'delete_file',
+    'record_write', 'record_delete', 'storage_cache', 'clear_storage_cache')
+
+
+# The entries cached for the duration of the current request, or None
+# outside of requests (e.g. in management commands), where only the
+# CROPDUSTER_STORAGE_CACHE backend, if any, is used. Each request gets its own
+# dict, which RenderBatch shares with its render workers by running them in a
+# copy of the request's context.
+_request_cache = contextvars.ContextVar('cropduster_storage_cache', default=None)
+_request_cache_lock = threading.Lock()
+
+
+@contextmanager
+def storage_cache():
+    """
+    Caches whether files exist, and their size, in memory until the block
+    exits, as is done for the duration of each request.
+    """
+    token = _request_cache.set({})
+    try:
+        yield
+    finally:
+        _request_cache.reset(token)
+
+
+def _request_started(**kwargs):
+    _request_cache.set({})
+
+
+def _request_finished(**kwargs):
+    _request_cache.set(None)
+
+
+request_started.connect(_request_started, dispatch_uid='cropduster_storage_cache_started')
+request_finished.connect(_request_finished, dispatch_uid='cropduster_storage_cache_finished')
+
+
+def clear_storage_cache():
+    """Empties the current request's cache. Entries in the shared cache are kept."""
+    request_cache = _request_cache.get()
+    if request_cache is not None:
+        with _request_cache_lock:
+            request_cache.clear()
+
+
+def _get_shared_cache():
+    if not cropduster_settings.CROPDUSTER_STORAGE_CACHE:
+        return None
+    return caches[cropduster_settings.CROPDUSTER_STORAGE_CACHE]
+
+
+def _cache_key(storage, name):
+    storage_id = '%s.%s:%s' % (
+        storage.__class__.__module__, storage.__class__.__name__,
+        getattr(storage, 'location', ''))
+    digest = hashlib.md5(('%s:%s' % (storage_id, name)).encode('utf-8')).hexdigest()
+    return 'cropduster:storage:%s' % digest
+
+
+def _get_cached(storage, name):
+    key = _cache_key(storage, name)
+    request_cache = _request_cache.get()
+    entry = None
+    if request_cache is not None:
+        with _request_cache_lock:
+            entry = request_cache.get(key)
+    if entry is None:
+        shared_cache = _get_shared_cache()
+        if shared_cache is not None:
+            entry = shared_cache.get(key)
+            if entry is not None and request_cache is not None:
+                with _request_cache_lock:
+                    request_cache[key] = entry
+    return entry
+
+
+def _set_cached(storage, name, entry):
+    key = _cache_key(storage, name)
+    request_cache = _request_cache.get()
+    if request_cache is not None:
+        with _request_cache_lock:
+            request_cache[key] = entry
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.set(key, entry, cropduster_settings.CROPDUSTER_STORAGE_CACHE_TIMEOUT)
+
+
+def file_exists(name, storage=default_storage):
+    """A cached storage.exists(name)"""
+    entry = _get_cached(storage, name)
+    if entry is None:
+        entry = {'exists': storage.exists(name), 'size': None}
+        _set_cached(storage, name, entry)
+    return entry['exists']
+
+
+def file_size(name, storage=default_storage):
+    """A cached storage.size(name), or None if the file doesn't exist"""
+    entry = _get_cached(storage, name)
+    if entry is None or (entry['exists'] and entry['size'] is None):
+        try:
+            entry = {'exists': True, 'size': storage.size(name)}
+        except (IOError, OSError):
+            entry = {'exists': False, 'size': None}
+        _set_cached(storage, name, entry)
+    return entry['size']
+
+
+def record_write(name, size=None, storage=default_storage):
+    """Records that ``name`` was written, with ``size`` bytes if known"""
+    _set_cached(storage, name, {'exists': True, 'size': size})
+
+
+def record_delete(name, storage=default_storage):
+    """Records that ``name`` was deleted"""
+    _set_cached(storage, name, {'exists': False, 'size': None})
+
+
+def delete_file(name, storage=default_storage):
+    """
+    Deletes ``name`` from ``storage`` and records that it is gone. The file is
+    deleted even if it is cached as missing, since the cache may be stale.
+    """
+    storage.delete(name)
+    record_delete(name, storage=storage)
+
+
+def _s3_key(storage, name):
+    """
+    Returns the key of ``name`` in the bucket of one of django-storages' S3
+    backends, or None if ``storage`` isn't one. django-storages has no public
+    API for this, so None is also returned if its internals have changed and
+    callers should then go through the storage API instead.
+    """
+    if getattr(storage, 'bucket', None) is None:
+        return None
+    try:
+        return storage._normalize_name(storage._clean_name(name))
+    except (AttributeError, TypeError):
+        return None
+
+
+def _s3_copy(storage, src, src_key, dst_key):
+    copy_kwargs = {
+        'CopySource': {'Bucket': storage.bucket.name, 'Key': src_key},
+    }
+    if getattr(storage, 'default_acl', None):
+        copy_kwargs['ACL'] = storage.default_acl
+    try:
+        storage.bucket.Object(dst_key).copy_from(**copy_kwargs)
+    except Exception as e:
+        code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+        if code in ('404', 'NoSuchKey'):
+            raise FileNotFoundError(src)
+        raise
+
+
+def _filesystem_paths(storage, src, dst):
+    src_path, dst_path = storage.path(src), storage.path(dst)
+    if not os.path.exists(src_path):
+        raise FileNotFoundError(src)
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    return src_path, dst_path
+
+
+def _stream_copy(storage, src, dst):
+    with storage.open(src, 'rb') as src_file:
+        with storage.open(dst, 'wb') as dst_file:
+            for chunk in src_file.chunks():
+                dst_file.write(chunk)
+
+
+def copy_file(src, dst, storage=default_storage):
+    """
+    Copies the file ``src`` to ``dst`` in ``storage``, replacing ``dst`` if
+    it exists. Raises FileNotFoundError if ``src`` doesn't exist.
+
+    Storages with a ``copy(src, dst)`` method are asked to copy the file
+    themselves. Files in a FileSystemStorage are copied by the kernel, and
+    objects in django-storages' S3 backends by a server-side copy. Other
+    storages fall back to streaming the file in chunks.
+    """
+    if hasattr(storage, 'copy'):
+        storage.copy(src, dst)
+    elif isinstance(storage, FileSystemStorage):
+        # A hardlink would be cheaper still, but files are rewritten in
+        # place by storage.open(name, 'wb'), which would change both names
+        shutil.copyfile(*_filesystem_paths(storage, src, dst))
+    else:
+        src_key, dst_key = _s3_key(storage, src), _s3_key(storage, dst)
+        if src_key is not None and dst_key is not None:
+            _s3_copy(storage, src, src_key, dst_key)
+        else:
+            if not storage.exists(src):
+                raise FileNotFoundError(src)
+            _stream_copy(storage, src, dst)
+    entry = _get_cached(storage, src)
+    record_write(dst, size=entry and entry['size'], storage=storage)
+
+
+def move_file(src, dst, storage=default_storage):
+    """
+    Moves the file ``src`` to ``dst`` in ``storage``, replacing ``dst`` if
+    it exists. Raises FileNotFoundError if ``src`` doesn't exist.
+
+    Storages with a ``move(src, dst)`` method are asked to move the file
+    themselves, and files in a FileSystemStorage are renamed. Otherwise the
+    file is copied with copy_file() and then deleted.
+    """
+    if hasattr(storage, 'move'):
+        storage.move(src, dst)
+    elif isinstance(storage, FileSystemStorage):
+        os.replace(*_filesystem_paths(storage, src, dst))
+    else:
+        copy_file(src, dst, storage=storage)
+        storage.delete(src)
+    entry = _get_cached(storage, src)
+    record_write(dst, size=entry and entry['size'], storage=storage)
+    record_delete(src, storage=storage)
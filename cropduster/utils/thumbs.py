@@ -1,10 +1,9 @@
-from ..resizing import Crop
-from ..exceptions import CropDusterException
+import time
 
+from django.db.models import QuerySet, prefetch_related_objects
 
-class DummyImage(object):
-    def __init__(self, image):
-        self.size = [image.width, image.height]
+from ..resizing import Crop
+from ..exceptions import CropDusterException
 
 
 def set_as_auto_crop(thumb, reference_thumb, force=False):
@@ -16,9 +15,9 @@ def set_as_auto_crop(thumb, reference_thumb, force=False):
     This function can be destructive so, by default, it does not re-set the
     parent crop if the new crop box is different than the old crop box.
     """
-    dummy_image = DummyImage(thumb.image)
-    current_best_fit = Crop(thumb.get_crop_box(), dummy_image).best_fit(thumb.width, thumb.height)
-    new_best_fit = Crop(reference_thumb.get_crop_box(), dummy_image).best_fit(thumb.width, thumb.height)
+    orig_size = (thumb.image.width, thumb.image.height)
+    current_best_fit = Crop(thumb.get_crop_box(), size=orig_size).best_fit(thumb.width, thumb.height)
+    new_best_fit = Crop(reference_thumb.get_crop_box(), size=orig_size).best_fit(thumb.width, thumb.height)
 
     if current_best_fit.box != new_best_fit.box and not force:
         raise CropDusterException("Current image crop based on '%s' is "
@@ -49,7 +48,7 @@ def unset_as_auto_crop(thumb):
         return
 
     reference_thumb_box = thumb.reference_thumb.get_crop_box()
-    crop = Crop(reference_thumb_box, DummyImage(thumb.image))
+    crop = Crop(reference_thumb_box, size=(thumb.image.width, thumb.image.height))
     best_fit = crop.best_fit(thumb.width, thumb.height)
 
     thumb.reference_thumb = None
@@ -58,3 +57,28 @@ def unset_as_auto_crop(thumb):
     thumb.crop_x = best_fit.box.x1
     thumb.crop_y = best_fit.box.y1
     thumb.save()
+
+
+def prefetch_crops(objs, *field_names):
+    """
+    Prefetches the cropduster images and thumbs of the CropDusterFields
+    ``field_names`` for ``objs``, which can be a QuerySet or a list of model
+    instances, so that get_crop can render any of their crops without
+    further queries. Usage:
+
+        articles = prefetch_crops(Article.objects.all(), 'lead_image', 'alt_image')
+
+    Returns the QuerySet with prefetch_related() applied, or the list with
+    its instances' caches populated.
+    """
+    lookups = ['%s__thumbs' % name for name in field_names]
+    if isinstance(objs, QuerySet):
+        return objs.prefetch_related(*lookups)
+    objs = list(objs)
+    prefetch_related_objects(objs, *lookups)
+    return objs
+
+
+def get_cache_buster(date_modified):
+    """Returns the query string that get_crop appends to the url of a crop"""
+    return str(time.mktime(date_modified.timetuple()))[:-2]
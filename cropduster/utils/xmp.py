@@ -0,0 +1,162 @@
+"""
+Reads and writes XMP packets in the encoded bytes of JPEG and PNG images,
+so that metadata can be added to a thumbnail before it is written to storage
+rather than by round-tripping the file through exempi afterwards.
+"""
+import struct
+import zlib
+
+
+__all__ = (
+    'XMP_PACKET_FORMATS', 'read_xmp_packet', 'write_xmp_packet',
+    'can_write_xmp_packet', 'get_image_xmp_packet')
+
+
+# The PIL image formats that packets can be read from and written to
+XMP_PACKET_FORMATS = ('JPEG', 'PNG')
+
+
+JPEG_XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+PNG_XMP_KEYWORD = b'XML:com.adobe.xmp'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# The largest packet that fits in a single APP1 segment. Larger packets need
+# the "extended XMP" scheme, which isn't supported; exempi writes them instead
+# (see can_write_xmp_packet()).
+JPEG_MAX_PACKET_SIZE = 0xFFFF - 2 - len(JPEG_XMP_HEADER)
+
+
+def _iter_jpeg_segments(data):
+    """
+    Yields (marker, start, end) for each segment of a JPEG's header, up to
+    and not including the start of scan.
+    """
+    pos = 2
+    length = len(data)
+    while pos + 4 <= length:
+        if data[pos] != 0xFF:
+            raise ValueError("Invalid JPEG marker at offset %d" % pos)
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker == 0xDA or marker == 0xD9:
+            return
+        seg_len, = struct.unpack('>H', data[pos + 2:pos + 4])
+        yield marker, pos, pos + 2 + seg_len
+        pos += 2 + seg_len
+
+
+def _iter_png_chunks(data):
+    """Yields (chunk_type, start, end) for each chunk of a PNG"""
+    pos = len(PNG_SIGNATURE)
+    length = len(data)
+    while pos + 8 <= length:
+        chunk_len, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        end = pos + 12 + chunk_len
+        yield chunk_type, pos, end
+        if chunk_type == b'IEND':
+            return
+        pos = end
+
+
+def _parse_itxt(body):
+    """
+    Returns the (keyword, text) of an iTXt chunk body, or None if the text is
+    compressed with an unknown method.
+    """
+    keyword, _, rest = body.partition(b'\x00')
+    compressed, method = rest[0], rest[1]
+    # Skip the language tag and translated keyword
+    _, _, rest = rest[2:].partition(b'\x00')
+    _, _, text = rest.partition(b'\x00')
+    if compressed:
+        if method != 0:
+            return None
+        text = zlib.decompress(text)
+    return keyword, text
+
+
+def read_xmp_packet(data):
+    """
+    Returns the XMP packet embedded in the bytes of a JPEG or PNG image, or
+    None if it has none. Raises ValueError for other formats.
+    """
+    if data[:2] == b'\xff\xd8':
+        for marker, start, end in _iter_jpeg_segments(data):
+            body = data[start + 4:end]
+            if marker == 0xE1 and body.startswith(JPEG_XMP_HEADER):
+                return body[len(JPEG_XMP_HEADER):]
+        return None
+    elif data[:8] == PNG_SIGNATURE:
+        for chunk_type, start, end in _iter_png_chunks(data):
+            if chunk_type == b'iTXt':
+                parsed = _parse_itxt(data[start + 8:end - 4])
+                if parsed and parsed[0] == PNG_XMP_KEYWORD:
+                    return parsed[1]
+        return None
+    raise ValueError("XMP packets can only be read from JPEG and PNG images")
+
+
+def write_xmp_packet(data, packet):
+    """
+    Returns the bytes of a JPEG or PNG image with ``packet`` as its XMP packet,
+    replacing any it already had. Raises ValueError for other formats.
+    """
+    if data[:2] == b'\xff\xd8':
+        if len(packet) > JPEG_MAX_PACKET_SIZE:
+            raise ValueError("XMP packet is too large for a JPEG APP1 segment")
+        body = JPEG_XMP_HEADER + packet
+        segment = b'\xff\xe1' + struct.pack('>H', len(body) + 2) + body
+        segments = []
+        header_end = 2
+        for marker, start, end in _iter_jpeg_segments(data):
+            header_end = end
+            if marker == 0xE1 and data[start + 4:end].startswith(JPEG_XMP_HEADER):
+                continue
+            segments.append((marker, data[start:end]))
+        # Place the packet after the JFIF / Exif segments, which readers
+        # expect to come first
+        insert_at = 0
+        while insert_at < len(segments) and segments[insert_at][0] in (0xE0, 0xE1):
+            insert_at += 1
+        segments.insert(insert_at, (0xE1, segment))
+        return data[:2] + b''.join(s for m, s in segments) + data[header_end:]
+    elif data[:8] == PNG_SIGNATURE:
+        body = PNG_XMP_KEYWORD + b'\x00\x00\x00\x00\x00' + packet
+        chunk = (struct.pack('>I', len(body)) + b'iTXt' + body +
+                 struct.pack('>I', zlib.crc32(b'iTXt' + body) & 0xFFFFFFFF))
+        out = [data[:len(PNG_SIGNATURE)]]
+        for chunk_type, start, end in _iter_png_chunks(data):
+            if chunk_type == b'iTXt':
+                parsed = _parse_itxt(data[start + 8:end - 4])
+                if parsed and parsed[0] == PNG_XMP_KEYWORD:
+                    continue
+            out.append(data[start:end])
+            if chunk_type == b'IHDR':
+                out.append(chunk)
+        return b''.join(out)
+    raise ValueError("XMP packets can only be written to JPEG and PNG images")
+
+
+def can_write_xmp_packet(format, packet):
+    """
+    Whether write_xmp_packet() can embed ``packet`` in an image of the PIL
+    ``format``. Packets too large for a JPEG APP1 segment, e.g. of originals
+    with a long Photoshop DocumentAncestors list, have to be written by exempi.
+    """
+    if format == 'JPEG':
+        return len(packet) <= JPEG_MAX_PACKET_SIZE
+    return format in XMP_PACKET_FORMATS
+
+
+def get_image_xmp_packet(im):
+    """
+    Returns the XMP packet of an opened PIL image, as parsed by Pillow when
+    it read the image header, or None if it has none.
+    """
+    packet = im.info.get('xmp') or im.info.get(PNG_XMP_KEYWORD.decode('ascii'))
+    if isinstance(packet, str):
+        packet = packet.encode('utf-8')
+    return packet or None
@@ -38,7 +38,6 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
 from django.core.files.storage import default_storage
-from django.db.models import Q
 from django.forms.models import modelformset_factory
 from django.http import HttpResponse
 from django.shortcuts import render
@@ -59,7 +58,8 @@ from cropduster.settings import (
     CROPDUSTER_PREVIEW_WIDTH as PREVIEW_WIDTH,
     CROPDUSTER_PREVIEW_HEIGHT as PREVIEW_HEIGHT)
 from cropduster.utils import (
-    json, is_animated_gif, has_animated_gif_support, process_image)
+    json, is_animated_gif, has_animated_gif_support, process_image, smart_resize,
+    draft_image, get_preview_size, file_exists, delete_file)
 from cropduster.exceptions import json_error, CropDusterResizeException, full_exc_info
 
 from .base import View
@@ -147,20 +147,33 @@ class CropDusterIndex(View):
     def get(self, *args, **kwargs):
         orig_image = self.orig_image
         try:
-            orig_w = getattr(orig_image, 'width', None) or 0
-            orig_h = getattr(orig_image, 'height', None) or 0
+            if self.db_image:
+                # Uses the dimensions stored on the row, or probes the header
+                # of the file, rather than reading the whole original
+                orig_w, orig_h = self.db_image.get_image_size()
+            else:
+                orig_w = getattr(orig_image, 'width', None) or 0
+                orig_h = getattr(orig_image, 'height', None) or 0
             orig_image_name = getattr(orig_image, 'name', None)
         except Exception:
             # If original image not found, allow it to be re-uploaded
             orig_w, orig_h = 0, 0
             orig_image_name = None
 
+        # The thumbs were fetched by self.thumbs; group each with the thumbs
+        # referencing it from those, rather than querying for each form
+        thumb_values = []
+        thumb_groups = {}
+        for t in self.thumbs.queryset:
+            values = {'id': t.pk, 'name': t.name, 'width': t.width, 'height': t.height}
+            thumb_values.append(values)
+            thumb_groups.setdefault(t.pk, []).append(values)
+            thumb_groups.setdefault(t.reference_thumb_id, []).append(values)
+
         initial = {
             'standalone': self.is_standalone,
             'sizes': json.dumps(self.sizes),
-            'thumbs': json.dumps(dict([
-                (t['name'], t)
-                for t in self.thumbs.queryset.values('id', 'name', 'width', 'height')])),
+            'thumbs': json.dumps(dict([(t['name'], t) for t in thumb_values])),
             'image_id': getattr(self.db_image, 'pk', None) if orig_image else None,
             'orig_image': orig_image_name,
             'orig_w': orig_w,
@@ -178,8 +191,7 @@ class CropDusterIndex(View):
                 thumb_form.initial['size'] = json.dumps(size_dict[name])
             # The thumb being cropped and thumbs referencing it
             pk = thumb_form.initial['id']
-            thumb_group = self.thumbs.queryset.filter(Q(pk=pk) | Q(reference_thumb_id__exact=pk))
-            thumb_group_data = dict([(t['name'], t) for t in thumb_group.values('id', 'name', 'width', 'height')])
+            thumb_group_data = dict([(t['name'], t) for t in thumb_groups.get(pk, [])])
             thumb_form.initial.update({
                 'thumbs': json.dumps(thumb_group_data),
                 'changed': False,
@@ -233,9 +245,12 @@ def upload(request):
     orig_file_path = form_data['image'].name
     orig_image = get_relative_media_url(orig_file_path)
 
+    # The original has to be decoded to make its preview, so it is read in
+    # full; the standalone path below reuses the bytes
     with default_storage.open(orig_image, mode='rb') as f:
-        img = PIL.Image.open(BytesIO(f.read()))
-        img.filename = f.name
+        orig_contents = f.read()
+        img = PIL.Image.open(BytesIO(orig_contents))
+        img.filename = orig_filename = f.name
 
     (w, h) = (orig_w, orig_h) = img.size
 
@@ -249,21 +264,14 @@ def upload(request):
     preview_h = form_data.get('preview_height') or PREVIEW_HEIGHT
 
     # First pass resize if it's too large
-    resize_ratio = min(preview_w / w, preview_h / h)
+    (preview_w, preview_h) = get_preview_size((w, h), preview_w, preview_h)
 
     def fit_preview(im):
-        (w, h) = im.size
-        if resize_ratio < 1:
-            w = int(round(w * resize_ratio))
-            h = int(round(h * resize_ratio))
-            preview_img = im.resize((w, h), PIL.Image.LANCZOS)
-        else:
-            preview_img = im
-        return preview_img
+        return smart_resize(im, preview_w, preview_h, resample=PIL.Image.LANCZOS)
 
     if not is_standalone:
         preview_file_path = tmp_image.get_image_path('_preview')
-        process_image(img, preview_file_path, fit_preview)
+        process_image(draft_image(img, preview_w, preview_h), preview_file_path, fit_preview)
 
     data.update({
         'crop': {
@@ -282,13 +290,15 @@ def upload(request):
     if not is_standalone:
         return HttpResponse(json.dumps(data), content_type='application/json')
 
-    size = Size('crop', w=img.size[0], h=img.size[1])
+    size = Size('crop', w=orig_w, h=orig_h)
 
     md5 = form_data.get('md5')
-    try:
-        standalone_image = StandaloneImage.objects.get(md5=md5)
-    except StandaloneImage.DoesNotExist:
-        standalone_image = StandaloneImage(md5=md5, image=orig_image)
+    if md5:
+        # md5 is unique, so concurrent uploads of the same file get one row
+        standalone_image, created = StandaloneImage.objects.get_or_create(
+            md5=md5, defaults={'image': orig_image})
+    else:
+        standalone_image = StandaloneImage(image=orig_image)
         standalone_image.save()
     cropduster_image, created = Image.objects.get_or_create(
         content_type=ContentType.objects.get_for_model(StandaloneImage),
@@ -296,19 +306,30 @@ def upload(request):
 
     if not cropduster_image.image:
         cropduster_image.image = orig_image
+        cropduster_image.md5 = md5 or ''
         cropduster_image.save()
     elif cropduster_image.image.name != orig_image:
         data['crop']['orig_image'] = data['orig_image'] = cropduster_image.image.name
         data['url'] = cropduster_image.get_image_url('_preview')
 
-    with cropduster_image.image_file_open() as f:
-        img = PIL.Image.open(BytesIO(f.read()))
-        img.filename = f.name
+    if cropduster_image.image.name == orig_image:
+        img_contents = orig_contents
+        img = PIL.Image.open(BytesIO(img_contents))
+        img.filename = orig_filename
+    else:
+        with cropduster_image.image_file_open() as f:
+            img_contents = f.read()
+            img = PIL.Image.open(BytesIO(img_contents))
+            img.filename = f.name
     preview_file_path = cropduster_image.get_image_path('_preview')
-    if not default_storage.exists(preview_file_path):
-        process_image(img, preview_file_path, fit_preview)
+    if not file_exists(preview_file_path):
+        # Open a separate copy to draft, since `img` is cropped at full resolution
+        preview_img = PIL.Image.open(BytesIO(img_contents))
+        preview_img.filename = img.filename
+        process_image(
+            draft_image(preview_img, preview_w, preview_h), preview_file_path, fit_preview)
 
-    thumb = cropduster_image.save_size(size, standalone=True, commit=False)
+    thumb = cropduster_image.save_size(size, image=img, standalone=True, commit=False)
 
     sizes = form_data.get('sizes') or []
     if len(sizes) == 1:
@@ -397,14 +418,21 @@ def crop(request):
         size = thumb_data['size']
 
         if changed_fields & set(['crop_x', 'crop_y', 'crop_w', 'crop_h']):
-            # Clear existing primary key to force new thumb creation
+            # Clear existing primary key to force new thumb creation. The
+            # new generation belongs to no image until the image's form is
+            # saved, which deletes the generation it replaces.
             thumb.pk = None
+            thumb.image = None
+            thumb.generation += 1
 
             thumb.width = min(filter(None, [thumb.width, thumb.crop_w]))
             thumb.height = min(filter(None, [thumb.height, thumb.crop_h]))
 
             try:
-                new_thumbs = db_image.save_size(size, thumb, tmp=True, standalone=standalone_mode)
+                # Its auto thumbs are new rows too, rather than the committed ones
+                new_thumbs = db_image.save_size(
+                    size, thumb, image=pil_image, tmp=True, standalone=standalone_mode,
+                    existing_thumbs={})
             except CropDusterResizeException as e:
                 return json_error(request, 'crop',
                                   action="saving size", errors=[force_str(e)])
@@ -435,14 +463,14 @@ def crop(request):
                     continue
                 thumbs_data[i]['thumbs'].update({name: thumb_data})
         elif thumb.pk and thumb.name and thumb.crop_w and thumb.crop_h:
-            thumb_path = db_image.get_image_path(thumb.name, tmp=False)
-            tmp_thumb_path = db_image.get_image_path(thumb.name, tmp=True)
-
-            if default_storage.exists(thumb_path):
-                if not thumb_form.cleaned_data.get('changed') or not default_storage.exists(tmp_thumb_path):
-                    with default_storage.open(thumb_path) as f:
-                        with default_storage.open(tmp_thumb_path, 'wb') as tmp_file:
-                            tmp_file.write(f.read())
+            if not thumb_form.cleaned_data.get('changed') and thumb.image_id:
+                # The tmp name of an unchanged thumb stands for its committed
+                # file, which Thumb.save() leaves in place when there is no
+                # tmp file to move over it. Delete any tmp file left by an
+                # abandoned crop, rather than copying the committed file over it.
+                # The tmp file of an uncommitted re-crop is its only file, and is kept.
+                for tmp_thumb_path in thumb.get_image_paths(tmp=True, image=db_image):
+                    delete_file(tmp_thumb_path)
 
         if not thumb.pk and not thumb.crop_w and not thumb.crop_h:
             if not len(thumbs_with_crops):
@@ -1,12 +1,10 @@
 from __future__ import division
 
 import os
-import hashlib
 
 import PIL.Image
 
 from django import forms
-from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.storage import default_storage
 from django.conf import settings
 from django.forms.forms import NON_FIELD_ERRORS
@@ -17,8 +15,8 @@ from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
 
 from cropduster.models import Thumb
-from cropduster.utils import (json, get_upload_foldername, get_min_size,
-    get_image_extension)
+from cropduster.utils import (json, get_upload_foldername, release_upload_foldername,
+    get_min_size, get_image_extension, md5_digest, record_write)
 
 
 class ErrorDict(_ErrorDict):
@@ -35,7 +33,11 @@ class ErrorDict(_ErrorDict):
                 % ''.join(['<li>%s</li>' % e for e in error_list]))
 
 
-def clean_upload_data(data):
+def clean_upload_data(data, md5=None):
+    """
+    Validates and saves an uploaded original image. ``md5`` is its digest,
+    if the caller has already computed it.
+    """
     image = data['image']
     image.seek(0)
     try:
@@ -49,10 +51,6 @@ def clean_upload_data(data):
     else:
         extension = get_image_extension(pil_image)
 
-    upload_to = data['upload_to'] or None
-
-    folder_path = get_upload_foldername(image.name, upload_to=upload_to)
-
     (w, h) = (orig_w, orig_h) = pil_image.size
     sizes = data.get('sizes')
     if sizes:
@@ -75,15 +73,24 @@ def clean_upload_data(data):
         raise forms.ValidationError({"image": ["Invalid image: height is %d" % h]})
 
     # File is good, get rid of the tmp file
-    orig_file_path = os.path.join(folder_path, 'original' + extension)
     image.seek(0)
-    md5_hash = hashlib.md5()
-    default_storage.save(orig_file_path, image)
+    # Hash the upload as it is streamed, rather than reading the saved file
+    # back from storage
+    data['md5'] = md5 or md5_digest(image)
+    image.seek(0)
+    # The folder is created when its name is reserved, so reserve it only
+    # now that the upload is valid, and remove it if saving fails
+    upload_to = data['upload_to'] or None
+    folder_path = get_upload_foldername(image.name, upload_to=upload_to)
+    orig_file_path = os.path.join(folder_path, 'original' + extension)
+    try:
+        orig_file_path = default_storage.save(orig_file_path, image)
+    except Exception:
+        release_upload_foldername(folder_path)
+        raise
+    record_write(orig_file_path, size=image.size)
     with default_storage.open(orig_file_path) as f:
-        md5_hash.update(f.read())
-        f.seek(0)
         data['image'] = f
-    data['md5'] = md5_hash.hexdigest()
 
     return data
 
@@ -209,19 +216,25 @@ class ThumbFormSet(BaseModelFormSet):
     def _existing_object(self, pk):
         """
         Avoid potentially expensive list comprehension over self.queryset()
-        in the parent method.
+        in the parent method: the thumbs submitted by every initial form are
+        looked up in one query, the first time one of them is needed.
         """
         if not hasattr(self, '_object_dict'):
-            self._object_dict = {}
+            pk_field = self.model._meta.pk
+            to_python = self._get_to_python(pk_field)
+            pks = set()
+            for i in range(self.initial_form_count()):
+                pk_key = "%s-%s" % (self.add_prefix(i), pk_field.name)
+                try:
+                    pks.add(to_python(self.data.get(pk_key) or None))
+                except forms.ValidationError:
+                    pass
+            pks.discard(None)
+            self._object_dict = dict(
+                (obj.pk, obj) for obj in self.get_queryset().filter(pk__in=pks))
         if not pk:
             return None
-        try:
-            obj = self.get_queryset().get(pk=pk)
-        except ObjectDoesNotExist:
-            return None
-        else:
-            self._object_dict[obj.pk] = obj
-        return super(ThumbFormSet, self)._existing_object(pk)
+        return self._object_dict.get(pk)
 
     def _construct_form(self, i, **kwargs):
         if self.is_bound and i < self.initial_form_count():
@@ -0,0 +1,22 @@
+import shutil
+
+from django.core.files.storage import FileSystemStorage
+
+
+class ServerSideCopyStorage(FileSystemStorage):
+    """
+    A stand-in for a remote storage which can copy and move files without
+    them passing through the Django process, recording the calls it gets.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ServerSideCopyStorage, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def copy(self, src, dst):
+        self.calls.append(('copy', src, dst))
+        shutil.copyfile(self.path(src), self.path(dst))
+
+    def move(self, src, dst):
+        self.calls.append(('move', src, dst))
+        shutil.move(self.path(src), self.path(dst))
@@ -1,21 +1,25 @@
 from __future__ import absolute_import, division
 
-from io import BytesIO
+from io import BytesIO, StringIO
 import os
+from unittest import mock
+
 import PIL
 
 from django.core.files.storage import default_storage
 from django.test import TestCase, override_settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
 
 from .helpers import CropdusterTestCaseMediaMixin
 from .models import (
     Article, Author, OptionalSizes, MultipleFieldsInheritanceChild,
     ReverseForeignRelA, ReverseForeignRelB, ReverseForeignRelC,
     ReverseForeignRelM2M, OrphanedThumbs)
-from cropduster.models import Size, Image, Thumb
+from cropduster.models import Size, Image, Thumb, RenderJob
 from cropduster.exceptions import CropDusterResizeException
 from cropduster import settings as cropduster_settings
+from cropduster import utils as cropduster_utils
 
 
 class TestImage(CropdusterTestCaseMediaMixin, TestCase):
@@ -33,6 +37,16 @@ class TestImage(CropdusterTestCaseMediaMixin, TestCase):
         self.assertEqual(article.lead_image.height, 800)
         self.assertIs(article.lead_image.sizes, Article.LEAD_IMAGE_SIZES)
 
+    def test_image_size_falls_back_to_pil(self):
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        image = Image.objects.create(
+            content_object=article, field_identifier='', image=article.lead_image.name)
+        with mock.patch('cropduster.models.probe_image', return_value=None):
+            self.assertEqual(image.get_image_size(), (674, 800))
+        image = Image.objects.get(pk=image.pk)
+        self.assertEqual((image.width, image.height), (674, 800))
+
     def test_generate_thumbs(self):
         article = Article.objects.create(title="Pudd'nhead Wilson",
             author=self.author, lead_image=self.create_unique_image('img.jpg'))
@@ -64,6 +78,211 @@ class TestImage(CropdusterTestCaseMediaMixin, TestCase):
             title="Img Too Small", author=self.author, lead_image='new-img.jpg')
         self.assertRaises(CropDusterResizeException, article.lead_image.generate_thumbs)
 
+    def test_generate_thumbs_reads_original_once(self):
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        with mock.patch.object(Image, 'image_file_open', autospec=True,
+                               side_effect=Image.image_file_open) as image_file_open:
+            article.lead_image.generate_thumbs()
+        self.assertEqual(image_file_open.call_count, 1)
+
+    def test_generate_thumbs_without_bulk_insert_pks(self):
+        from django.db import connection
+
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        # New thumbs are saved one at a time, after the thumbs they reference
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert',
+                               False, create=True):
+            article.lead_image.generate_thumbs()
+        article = Article.objects.get(pk=article.pk)
+        thumbs = dict((t.name, t) for t in article.lead_image.related_object.thumbs.all())
+        self.assertEqual(sorted(thumbs), ['main', 'no_height', 'thumb'])
+        self.assertEqual(thumbs['thumb'].reference_thumb_id, thumbs['main'].pk)
+
+    def get_thumb_writes(self, article):
+        """The INSERT and UPDATE statements on thumbs made by generate_thumbs()"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        table = connection.ops.quote_name(Thumb._meta.db_table)
+        article = Article.objects.get(pk=article.pk)
+        with CaptureQueriesContext(connection) as queries:
+            article.lead_image.generate_thumbs()
+        return [q['sql'].split()[0] for q in queries.captured_queries
+                if q['sql'].startswith(('INSERT INTO %s' % table, 'UPDATE %s' % table))]
+
+    def test_generate_thumbs_saves_thumbs_in_bulk(self):
+        few_sizes = [Size('a', w=100, h=100, auto=[Size('a_small', w=50, h=50)])]
+        many_sizes = few_sizes + [
+            Size('b', w=200, h=100),
+            Size('c', w=100, h=200, auto=[Size('c_small', w=50, h=100)]),
+            Size('d', w=300),
+        ]
+        writes = []
+        for sizes in (few_sizes, many_sizes):
+            article = Article.objects.create(title="Pudd'nhead Wilson",
+                author=self.author, lead_image=self.create_unique_image('img.jpg'))
+            with mock.patch.object(Article._meta.get_field('lead_image'), 'sizes', sizes):
+                writes.append((self.get_thumb_writes(article), self.get_thumb_writes(article)))
+            image = Article.objects.get(pk=article.pk).lead_image.related_object
+            self.assertEqual(image.thumbs.count(), len(list(Size.flatten(sizes))))
+        # New thumbs are inserted a batch per level of reference, and
+        # existing ones updated in one batch, whatever the number of sizes
+        self.assertEqual(writes[0], writes[1])
+        self.assertEqual(writes[0][1], ['UPDATE'])
+
+    def test_image_md5(self):
+        import hashlib
+
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        article.lead_image.generate_thumbs()
+        article = Article.objects.get(pk=article.pk)
+        image = Image.objects.get(pk=article.lead_image.related_object.pk)
+        with default_storage.open(image.image.name, mode='rb') as f:
+            self.assertEqual(image.md5, hashlib.md5(f.read()).hexdigest())
+
+        with mock.patch.object(Image, 'image_file_open') as image_file_open:
+            self.assertEqual(image.get_md5(), image.md5)
+        self.assertFalse(image_file_open.called)
+
+        # Replacing the original discards the digest of the old one
+        image.image = self.create_unique_image('img.png')
+        image.save()
+        self.assertEqual(Image.objects.get(pk=image.pk).md5, '')
+
+    def test_generate_thumbs_concurrently(self):
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        with mock.patch.object(cropduster_settings, 'CROPDUSTER_RENDER_WORKERS', 4):
+            article.lead_image.generate_thumbs()
+
+        article = Article.objects.get(pk=article.pk)
+        thumbs = list(article.lead_image.related_object.thumbs.all())
+        self.assertEqual(len(thumbs), len(list(Size.flatten(Article.LEAD_IMAGE_SIZES))))
+        for thumb in thumbs:
+            with default_storage.open(thumb.image_name, mode='rb') as f:
+                self.assertEqual((thumb.width, thumb.height), PIL.Image.open(f).size)
+
+    def test_xmp_support_is_resolved_before_rendering_concurrently(self):
+        import threading
+        from cropduster.resizing import get_xmp_metadata
+
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        calling_threads = []
+
+        def resolve_xmp_metadata():
+            calling_threads.append(threading.current_thread())
+            return get_xmp_metadata()
+
+        with mock.patch.object(cropduster_settings, 'CROPDUSTER_RENDER_WORKERS', 4), \
+                mock.patch('cropduster.models.get_xmp_metadata', resolve_xmp_metadata), \
+                mock.patch('cropduster.resizing.get_xmp_metadata', resolve_xmp_metadata):
+            article.lead_image.generate_thumbs()
+        self.assertEqual(set(calling_threads), {threading.current_thread()})
+
+    def test_large_xmp_packet_is_written_by_exempi(self):
+        from cropduster.resizing import Crop
+        from cropduster.utils.xmp import can_write_xmp_packet, write_xmp_packet
+
+        # e.g. an original with a long Photoshop DocumentAncestors list
+        packet = b'<x:xmpmeta xmlns:x="adobe:ns:meta/">%s</x:xmpmeta>' % (b' ' * 70000)
+        self.assertFalse(can_write_xmp_packet('JPEG', packet))
+        with self.assertRaises(ValueError):
+            write_xmp_packet(b'\xff\xd8\xff\xd9', packet)
+
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        with mock.patch('cropduster.models.get_xmp_metadata', return_value=mock.Mock()), \
+                mock.patch.object(Crop, 'get_xmp_packet', return_value=packet), \
+                mock.patch.object(Crop, 'add_xmp_to_crop') as add_xmp_to_crop:
+            article.lead_image.generate_thumbs()
+        self.assertEqual(add_xmp_to_crop.call_count, len(list(Size.flatten(Article.LEAD_IMAGE_SIZES))))
+        for thumb in Article.objects.get(pk=article.pk).lead_image.related_object.thumbs.all():
+            self.assertTrue(default_storage.exists(thumb.image_name))
+
+    def test_generate_thumbs_in_background(self):
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        with mock.patch.object(cropduster_settings, 'CROPDUSTER_THUMB_BACKEND',
+                               'cropduster.jobs.DatabaseBackend'), \
+                mock.patch.object(Image, 'open_image', side_effect=AssertionError):
+            # The original is only read when the job renders the thumbnails
+            article.lead_image.generate_thumbs(background=True)
+
+        article = Article.objects.get(pk=article.pk)
+        image = article.lead_image.related_object
+        thumbs = list(image.thumbs.all())
+        self.assertEqual(len(thumbs), len(list(Size.flatten(Article.LEAD_IMAGE_SIZES))))
+        for thumb in thumbs:
+            self.assertTrue(thumb.width and thumb.height)
+            self.assertFalse(default_storage.exists(thumb.image_name))
+        self.assertEqual(RenderJob.objects.filter(image=image).count(), 1)
+
+        call_command('cropduster_render_jobs', stdout=StringIO())
+        self.assertFalse(RenderJob.objects.exists())
+        for thumb in thumbs:
+            with default_storage.open(thumb.image_name, mode='rb') as f:
+                self.assertEqual((thumb.width, thumb.height), PIL.Image.open(f).size)
+
+    def test_render_jobs_requeues_stale_jobs(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        with mock.patch.object(cropduster_settings, 'CROPDUSTER_THUMB_BACKEND',
+                               'cropduster.jobs.DatabaseBackend'):
+            article.lead_image.generate_thumbs(background=True)
+        # A worker claimed the job, then died
+        [job] = RenderJob.objects.claim()
+
+        call_command('cropduster_render_jobs', stdout=StringIO())
+        self.assertEqual(RenderJob.objects.get(pk=job.pk).status, RenderJob.RUNNING)
+
+        RenderJob.objects.update(date_claimed=timezone.now() - timedelta(hours=2))
+        call_command('cropduster_render_jobs', stdout=StringIO())
+        self.assertFalse(RenderJob.objects.exists())
+
+    def test_failed_render_job_keeps_its_claim(self):
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        with mock.patch.object(cropduster_settings, 'CROPDUSTER_THUMB_BACKEND',
+                               'cropduster.jobs.DatabaseBackend'):
+            article.lead_image.generate_thumbs(background=True)
+        [job] = RenderJob.objects.claim()
+        with mock.patch('cropduster.jobs.render_thumbs', side_effect=IOError):
+            self.assertFalse(job.run())
+
+        job = RenderJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, RenderJob.FAILED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.date_claimed)
+
+    def test_regenerate_command(self):
+        article = Article.objects.create(title="Pudd'nhead Wilson",
+            author=self.author, lead_image=self.create_unique_image('img.jpg'))
+        article.lead_image.generate_thumbs()
+        article = Article.objects.get(pk=article.pk)
+        thumbs = list(article.lead_image.related_object.thumbs.all())
+        for thumb in thumbs:
+            default_storage.delete(thumb.image_name)
+
+        checkpoint = os.path.join(self.temp_media_root, 'checkpoint.json')
+        stdout = StringIO()
+        call_command('cropduster_regenerate', model=['tests.article'],
+            size=['main'], checkpoint=checkpoint, stdout=stdout)
+        self.assertIn("regenerated 1 image(s), 0 failed", stdout.getvalue())
+        for thumb in thumbs:
+            self.assertEqual(default_storage.exists(thumb.image_name), thumb.name != 'no_height')
+
+        # Resuming from the checkpoint skips the images already processed
+        stdout = StringIO()
+        call_command('cropduster_regenerate', checkpoint=checkpoint, stdout=stdout)
+        self.assertIn("regenerated 0 image(s), 0 failed", stdout.getvalue())
+
     @override_settings(CROPDUSTER_CREATE_THUMBS=False)
     def test_dont_generate_thumbs(self):
         article = Article.objects.create(title="Pudd'nhead Wilson",
@@ -115,6 +334,169 @@ class TestImage(CropdusterTestCaseMediaMixin, TestCase):
                 for thumb in article.lead_image.related_object.thumbs.all():
                     thumb.image
 
+    def test_get_crop_queries(self):
+        from django.template import Context, Template
+        from cropduster.utils import prefetch_crops
+
+        for x in range(3):
+            lead_image = self.create_unique_image('img.jpg')
+            article = Article.objects.create(title="", author=self.author, lead_image=lead_image)
+            article.lead_image.generate_thumbs()
+
+        template = Template(
+            "{% load cropduster_tags %}{% for article in articles %}"
+            "{% for name in names %}{% get_crop article.lead_image name as img %}"
+            "{{ img.width }} {% endfor %}{% endfor %}")
+        names = ['main', 'thumb', 'original']
+
+        # The thumbs of each image are looked up once, however many crops of
+        # it are rendered
+        articles = list(Article.objects.all())
+        with self.assertNumQueries(6):
+            output = template.render(Context({'articles': articles, 'names': names}))
+        self.assertEqual(output.split(), ['600', '110', '674'] * 3)
+
+        with self.assertNumQueries(3):
+            articles = prefetch_crops(Article.objects.all(), 'lead_image')
+            template.render(Context({'articles': articles, 'names': names}))
+
+    def test_get_crop_outside_templates(self):
+        from cropduster.templatetags.cropduster_tags import get_crop
+
+        article = Article.objects.create(title="", author=self.author,
+            lead_image=self.create_unique_image('img.jpg'))
+        article.lead_image.generate_thumbs()
+        article = Article.objects.get(pk=article.pk)
+        crop = get_crop(article.lead_image, 'main')
+        self.assertEqual((crop['width'], crop['height']), (600, 480))
+        self.assertIsNone(get_crop(article.lead_image, 'does_not_exist'))
+
+    def test_get_crop_manifest(self):
+        from django.template import Context, Template
+
+        with mock.patch.object(cropduster_settings, 'CROPDUSTER_CROP_MANIFEST', True):
+            article = Article.objects.create(title="", author=self.author,
+                lead_image=self.create_unique_image('img.jpg'))
+            article.lead_image.generate_thumbs()
+
+            article = Article.objects.get(pk=article.pk)
+            image = article.lead_image.related_object
+            manifest = image.get_manifest()
+            self.assertEqual(
+                sorted(manifest), ['main', 'no_height', 'original', 'thumb'])
+            self.assertEqual(manifest['thumb']['url'], image.thumbs.get(name='thumb').url)
+
+            template = Template(
+                "{% load cropduster_tags %}{% for name in names %}"
+                "{% get_crop article.lead_image name as img %}"
+                "{% if img %}{{ img.width }}x{{ img.height }} {% endif %}{% endfor %}")
+            with self.assertNumQueries(0):
+                output = template.render(Context({
+                    'article': article, 'names': ['main', 'thumb', 'original', 'missing']}))
+            self.assertEqual(output.split(), ['600x480', '110x90', '674x800'])
+
+    def test_manifest_is_refreshed_once(self):
+        with mock.patch.object(cropduster_settings, 'CROPDUSTER_CROP_MANIFEST', True):
+            article = Article.objects.create(title="", author=self.author,
+                lead_image=self.create_unique_image('img.jpg'))
+            with mock.patch.object(Image, 'refresh_manifest', autospec=True,
+                                   side_effect=Image.refresh_manifest) as refresh_manifest:
+                article.lead_image.generate_thumbs()
+            self.assertEqual(refresh_manifest.call_count, 1)
+
+            image = Article.objects.get(pk=article.pk).lead_image.related_object
+            thumbs = list(image.thumbs.all())
+            self.assertEqual(sorted(image.get_manifest()),
+                sorted(['original'] + [t.name for t in thumbs]))
+            with mock.patch.object(Image, 'refresh_manifest', autospec=True) as refresh_manifest:
+                image.save()
+                image.thumbs.set(thumbs)
+            self.assertEqual(refresh_manifest.call_count, 1)
+
+    def test_retina_size(self):
+        from django.template import Context, Template
+
+        article = Article.objects.create(title="", author=self.author,
+            lead_image=self.create_unique_image('img.jpg'))
+        article.lead_image.generate_thumbs()
+        article = Article.objects.get(pk=article.pk)
+        image = article.lead_image.related_object
+
+        thumb = Thumb(name='square', image=image, crop_x=0, crop_y=0, crop_w=674, crop_h=674)
+        size = Size('square', w=300, h=300, retina=True)
+        with mock.patch('cropduster.utils.smart_resize',
+                        wraps=cropduster_utils.smart_resize) as smart_resize:
+            image.save_size(size, thumb)
+        # The 1x file is downscaled from the 2x one, not from the original
+        self.assertEqual([c.args[0].size for c in smart_resize.call_args_list],
+            [(674, 674), (600, 600)])
+
+        thumb = image.thumbs.get(name='square')
+        self.assertEqual((thumb.width, thumb.height), (300, 300))
+        self.assertEqual((thumb.retina_width, thumb.retina_height), (600, 600))
+        with default_storage.open(image.get_image_path(thumb.retina_name)) as f:
+            self.assertEqual(PIL.Image.open(f).size, (600, 600))
+        with default_storage.open(image.get_image_path('square')) as f:
+            self.assertEqual(PIL.Image.open(f).size, (300, 300))
+
+        # A crop box too small for the 2x file gets none
+        small_thumb = Thumb(name='small', image=image, crop_x=0, crop_y=0, crop_w=400, crop_h=400)
+        image.save_size(Size('small', w=300, h=300, retina=True), small_thumb)
+        self.assertIsNone(image.thumbs.get(name='small').retina_name)
+
+        template = Template(
+            "{% load cropduster_tags %}{% for name in names %}"
+            "{% get_crop article.lead_image name as img %}"
+            "{{ img.srcset|default:'none' }}|{% endfor %}")
+        output = template.render(Context({
+            'article': Article.objects.get(pk=article.pk), 'names': ['square', 'small']}))
+        square_srcset, small_srcset = output.split('|')[:2]
+        self.assertRegex(square_srcset, r'/square\.jpg\?\d+ 1x, .*/square%402x\.jpg\?\d+ 2x$')
+        self.assertEqual(small_srcset, 'none')
+
+    def test_alternate_formats(self):
+        from django.template import Context, Template
+
+        article = Article.objects.create(title="", author=self.author,
+            lead_image=self.create_unique_image('img.jpg'))
+        article.lead_image.generate_thumbs()
+        article = Article.objects.get(pk=article.pk)
+        image = article.lead_image.related_object
+
+        thumb = Thumb(name='square', image=image, crop_x=0, crop_y=0, crop_w=674, crop_h=674)
+        # Formats this Pillow build can't write are left out
+        size = Size('square', w=300, h=300, retina=True, formats=['WEBP', 'NOPE'])
+        image.save_size(size, thumb)
+
+        thumb = image.thumbs.get(name='square')
+        self.assertEqual(thumb.alternate_formats, ['WEBP'])
+        for name, dimensions in [('square', (300, 300)), ('square@2x', (600, 600))]:
+            with default_storage.open(image.get_image_path(name, format='WEBP')) as f:
+                im = PIL.Image.open(f)
+                self.assertEqual((im.format, im.size), ('WEBP', dimensions))
+
+        template = Template(
+            "{% load cropduster_tags %}{% get_crop article.lead_image 'square' as img %}"
+            "{% for source in img.sources %}{{ source.type }} {{ source.srcset }}{% endfor %}")
+        for manifest in (False, True):
+            with mock.patch.object(cropduster_settings, 'CROPDUSTER_CROP_MANIFEST', manifest):
+                if manifest:
+                    image.refresh_manifest()
+                output = template.render(Context({'article': Article.objects.get(pk=article.pk)}))
+            self.assertRegex(output,
+                r'^image/webp \S+/square\.webp\?\d+ 1x, \S+/square%402x\.webp\?\d+ 2x$')
+
+    def test_thumb_quality(self):
+        article = Article.objects.create(title="", author=self.author,
+            lead_image=self.create_unique_image('img.jpg'))
+        with mock.patch('cropduster.utils.image.CROPDUSTER_JPEG_QUALITY_SEARCH',
+                        {'max_bytes': 10 ** 7, 'max_quality': 93}):
+            article.lead_image.generate_thumbs()
+        image = Article.objects.get(pk=article.pk).lead_image.related_object
+        self.assertEqual(
+            sorted(image.thumbs.values_list('name', 'quality')),
+            [('main', 93), ('no_height', 93), ('thumb', 93)])
+
     def test_redundant_prefetch_related_args_with_images(self):
         for x in range(3):
             lead_image = self.create_unique_image('img.jpg')
@@ -203,6 +585,28 @@ class TestModelSaving(CropdusterTestCaseMediaMixin, TestCase):
         self.assertTrue(article.lead_image)
         self.assertEqual(article.lead_image.name, img_path)
 
+    def test_resave_unchanged_image_does_not_update_model(self):
+        from cropduster.fields import get_image_fields
+
+        self.assertEqual(get_image_fields(Article, ''), [(Article, 'lead_image')])
+        self.assertEqual(get_image_fields(Article, 'alt'), [(Article, 'alt_image')])
+        article = Article.objects.create(title="test", author=Author.objects.create(name='test'))
+        article_ct = ContentType.objects.get_for_model(Article, for_concrete_model=False)
+        Image.objects.create(
+            content_type=article_ct, object_id=article.pk,
+            image=self.create_unique_image('img.jpg'))
+
+        image = Image.objects.get(content_type=article_ct, object_id=article.pk)
+        with self.assertNumQueries(1):
+            image.save()
+
+        new_path = self.create_unique_image('img.png')
+        image.image = new_path
+        with self.assertNumQueries(2):
+            image.save()
+        article.refresh_from_db()
+        self.assertEqual(article.lead_image.name, new_path)
+
     def test_resave_single_image_model(self):
         img_path = self.create_unique_image('img.jpg')
         author = Author(name='test')
@@ -397,3 +801,30 @@ class TestReverseForeignRelation(TestCase):
             for obj in objs:
                 for m2m_obj in obj.m2m.all():
                     self.assertEqual(len(m2m_obj.rel_a.all()), 3)
+
+
+class TestIndexes(TestCase):
+
+    def assertUsesIndex(self, queryset, index_name=None):
+        from django.db import connection
+
+        if connection.vendor != 'sqlite':
+            self.skipTest("Query plans are only checked on SQLite")
+        plan = queryset.explain()
+        self.assertRegex(plan, r'SEARCH \S+ USING (COVERING )?INDEX')
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_thumb_lookup_uses_index(self):
+        self.assertUsesIndex(
+            Thumb.objects.filter(image_id=1, name='main'), 'cropduster_thumb_image_name')
+
+    def test_standalone_md5_lookup_uses_index(self):
+        from cropduster.standalone.models import StandaloneImage
+
+        self.assertUsesIndex(StandaloneImage.objects.filter(md5='0' * 32))
+
+        # Images whose digest is unknown don't collide
+        StandaloneImage.objects.create(md5='')
+        StandaloneImage.objects.create(md5='')
+        self.assertEqual(StandaloneImage.objects.filter(md5__isnull=True).count(), 2)
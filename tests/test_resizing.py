@@ -1,9 +1,17 @@
 import os
+import random
+from unittest import mock, skipIf
 
 from django import test
+from django.core.files.storage import default_storage
 
 from .helpers import CropdusterTestCaseMediaMixin
-from cropduster.resizing import Crop, Box, Size
+from cropduster.resizing import Crop, Box, Size, best_fit_batch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class TestResizing(CropdusterTestCaseMediaMixin, test.TestCase):
@@ -23,3 +31,53 @@ class TestResizing(CropdusterTestCaseMediaMixin, test.TestCase):
         new_crop = size.fit_to_crop(crop)
         self.assertGreaterEqual(new_crop.box.w, 650,
             "Calculated best fit (%d) didn't get required width (650)" % new_crop.box.w)
+
+    def test_crop_geometry_without_io(self):
+        img_path = self.create_unique_image('size-order-bug.png')
+        with mock.patch.object(default_storage, 'open', side_effect=AssertionError):
+            crop = Crop(Box(x1=160, y1=0, x2=800, y2=640), img_path, size=(960, 640))
+            new_crop = Size('650', w=650, min_h=250).fit_to_crop(crop)
+            self.assertEqual(new_crop.bounds, Box(0, 0, 960, 640))
+            self.assertGreaterEqual(new_crop.box.w, 650)
+        # The original is only opened once its pixels are needed
+        self.assertEqual(new_crop.image.size, (960, 640))
+
+    @skipIf(numpy is None, "numpy is not installed")
+    def test_best_fit_batch(self):
+        rng = random.Random(1234)
+        boxes, bounds, kwargs, expected = [], [], [], []
+        while len(expected) < 5000:
+            bounds_w, bounds_h = rng.randint(1, 4000), rng.randint(1, 4000)
+            x1, x2 = sorted(rng.sample(range(bounds_w + 1), 2))
+            y1, y2 = sorted(rng.sample(range(bounds_h + 1), 2))
+            size_kwargs = {
+                'w': rng.choice([None, rng.randint(1, 2 * bounds_w)]),
+                'h': rng.choice([None, rng.randint(1, 2 * bounds_h)]),
+                'min_w': rng.choice([None, rng.randint(1, bounds_w)]),
+                'min_h': rng.choice([None, rng.randint(1, bounds_h)]),
+                'min_aspect': rng.choice([None, rng.uniform(0.2, 1.5)]),
+                'max_aspect': rng.choice([None, rng.uniform(1.5, 5), float('inf')]),
+            }
+            crop = Crop(Box(x1, y1, x2, y2), size=(bounds_w, bounds_h))
+            try:
+                best_fit = crop.best_fit(**size_kwargs)
+            except TypeError:
+                # best_fit() compared a float against a min_w or min_h of None
+                continue
+            boxes.append((x1, y1, x2, y2))
+            bounds.append((bounds_w, bounds_h))
+            kwargs.append(size_kwargs)
+            expected.append(best_fit.box.as_tuple())
+
+        def column(name):
+            return [kw.get(name) for kw in kwargs]
+
+        names = ('w', 'h', 'min_w', 'min_h', 'min_aspect', 'max_aspect')
+        fitted = best_fit_batch(boxes, bounds, **{name: column(name) for name in names})
+        self.assertEqual([tuple(box) for box in fitted.tolist()], expected)
+
+        # A single size fitted to many boxes
+        size = Size('960', w=960, h=594)
+        crop = Crop(Box(x1=0, y1=0, x2=960, y2=915), size=(960, 915))
+        fitted = size.fit_to_boxes([crop.box.as_tuple()] * 2, (960, 915))
+        self.assertEqual(fitted.tolist(), [list(size.fit_to_crop(crop).box.as_tuple())] * 2)
@@ -2,6 +2,7 @@ from io import open, BytesIO
 import os
 import shutil
 import tempfile
+from unittest import mock
 
 from PIL import Image
 
@@ -60,6 +61,257 @@ class TestUtilsImage(CropdusterTestCaseMediaMixin, test.TestCase):
                 self.assertTrue(is_animated_gif(yes))
                 self.assertFalse(is_animated_gif(no))
 
+    def test_draft_image(self):
+        from cropduster.utils import draft_image, smart_resize
+
+        with self._get_img('img.jpg') as im:
+            self.assertEqual(im.size, (674, 800))
+            draft_image(im, 150, 178)
+            # Decoded at 1/4 scale, which is still larger than the target
+            self.assertEqual(im.size, (169, 200))
+            self.assertEqual(smart_resize(im, 150, 178).size, (150, 178))
+        with self._get_img('img.png') as im:
+            draft_image(im, 150, 178)
+            self.assertEqual(im.size, (674, 800))
+
+    def test_get_preview_size(self):
+        from cropduster.utils import get_preview_size
+
+        self.assertEqual(get_preview_size((1600, 1000), 800, 500), (800, 500))
+        self.assertEqual(get_preview_size((674, 800), 800, 500), (421, 500))
+        self.assertEqual(get_preview_size((400, 300), 800, 500), (400, 300))
+
+    def test_process_image_does_not_reread(self):
+        from cropduster.utils import process_image, smart_resize
+
+        with self._get_img('img.jpg') as im:
+            with mock.patch.object(default_storage, 'open',
+                                   wraps=default_storage.open) as storage_open:
+                processed = process_image(
+                    im, 'processed.jpg', lambda i: smart_resize(i, 150, 178))
+            storage_open.assert_called_once_with('processed.jpg', 'wb')
+        self.assertEqual(processed.size, (150, 178))
+        self.assertEqual(processed.format, 'JPEG')
+        self.assertEqual(processed.filename, 'processed.jpg')
+        with default_storage.open('processed.jpg', mode='rb') as f:
+            self.assertEqual(f.read(), processed.content)
+        self.assertEqual(processed.mode, 'RGB')
+        self.assertEqual(processed.getpixel((0, 0)), processed.image.getpixel((0, 0)))
+
+    def test_search_quality(self):
+        from cropduster.utils import process_image, search_quality, smart_resize
+        from cropduster.utils.quality import get_psnr
+
+        # A noisy image, whose encoded size grows with the quality
+        resized = Image.merge('RGB', [
+            Image.effect_noise((300, 356), 40),
+            Image.linear_gradient('L').resize((300, 356)),
+            Image.radial_gradient('L').resize((300, 356)),
+        ])
+
+        def size_at(quality):
+            buf = BytesIO()
+            resized.save(buf, format='JPEG', quality=quality)
+            return len(buf.getvalue())
+
+        max_bytes = size_at(70)
+        result = search_quality(resized, max_bytes=max_bytes)
+        self.assertLessEqual(len(result.content), max_bytes)
+        self.assertGreater(size_at(result.quality + 1), max_bytes)
+        self.assertLessEqual(result.encodes, 6)
+
+        def psnr_at(quality):
+            buf = BytesIO()
+            resized.save(buf, format='JPEG', quality=quality)
+            return get_psnr(resized, Image.open(buf))
+
+        min_psnr = psnr_at(80)
+        result = search_quality(resized, min_psnr=min_psnr)
+        self.assertLessEqual(result.quality, 80)
+        self.assertGreaterEqual(get_psnr(resized, Image.open(BytesIO(result.content))), min_psnr)
+        self.assertLess(psnr_at(result.quality - 1), min_psnr)
+
+        # The byte budget wins over the similarity floor
+        result = search_quality(resized, max_bytes=size_at(50), min_psnr=60)
+        self.assertLessEqual(len(result.content), size_at(50))
+
+        with self._get_img('img.jpg') as im:
+            with mock.patch('cropduster.utils.image.CROPDUSTER_JPEG_QUALITY_SEARCH',
+                            {'max_bytes': lambda w, h: w * h // 10}):
+                processed = process_image(
+                    im, 'processed.jpg', lambda i: smart_resize(i, 300, 356))
+        self.assertLessEqual(len(processed.content), 300 * 356 // 10)
+        self.assertEqual(processed.quality, processed.quality_search.quality)
+
+    def test_copy_and_move_file(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import Storage
+        from cropduster.utils import copy_file, move_file
+        from cropduster.utils.storage import _stream_copy
+        from .storage import ServerSideCopyStorage
+
+        default_storage.save('a/src.txt', ContentFile(b'contents'))
+        with mock.patch.object(Storage, 'open', side_effect=AssertionError):
+            copy_file('a/src.txt', 'a/copy.txt')
+            move_file('a/src.txt', 'b/moved.txt')
+        self.assertFalse(default_storage.exists('a/src.txt'))
+        for name in ('a/copy.txt', 'b/moved.txt'):
+            with default_storage.open(name) as f:
+                self.assertEqual(f.read(), b'contents')
+        with self.assertRaises(FileNotFoundError):
+            move_file('a/src.txt', 'a/dst.txt')
+
+        storage = ServerSideCopyStorage()
+        copy_file('a/copy.txt', 'a/copy2.txt', storage=storage)
+        move_file('a/copy2.txt', 'a/moved2.txt', storage=storage)
+        self.assertEqual(storage.calls, [
+            ('copy', 'a/copy.txt', 'a/copy2.txt'),
+            ('move', 'a/copy2.txt', 'a/moved2.txt'),
+        ])
+
+        _stream_copy(default_storage, 'a/moved2.txt', 'a/streamed.txt')
+        with default_storage.open('a/streamed.txt') as f:
+            self.assertEqual(f.read(), b'contents')
+
+    def test_s3_internals_are_optional(self):
+        from django.core.files.storage import FileSystemStorage
+        from cropduster.utils import copy_file, probe_image
+        from cropduster.utils.storage import _s3_key
+
+        storage = mock.Mock(spec=['bucket', '_clean_name', '_normalize_name'])
+        storage._clean_name.side_effect = lambda name: name
+        storage._normalize_name.side_effect = lambda name: 'media/%s' % name
+        self.assertEqual(_s3_key(storage, 'a.jpg'), 'media/a.jpg')
+
+        # A storage with a bucket but without django-storages' internals is
+        # read and copied through the storage API
+        storage = FileSystemStorage()
+        storage.bucket = mock.Mock()
+        self.assertIsNone(_s3_key(storage, 'a.jpg'))
+        with open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), mode='rb') as f:
+            name = storage.save('probe/img.jpg', f)
+        self.assertEqual(probe_image(name, storage=storage), ('JPEG', 674, 800))
+        with mock.patch('cropduster.utils.storage.FileSystemStorage', type(None)):
+            copy_file(name, 'probe/copy.jpg', storage=storage)
+        self.assertFalse(storage.bucket.Object.called)
+        self.assertTrue(storage.exists('probe/copy.jpg'))
+
+    def test_storage_cache(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import FileSystemStorage
+        from django.core.signals import request_finished, request_started
+        from cropduster.utils import (
+            file_exists, file_size, delete_file, move_file, record_write)
+
+        default_storage.save('a/cached.txt', ContentFile(b'contents'))
+        exists = mock.patch.object(FileSystemStorage, 'exists', autospec=True, return_value=True)
+
+        # Outside of a request, without a shared cache, nothing is cached
+        with exists as mock_exists:
+            file_exists('a/cached.txt')
+            file_exists('a/cached.txt')
+        self.assertEqual(mock_exists.call_count, 2)
+
+        request_started.send(sender=self.__class__)
+        try:
+            with exists as mock_exists:
+                self.assertTrue(file_exists('a/cached.txt'))
+                self.assertTrue(file_exists('a/cached.txt'))
+                self.assertEqual(mock_exists.call_count, 1)
+                self.assertEqual(file_size('a/cached.txt'), 8)
+                move_file('a/cached.txt', 'a/moved.txt')
+                self.assertFalse(file_exists('a/cached.txt'))
+                self.assertTrue(file_exists('a/moved.txt'))
+                delete_file('a/moved.txt')
+                self.assertFalse(file_exists('a/moved.txt'))
+                record_write('a/written.txt', size=3)
+                self.assertTrue(file_exists('a/written.txt'))
+                self.assertEqual(file_size('a/written.txt'), 3)
+                self.assertEqual(mock_exists.call_count, 1)
+        finally:
+            request_finished.send(sender=self.__class__)
+        self.assertFalse(default_storage.exists('a/moved.txt'))
+
+        cache_settings = {'storage': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with self.settings(CACHES=cache_settings), \
+                mock.patch('cropduster.settings.CROPDUSTER_STORAGE_CACHE', 'storage'):
+            with exists as mock_exists:
+                file_exists('a/other.txt')
+                file_exists('a/other.txt')
+            self.assertEqual(mock_exists.call_count, 1)
+
+    def test_storage_cache_is_per_request(self):
+        import threading
+        from django.core.files.storage import FileSystemStorage
+        from cropduster.utils import delete_file, file_exists, record_write, storage_cache
+
+        def other_request():
+            # Another request in another thread starts with an empty cache,
+            # and forgets its entries when it finishes
+            with storage_cache():
+                results.append(file_exists('a/written.txt'))
+                record_write('a/other.txt')
+
+        results = []
+        with storage_cache():
+            record_write('a/written.txt')
+            thread = threading.Thread(target=other_request)
+            thread.start()
+            thread.join()
+            self.assertEqual(results, [False])
+            self.assertTrue(file_exists('a/written.txt'))
+            self.assertFalse(file_exists('a/other.txt'))
+
+            # Files cached as missing are still deleted
+            with mock.patch.object(FileSystemStorage, 'delete', autospec=True) as mock_delete:
+                delete_file('a/other.txt')
+            self.assertEqual(mock_delete.call_count, 1)
+
+        with mock.patch.object(FileSystemStorage, 'exists', autospec=True, return_value=True):
+            self.assertTrue(file_exists('a/other.txt'))
+
+    def test_xmp_packet(self):
+        from cropduster.utils import process_image
+        from cropduster.utils.xmp import (
+            read_xmp_packet, write_xmp_packet, get_image_xmp_packet)
+
+        packet = b'<x:xmpmeta xmlns:x="adobe:ns:meta/"></x:xmpmeta>'
+        for filename in ('img.jpg', 'img.png'):
+            with open(os.path.join(self.TEST_IMG_DIR, filename), mode='rb') as f:
+                data = f.read()
+            self.assertIsNone(read_xmp_packet(data))
+            data = write_xmp_packet(data, packet + b'old')
+            data = write_xmp_packet(data, packet)
+            self.assertEqual(read_xmp_packet(data), packet)
+            with Image.open(BytesIO(data)) as im:
+                self.assertEqual(im.size, (674, 800))
+                self.assertEqual(get_image_xmp_packet(im), packet)
+                processed = process_image(im, 'processed-%s' % filename, xmp=packet)
+            with default_storage.open(processed.filename, mode='rb') as f:
+                self.assertEqual(read_xmp_packet(f.read()), packet)
+
+        with open(os.path.join(self.TEST_IMG_DIR, 'animated.gif'), mode='rb') as f:
+            with self.assertRaises(ValueError):
+                write_xmp_packet(f.read(), packet)
+
+    def test_probe_image(self):
+        from cropduster.utils import probe_image
+        from cropduster.utils.probe import probe_image_bytes
+
+        for filename in os.listdir(self.TEST_IMG_DIR):
+            with self._get_img(filename) as im:
+                expected = (im.format, im.width, im.height)
+            with open(os.path.join(self.TEST_IMG_DIR, filename), mode='rb') as f:
+                name = default_storage.save('probe/%s' % filename, f)
+            self.assertEqual(probe_image(name), expected)
+
+        for fmt, mode in [('WEBP', 'RGB'), ('WEBP', 'RGBA'), ('TIFF', 'RGB')]:
+            buf = BytesIO()
+            Image.new(mode, (321, 123)).save(buf, fmt, lossless=(mode == 'RGBA'))
+            self.assertEqual(probe_image_bytes(buf.getvalue()), (fmt, 321, 123))
+
+        self.assertIsNone(probe_image('probe/does-not-exist.jpg'))
+
 
 class TestUtilsPaths(CropdusterTestCaseMediaMixin, test.TestCase):
 
@@ -70,9 +322,51 @@ class TestUtilsPaths(CropdusterTestCaseMediaMixin, test.TestCase):
         path = random = uuid.uuid4().hex
         folder_path = get_upload_foldername('my img.jpg', upload_to=path)
         self.assertEqual(folder_path, "%s/my_img" % (path))
-        default_storage.save("%s/original.jpg" % folder_path, BytesIO(b''))
-        self.assertEqual(get_upload_foldername('my img.jpg', upload_to=path),
-                         os.path.join(path, 'my_img-1'))
+        # The folder is reserved as soon as its name is returned
+        self.assertRegex(get_upload_foldername('my img.jpg', upload_to=path),
+                         r'^%s/my_img-[0-9a-f]{8}$' % path)
+
+        with mock.patch.object(default_storage, 'listdir', side_effect=AssertionError):
+            folder_paths = set(
+                get_upload_foldername('my img.jpg', upload_to=path) for i in range(20))
+        self.assertEqual(len(folder_paths), 20)
+
+    def test_upload_folder_permissions(self):
+        import stat
+        import uuid
+        from cropduster.utils import get_upload_foldername
+
+        path = uuid.uuid4().hex
+        with self.settings(FILE_UPLOAD_DIRECTORY_PERMISSIONS=0o750):
+            folder_path = get_upload_foldername('my img.jpg', upload_to=path)
+        for name in (path, folder_path):
+            mode = os.stat(default_storage.path(name)).st_mode
+            self.assertEqual(stat.S_IMODE(mode), 0o750)
+
+    def test_failed_upload_leaves_no_folder(self):
+        import uuid
+        from django import forms
+        from django.core.files.storage import FileSystemStorage
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from cropduster.resizing import Size
+        from cropduster.views.forms import clean_upload_data
+
+        path = uuid.uuid4().hex
+        with open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), mode='rb') as f:
+            contents = f.read()
+
+        # Too small for its sizes
+        data = {'image': SimpleUploadedFile('img.jpg', contents), 'upload_to': path,
+                'sizes': [Size('main', w=5000, h=5000)]}
+        with self.assertRaises(forms.ValidationError):
+            clean_upload_data(data)
+        self.assertFalse(default_storage.exists(path))
+
+        data = {'image': SimpleUploadedFile('img.jpg', contents), 'upload_to': path}
+        with mock.patch.object(FileSystemStorage, 'save', side_effect=IOError):
+            with self.assertRaises(IOError):
+                clean_upload_data(data)
+        self.assertEqual(default_storage.listdir(path), ([], []))
 
     def test_get_min_size(self):
         from cropduster.utils import get_min_size
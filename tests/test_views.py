@@ -1,4 +1,8 @@
+import html
 import os
+import re
+from unittest import mock
+from urllib.parse import urlencode
 
 from django import test
 from django.core.files.storage import default_storage
@@ -7,12 +11,16 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
-from django.http import HttpRequest
+from django.forms.models import modelformset_factory
+from django.http import HttpRequest, QueryDict
 
 from cropduster import views
+from cropduster.models import Thumb
 from cropduster.utils import json
+from cropduster.views.forms import ThumbForm, ThumbFormSet
 
 from .helpers import CropdusterTestCaseMediaMixin
+from .models import Article, Author
 
 
 class CropdusterViewTestRunner(CropdusterTestCaseMediaMixin, test.TestCase):
@@ -22,6 +30,39 @@ class CropdusterViewTestRunner(CropdusterTestCaseMediaMixin, test.TestCase):
         self.user = User.objects.create_superuser('test',
             'test@test.com', 'password')
 
+    def create_article_image(self):
+        article = Article.objects.create(title="", author=Author.objects.create(name=""),
+            lead_image=self.create_unique_image('img.jpg'))
+        article.lead_image.generate_thumbs()
+        return Article.objects.get(pk=article.pk).lead_image.related_object
+
+    def post_crop(self, image, thumb, **data):
+        """Submits the crop form of ``thumb``, with ``data`` overriding its values"""
+        form_data = {
+            'crop-image_id': image.pk,
+            'crop-orig_image': image.image.name,
+            'crop-orig_w': image.width,
+            'crop-orig_h': image.height,
+            'crop-sizes': json.dumps(Article.LEAD_IMAGE_SIZES),
+            'crop-thumbs': '{}',
+            'thumbs-TOTAL_FORMS': 1,
+            'thumbs-INITIAL_FORMS': 1,
+            'thumbs-0-id': thumb.pk,
+            'thumbs-0-name': thumb.name,
+            'thumbs-0-width': thumb.width,
+            'thumbs-0-height': thumb.height,
+            'thumbs-0-crop_x': thumb.crop_x,
+            'thumbs-0-crop_y': thumb.crop_y,
+            'thumbs-0-crop_w': thumb.crop_w,
+            'thumbs-0-crop_h': thumb.crop_h,
+            'thumbs-0-thumbs': '{}',
+            'thumbs-0-size': json.dumps(Article.LEAD_IMAGE_SIZES[0]),
+        }
+        form_data.update(('thumbs-0-%s' % k, v) for k, v in data.items())
+        request = self.factory.post(reverse('cropduster-crop'), form_data)
+        request.user = self.user
+        return views.crop(request)
+
 
 class TestIndex(CropdusterViewTestRunner):
 
@@ -31,6 +72,40 @@ class TestIndex(CropdusterViewTestRunner):
         response = views.index(request)
         self.assertEqual(response.status_code, 200)
 
+    def get_existing_image_request(self, image):
+        request = self.factory.get(reverse('cropduster-index'), {
+            'id': image.pk,
+            'image': image.image.name,
+            'sizes': json.dumps(Article.LEAD_IMAGE_SIZES),
+            'thumbs': ','.join(str(t.pk) for t in image.thumbs.all()),
+        })
+        request.user = self.user
+        return request
+
+    def test_get_existing_image_queries(self):
+        request = self.get_existing_image_request(self.create_article_image())
+        with self.assertNumQueries(2):
+            response = views.index(request)
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_existing_image_groups_auto_thumbs(self):
+        response = views.index(self.get_existing_image_request(self.create_article_image()))
+        # The form of 'main' has the auto thumb that references it
+        main_group = re.search(r'name="thumbs-0-thumbs" value="([^"]*)"',
+                               response.content.decode('utf-8')).group(1)
+        self.assertEqual(sorted(json.loads(html.unescape(main_group))), ['main', 'thumb'])
+
+    def test_submitted_thumbs_are_looked_up_at_once(self):
+        thumbs = dict((t.name, t) for t in self.create_article_image().thumbs.all())
+        FormSet = modelformset_factory(Thumb, form=ThumbForm, formset=ThumbFormSet)
+        data = {'thumbs-TOTAL_FORMS': 2, 'thumbs-INITIAL_FORMS': 2}
+        for i, name in enumerate(['main', 'no_height']):
+            data['thumbs-%d-id' % i] = thumbs[name].pk
+        formset = FormSet(QueryDict(urlencode(data), mutable=True), prefix='thumbs')
+        with self.assertNumQueries(1):
+            instances = [form.instance for form in formset.forms]
+        self.assertEqual(instances, [thumbs['main'], thumbs['no_height']])
+
     def test_post_is_405(self):
         request = self.factory.post(reverse('cropduster-index'), {})
         request.user = self.user
@@ -111,3 +186,99 @@ class TestUpload(CropdusterViewTestRunner):
             self.assertEqual(response.status_code, 200)
             data = json.loads(response.content)
             self.assertTrue(default_storage.exists(data['orig_image']))
+
+
+class TestCrop(CropdusterViewTestRunner):
+
+    def test_unchanged_thumbs_are_not_copied(self):
+        image = self.create_article_image()
+        with mock.patch.object(default_storage, 'open', wraps=default_storage.open) as storage_open:
+            response = self.post_crop(image, image.thumbs.get(name='main'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c for c in storage_open.call_args_list if 'wb' in c.args], [])
+
+    def test_unchanged_thumbs_keep_their_committed_file(self):
+        image = self.create_article_image()
+        thumb = image.thumbs.get(name='main')
+        # A tmp file left behind by a crop that was never saved
+        stale_tmp_path = image.get_image_path('main', tmp=True)
+        with default_storage.open(stale_tmp_path, 'wb') as f:
+            f.write(b'stale')
+
+        self.assertEqual(self.post_crop(image, thumb).status_code, 200)
+        self.assertFalse(default_storage.exists(stale_tmp_path))
+        thumb.save()
+        with default_storage.open(image.get_image_path('main'), 'rb') as f:
+            self.assertNotEqual(f.read(), b'stale')
+
+    def recrop(self, image, thumb):
+        response = self.post_crop(image, thumb, crop_y=thumb.crop_y - 10, changed=True)
+        self.assertEqual(response.status_code, 200)
+        return dict((t.name, t) for t in Thumb.objects.filter(generation=thumb.generation + 1))
+
+    def test_recrop_creates_next_generation(self):
+        image = self.create_article_image()
+        old_thumbs = set(image.thumbs.all())
+        new_thumbs = self.recrop(image, image.thumbs.get(name='main'))
+
+        # The new generation belongs to no image until it is committed
+        self.assertEqual(sorted(new_thumbs), ['main', 'thumb'])
+        self.assertIsNone(new_thumbs['main'].image_id)
+        self.assertEqual(new_thumbs['thumb'].reference_thumb_id, new_thumbs['main'].pk)
+        self.assertEqual(set(image.thumbs.all()), old_thumbs)
+
+    def test_resubmit_unchanged_recrop(self):
+        image = self.create_article_image()
+        new_thumb = self.recrop(image, image.thumbs.get(name='main'))['main']
+        tmp_path = image.get_image_path('main', tmp=True)
+        self.assertTrue(default_storage.exists(tmp_path))
+
+        response = self.post_crop(image, new_thumb)
+        self.assertEqual(response.status_code, 200)
+        # The tmp file is the only file of the uncommitted crop
+        self.assertTrue(default_storage.exists(tmp_path))
+
+    def test_commit_deletes_replaced_generation(self):
+        image = self.create_article_image()
+        old_thumbs = dict((t.name, t) for t in image.thumbs.all())
+        new_thumbs = self.recrop(image, old_thumbs['main'])
+        committed = [new_thumbs['main'], new_thumbs['thumb'], old_thumbs['no_height']]
+
+        self.assertEqual(image.delete_replaced_thumbs(committed), 2)
+        image.thumbs.set(committed)
+        self.assertEqual(set(image.thumbs.all()), set(Thumb.objects.all()))
+        self.assertEqual(image.thumbs.get(name='main').pk, new_thumbs['main'].pk)
+
+    def test_set_subset_keeps_removed_thumbs(self):
+        image = self.create_article_image()
+        main = image.thumbs.get(name='main')
+        image.thumbs.set([main])
+        # Thumbs left out of set() are detached from the image, not deleted
+        self.assertEqual(list(image.thumbs.all()), [main])
+        self.assertEqual(Thumb.objects.count(), 3)
+
+    def test_compact_thumbs_deletes_old_uncommitted_crops(self):
+        from datetime import timedelta
+        from io import StringIO
+        from django.core.management import call_command
+        from django.utils import timezone
+
+        image = self.create_article_image()
+        self.recrop(image, image.thumbs.get(name='main'))
+        call_command('cropduster_compact_thumbs', stdout=StringIO())
+        self.assertEqual(Thumb.objects.count(), 5)
+
+        orphans = Thumb.objects.filter(image__isnull=True)
+        tmp_paths = [p for t in orphans for p in t.get_image_paths(tmp=True, image=image)]
+        self.assertEqual(len(tmp_paths), 2)
+        self.assertTrue(all(default_storage.exists(p) for p in tmp_paths))
+
+        orphans.update(date_modified=timezone.now() - timedelta(days=2))
+        stdout = StringIO()
+        call_command('cropduster_compact_thumbs', batch_size=1, stdout=stdout)
+        self.assertIn("Deleted 2 orphaned thumb(s)", stdout.getvalue())
+        self.assertEqual(set(image.thumbs.all()), set(Thumb.objects.all()))
+        self.assertFalse(any(default_storage.exists(p) for p in tmp_paths))
+        for thumb in image.thumbs.all():
+            for path in thumb.get_image_paths():
+                self.assertTrue(default_storage.exists(path))